@@ -5,7 +5,8 @@ from django.contrib import admin
 from django_comments import get_model
 from django_comments.admin import CommentsAdmin
 from django_comments.models import CommentFlag
-from django_comments_xtd.models import XtdComment, BlackListedDomain
+from django_comments_xtd.models import (XtdComment, BlackListedDomain,
+                                        FollowupNotification)
 
 
 class XtdCommentsAdmin(CommentsAdmin):
@@ -43,7 +44,13 @@ class BlackListedDomainAdmin(admin.ModelAdmin):
     search_fields = ['domain']
 
 
+class FollowupNotificationAdmin(admin.ModelAdmin):
+    list_display = ('comment', 'created', 'attempts', 'claimed_until')
+    raw_id_fields = ('comment',)
+
+
 if get_model() is XtdComment:
     admin.site.register(XtdComment, XtdCommentsAdmin)
     admin.site.register(CommentFlag)
     admin.site.register(BlackListedDomain, BlackListedDomainAdmin)
+    admin.site.register(FollowupNotification, FollowupNotificationAdmin)
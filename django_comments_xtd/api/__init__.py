@@ -1,6 +1,6 @@
 from django_comments_xtd.api.views import (
-    CommentCreate, CommentList, CommentCount, ToggleFeedbackFlag,
-    CreateReportFlag)
+    CommentCreate, CommentList, CommentTree, CommentCount, CommentCounts,
+    ToggleFeedbackFlag, CreateReportFlag)
 
-__all__ = (CommentCreate, CommentList, CommentCount, ToggleFeedbackFlag,
-           CreateReportFlag)
+__all__ = (CommentCreate, CommentList, CommentTree, CommentCount,
+           CommentCounts, ToggleFeedbackFlag, CreateReportFlag)
@@ -0,0 +1,149 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.db.models import Count
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.six.moves.urllib import parse as urlparse
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from django_comments_xtd.conf import settings
+
+
+def get_thread_ordering():
+    """
+    Return the fields ordering threads and the comments within each thread,
+    as given in COMMENTS_XTD_LIST_ORDER, ie: ('thread_id', 'order').
+    """
+    list_order = tuple(settings.COMMENTS_XTD_LIST_ORDER)
+    if len(list_order) != 2 or list_order[0].lstrip('-') != 'thread_id':
+        return ('thread_id', 'order')
+    return list_order
+
+
+def lookup(field):
+    """Return the lookup for the values that come after in field order."""
+    if field.startswith('-'):
+        return '%s__lt' % field[1:]
+    return '%s__gt' % field
+
+
+class ThreadCursorPagination(BasePagination):
+    """
+    Paginate comments by thread, leaving the replies of each thread together.
+
+    A page holds up to ``threads_per_page`` threads. Threads with more than
+    ``replies_per_page`` replies are cut short, and get a cursor to request
+    the rest of the replies, ``replies_per_page`` at a time. Pagination is
+    disabled when ``threads_per_page`` is 0.
+    """
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self):
+        self.threads_per_page = settings.COMMENTS_XTD_API_THREADS_PER_PAGE
+        self.replies_per_page = settings.COMMENTS_XTD_API_REPLIES_PER_PAGE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.threads_per_page:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = get_thread_ordering()
+        self.next_cursor = None
+        self.replies_cursors = OrderedDict()
+        cursor = self.decode_cursor(request)
+        queryset = queryset.order_by(*self.ordering)
+        if cursor.get('thread') is not None:
+            return self.paginate_replies(queryset, cursor['thread'],
+                                         cursor['position'])
+        return self.paginate_threads(queryset, cursor.get('after'))
+
+    def paginate_threads(self, queryset, after):
+        thread_order = self.ordering[0]
+        threads = queryset.order_by(thread_order)\
+                          .values_list('thread_id')\
+                          .annotate(count=Count('pk'))
+        if after is not None:
+            threads = threads.filter(**{lookup(thread_order): after})
+        threads = list(threads[:self.threads_per_page + 1])
+        if len(threads) > self.threads_per_page:
+            threads = threads[:self.threads_per_page]
+            self.next_cursor = {'after': threads[-1][0]}
+
+        # Threads short enough are read at once, the others one by one.
+        short = [thread_id for thread_id, count in threads
+                 if count <= self.replies_per_page + 1]
+        comments = dict((thread_id, []) for thread_id, count in threads)
+        for comment in queryset.filter(thread_id__in=short):
+            comments[comment.thread_id].append(comment)
+        for thread_id, count in threads:
+            if thread_id not in short:
+                comments[thread_id] = self.get_thread_page(
+                    queryset.filter(thread_id=thread_id), thread_id,
+                    self.replies_per_page + 1)
+        return [comment for thread_id, count in threads
+                for comment in comments[thread_id]]
+
+    def paginate_replies(self, queryset, thread_id, position):
+        field = self.ordering[1]
+        queryset = queryset.filter(thread_id=thread_id,
+                                   **{lookup(field): position})
+        page = self.get_thread_page(queryset, thread_id,
+                                    self.replies_per_page)
+        self.next_cursor = self.replies_cursors.pop(thread_id, None)
+        return page
+
+    def get_thread_page(self, queryset, thread_id, size):
+        page = list(queryset[:size + 1])
+        if len(page) > size:
+            page = page[:size]
+            field = self.ordering[1].lstrip('-')
+            self.replies_cursors[thread_id] = {
+                'thread': thread_id,
+                'position': getattr(page[-1], field)}
+        return page
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return {}
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = urlparse.parse_qs(querystring, keep_blank_values=True)
+            cursor = {}
+            if 'a' in tokens:
+                cursor['after'] = int(tokens['a'][0])
+            else:
+                cursor['thread'] = int(tokens['t'][0])
+                cursor['position'] = tokens['p'][0]
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, cursor):
+        if cursor is None:
+            return None
+        if 'after' in cursor:
+            tokens = {'a': cursor['after']}
+        else:
+            tokens = {'t': cursor['thread'], 'p': cursor['position']}
+        querystring = urlparse.urlencode(sorted(tokens.items()), doseq=True)
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        return replace_query_param(remove_query_param(self.base_url, 'since'),
+                                   self.cursor_query_param, encoded)
+
+    def get_paginated_data(self, data):
+        return OrderedDict([
+            ('comments', data),
+            ('next', self.encode_cursor(self.next_cursor)),
+            ('replies', OrderedDict(
+                (force_text(thread_id), self.encode_cursor(cursor))
+                for thread_id, cursor in six.iteritems(self.replies_cursors)))
+        ])
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
@@ -7,16 +7,19 @@ except ImportError:
 from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.shortcuts import get_current_site
-from django.utils import formats
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, models
+from django.utils import dateformat, formats
 from django.utils.html import escape
-from django.utils.translation import ugettext as _, activate, get_language
+from django.utils.translation import ugettext as _
 
 from django_comments import get_form
 from django_comments.models import CommentFlag
 from django_comments.signals import comment_will_be_posted, comment_was_posted
 from rest_framework import serializers
+from rest_framework.settings import ISO_8601
 
-from django_comments_xtd import signed, views
+from django_comments_xtd import views
 from django_comments_xtd.conf import settings
 from django_comments_xtd.models import (TmpXtdComment, XtdComment,
                                         LIKEDIT_FLAG, DISLIKEDIT_FLAG)
@@ -131,8 +134,13 @@ class WriteCommentSerializer(serializers.Serializer):
 
         # Replicate logic from django_comments_xtd.views.on_comment_was_posted.
         if not settings.COMMENTS_XTD_CONFIRM_EMAIL or user_is_authenticated:
+            new_comment = None
             if not views._comment_exists(resp['comment']):
-                new_comment = views._create_comment(resp['comment'])
+                try:
+                    new_comment = views._create_comment(resp['comment'])
+                except IntegrityError:  # Posted twice at once.
+                    pass
+            if new_comment is not None:
                 resp['comment'].xtd_comment = new_comment
                 confirmation_received.send(sender=TmpXtdComment,
                                            comment=resp['comment'],
@@ -141,25 +149,38 @@ class WriteCommentSerializer(serializers.Serializer):
                                         comment=new_comment,
                                         request=self.request)
                 if resp['comment'].is_public:
-                    resp['code'] = 201
                     views.notify_comment_followers(new_comment)
-                else:
-                    resp['code'] = 202
+            # A duplicate gets the same response the comment got when it
+            # was posted the first time.
+            resp['code'] = 201 if resp['comment'].is_public else 202
         else:
-            key = signed.dumps(resp['comment'], compress=True,
-                               extra_key=settings.COMMENTS_XTD_SALT)
+            key = views.get_confirmation_key(resp['comment'])
             views.send_email_confirmation_request(resp['comment'], key, site)
             resp['code'] = 204  # Confirmation sent by mail.
 
         return resp
 
 
+class ReadCommentListSerializer(serializers.ListSerializer):
+    """Prefetch flags for all the comments before serializing them."""
+
+    def to_representation(self, data):
+        if isinstance(data, models.Manager):
+            data = data.all()
+        data = XtdComment.prefetch_users_flagging(
+            data, [LIKEDIT_FLAG, DISLIKEDIT_FLAG, CommentFlag.SUGGEST_REMOVAL])
+        return super(ReadCommentListSerializer, self).to_representation(data)
+
+
 class ReadCommentSerializer(serializers.ModelSerializer):
     user_name = serializers.CharField(max_length=50, read_only=True)
     user_url = serializers.CharField(read_only=True)
     user_moderator = serializers.SerializerMethodField()
     user_avatar = serializers.SerializerMethodField()
     submit_date = serializers.SerializerMethodField()
+    submit_date_iso = serializers.DateTimeField(source='submit_date',
+                                                format=ISO_8601,
+                                                read_only=True)
     parent_id = serializers.IntegerField(default=0, read_only=True)
     level = serializers.IntegerField(read_only=True)
     is_removed = serializers.BooleanField(read_only=True)
@@ -172,17 +193,25 @@ class ReadCommentSerializer(serializers.ModelSerializer):
         model = XtdComment
         fields = ('id', 'user_name', 'user_url', 'user_moderator',
                   'user_avatar', 'permalink', 'comment', 'submit_date',
-                  'parent_id', 'level', 'is_removed', 'allow_reply', 'flags')
+                  'submit_date_iso', 'parent_id', 'level', 'is_removed',
+                  'allow_reply', 'flags')
+        list_serializer_class = ReadCommentListSerializer
 
     def __init__(self, *args, **kwargs):
         self.request = kwargs['context']['request']
         super(ReadCommentSerializer, self).__init__(*args, **kwargs)
 
     def get_submit_date(self, obj):
-        activate(get_language())
-        print("Language: ", get_language())
-        return formats.date_format(obj.submit_date, 'DATETIME_FORMAT',
-                                   use_l10n=True)
+        # The format, in the language of the request, is resolved once,
+        # and each date formatted once, for all the comments serialized.
+        if 'datetime_format' not in self.context:
+            self.context['datetime_format'] = formats.get_format(
+                'DATETIME_FORMAT', use_l10n=True)
+        submit_dates = self.context.setdefault('submit_dates', {})
+        if obj.submit_date not in submit_dates:
+            submit_dates[obj.submit_date] = dateformat.format(
+                obj.submit_date, self.context['datetime_format'])
+        return submit_dates[obj.submit_date]
 
     def get_comment(self, obj):
         if obj.is_removed:
@@ -190,14 +219,33 @@ class ReadCommentSerializer(serializers.ModelSerializer):
         else:
             return obj.comment
 
+    # The app.model options, and whether the request user and the authors
+    # of the comments can moderate, are resolved once and kept in the
+    # context, shared by all the comments serialized in the same request.
+
+    def get_app_model_options(self, obj):
+        options = self.context.setdefault('app_model_options', {})
+        if obj.content_type_id not in options:
+            options[obj.content_type_id] = has_app_model_option(obj)
+        return options[obj.content_type_id]
+
+    def request_user_can_moderate(self):
+        if 'can_moderate' not in self.context:
+            self.context['can_moderate'] = self.request.user.has_perm(
+                "django_comments.can_moderate")
+        return self.context['can_moderate']
+
     def get_user_moderator(self, obj):
-        try:
-            if obj.user and obj.user.has_perm('comments.can_moderate'):
-                return True
-            else:
-                return False
-        except:
-            return None
+        if obj.user_id is None:
+            return False
+        moderators = self.context.setdefault('moderators', {})
+        if obj.user_id not in moderators:
+            try:
+                moderators[obj.user_id] = obj.user.has_perm(
+                    'django_comments.can_moderate')
+            except (AttributeError, ObjectDoesNotExist):
+                moderators[obj.user_id] = None
+        return moderators[obj.user_id]
 
     def get_flags(self, obj):
         flags = {
@@ -206,27 +254,25 @@ class ReadCommentSerializer(serializers.ModelSerializer):
             'removal': {'active': False, 'count': None},
         }
         users_likedit, users_dislikedit = None, None
+        options = self.get_app_model_options(obj)
 
-        if has_app_model_option(obj)['allow_flagging']:
-            users_flagging = obj.users_flagging(CommentFlag.SUGGEST_REMOVAL)
-            if self.request.user in users_flagging:
+        if options['allow_flagging']:
+            if obj.is_flagged_by(self.request.user,
+                                 CommentFlag.SUGGEST_REMOVAL):
                 flags['removal']['active'] = True
-            if self.request.user.has_perm("django_comments.can_moderate"):
-                flags['removal']['count'] = len(users_flagging)
+            if self.request_user_can_moderate():
+                flags['removal']['count'] = obj.flagged_count
 
-        if (
-                has_app_model_option(obj)['allow_feedback'] or
-                has_app_model_option(obj)['show_feedback']
-        ):
+        if options['allow_feedback'] or options['show_feedback']:
             users_likedit = obj.users_flagging(LIKEDIT_FLAG)
             users_dislikedit = obj.users_flagging(DISLIKEDIT_FLAG)
 
-        if has_app_model_option(obj)['allow_feedback']:
-            if self.request.user in users_likedit:
+        if options['allow_feedback']:
+            if obj.is_flagged_by(self.request.user, LIKEDIT_FLAG):
                 flags['like']['active'] = True
-            elif self.request.user in users_dislikedit:
+            elif obj.is_flagged_by(self.request.user, DISLIKEDIT_FLAG):
                 flags['dislike']['active'] = True
-        if has_app_model_option(obj)['show_feedback']:
+        if options['show_feedback']:
             flags['like']['users'] = [
                 "%d:%s" % (user.id, settings.COMMENTS_XTD_API_USER_REPR(user))
                 for user in users_likedit]
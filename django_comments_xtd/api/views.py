@@ -1,13 +1,27 @@
+from datetime import timedelta
+from itertools import islice
+
 from django.contrib.contenttypes.models import ContentType
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.utils.translation import get_language
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
 from django_comments.views.moderation import perform_flag
 from rest_framework import generics, mixins, permissions, status
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from django_comments_xtd import views
 from django_comments_xtd.api import serializers
-from django_comments_xtd.models import XtdComment
-from rest_framework.views import APIView
+from django_comments_xtd.api.pagination import ThreadCursorPagination
+from django_comments_xtd.cache import get_version, make_etag
+from django_comments_xtd.conf import settings
+from django_comments_xtd.models import XtdComment, get_comment_counts
 
 
 class CommentCreate(generics.CreateAPIView):
@@ -25,11 +39,66 @@ class CommentCreate(generics.CreateAPIView):
         self.resp_dict = serializer.save()
 
 
+# Margin by which deltas of the comment list overlap in time.
+DELTA_OVERLAP = timedelta(seconds=5)
+
+# Comments read and serialized at a time in streamed comment lists.
+STREAM_CHUNK_SIZE = 100
+
+
+def comments_version(content_type=None, object_pk=None, **kwargs):
+    """
+    Return the version of the comments posted to the object, as kept in the
+    cache, or None when the content type does not exist.
+    """
+    app_label, model = content_type.split("-")
+    try:
+        ctype = ContentType.objects.get_by_natural_key(app_label, model)
+    except ContentType.DoesNotExist:
+        return None
+    return get_version(ctype.pk, object_pk)
+
+
+def comment_list_etag(request, *args, **kwargs):
+    # Comments are represented differently depending on the user, as
+    # they include the flags the user has sent, and on the language.
+    version = comments_version(**kwargs)
+    if version is not None:
+        return make_etag(version, request.user.pk, get_language(),
+                         request.META.get('HTTP_ACCEPT', ''),
+                         request.GET.urlencode())
+
+
+def comment_count_etag(request, *args, **kwargs):
+    version = comments_version(**kwargs)
+    if version is not None:
+        return make_etag(version, request.META.get('HTTP_ACCEPT', ''))
+
+
 class CommentList(generics.ListAPIView):
-    """List all comments for a given ContentType and object ID."""
+    """
+    List all comments for a given ContentType and object ID.
+
+    With the 'since' argument, list only the comments changed after the
+    given time, the IDs of those that are no longer public, and the value
+    of 'since' to use in the next request. An empty 'since' lists all
+    the comments.
+
+    With COMMENTS_XTD_API_THREADS_PER_PAGE, list the comments by pages of
+    threads, see ThreadCursorPagination. Changes are never paginated.
+
+    With COMMENTS_XTD_API_STREAMING, lists not paginated are encoded in
+    JSON as comments are read, STREAM_CHUNK_SIZE at a time.
+    """
     serializer_class = serializers.ReadCommentSerializer
+    pagination_class = ThreadCursorPagination
 
-    def get_queryset(self):
+    @method_decorator(cache_control(private=True, no_cache=True))
+    @method_decorator(condition(etag_func=comment_list_etag))
+    def get(self, request, *args, **kwargs):
+        return super(CommentList, self).get(request, *args, **kwargs)
+
+    def get_comments(self):
         content_type_arg = self.kwargs.get('content_type', None)
         object_pk_arg = self.kwargs.get('object_pk', None)
         app_label, model = content_type_arg.split("-")
@@ -41,26 +110,163 @@ class CommentList(generics.ListAPIView):
         else:
             qs = XtdComment.objects.filter(content_type=content_type,
                                            object_pk=int(object_pk_arg),
-                                           is_public=True)
+                                           site__pk=settings.SITE_ID)
         return qs
 
+    def get_queryset(self):
+        return self.get_comments().filter(is_public=True)
+
+    def list(self, request, *args, **kwargs):
+        if 'since' not in request.query_params:
+            queryset = self.get_queryset()
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                serializer = self.get_serializer(page, many=True)
+                return self.get_paginated_response(serializer.data)
+            if self.is_streaming():
+                return self.get_streaming_response(queryset)
+            return super(CommentList, self).list(request, *args, **kwargs)
+        since_arg = request.query_params['since']
+        try:
+            since = parse_datetime(since_arg) if since_arg else None
+        except ValueError:
+            since = None
+        if since_arg and since is None:
+            raise ParseError("'since' must be a date and time in ISO 8601.")
+        # Changes being committed while the comments are read might have
+        # been made slightly before 'now'. Reporting them twice is harmless.
+        next_since = timezone.now() - DELTA_OVERLAP
+        queryset = self.get_queryset()
+        removed = []
+        page = None
+        if since is not None:
+            queryset = queryset.filter(modified__gte=since)
+            removed = self.get_comments()\
+                          .filter(is_public=False, modified__gte=since)\
+                          .values_list('pk', flat=True)
+        else:
+            page = self.paginate_queryset(queryset)
+        if page is None and self.is_streaming():
+            return self.get_streaming_response(
+                queryset, ('comments', {'removed': list(removed),
+                                        'since': next_since.isoformat()}))
+        serializer = self.get_serializer(
+            queryset if page is None else page, many=True)
+        data = {'comments': serializer.data}
+        if page is not None:
+            data = self.paginator.get_paginated_data(serializer.data)
+        data['removed'] = list(removed)
+        data['since'] = next_since.isoformat()
+        return Response(data)
+
+    def is_streaming(self):
+        return (settings.COMMENTS_XTD_API_STREAMING and
+                isinstance(self.request.accepted_renderer, JSONRenderer))
+
+    def get_streaming_response(self, queryset, wrapper=None):
+        """
+        Return a response streaming the comments in queryset as a JSON
+        array. With wrapper, a pair (key, data), the array is the value of
+        key in the data object.
+        """
+        renderer = self.request.accepted_renderer
+        head, tail = b'[', b']'
+        if wrapper is not None:
+            key, data = wrapper
+            head = b'{' + renderer.render(key) + b':['
+            tail = b']' + (b',' + renderer.render(data)[1:] if data
+                           else b'}')
+        return StreamingHttpResponse(
+            self.stream_comments(queryset, renderer, head, tail),
+            content_type=renderer.media_type)
+
+    def stream_comments(self, queryset, renderer, head, tail):
+        yield head
+        # The iterator doesn't keep the comments read in the queryset cache.
+        comments = queryset.iterator()
+        separator = b''
+        while True:
+            chunk = list(islice(comments, STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            data = self.get_serializer(chunk, many=True).data
+            yield separator + b','.join(renderer.render(item)
+                                        for item in data)
+            separator = b','
+        yield tail
+
+
+def tree_from_serialized(data):
+    """
+    Return the serialized comments in data, in thread order, as a list of
+    nested dictionaries, the same way XtdComment.tree_from_queryset does.
+    """
+    dic_list = []
+    dic_by_id = {}
+    for item in data:
+        if item['level'] == 0:
+            siblings = dic_list
+        else:
+            parent_dict = dic_by_id.get(item['parent_id'])
+            if parent_dict is None:
+                continue
+            siblings = parent_dict['children']
+        new_dict = {'comment': item, 'children': []}
+        dic_by_id[item['id']] = new_dict
+        siblings.append(new_dict)
+    return dic_list
+
+
+class CommentTree(CommentList):
+    """
+    List all comments for a given ContentType and object ID as a tree.
+
+    Each item has two attributes, 'comment', with the comment as in
+    CommentList, and 'children', with the items of its replies.
+    """
+    pagination_class = None
+
+    def list(self, request, *args, **kwargs):
+        # All the comments are serialized at once, sharing the flags
+        # prefetched and the context, and placed in the tree afterwards.
+        serializer = self.get_serializer(self.get_queryset(), many=True)
+        return Response(tree_from_serialized(serializer.data))
+
 
 class CommentCount(generics.GenericAPIView):
     """Get number of comments posted to a given ContentType and object ID."""
     serializer_class = serializers.ReadCommentSerializer
 
-    def get_queryset(self):
+    @method_decorator(cache_control(private=True, no_cache=True))
+    @method_decorator(condition(etag_func=comment_count_etag))
+    def get(self, request, *args, **kwargs):
         content_type_arg = self.kwargs.get('content_type', None)
-        object_pk_arg = self.kwargs.get('object_pk', None)
         app_label, model = content_type_arg.split("-")
         content_type = ContentType.objects.get_by_natural_key(app_label, model)
-        qs = XtdComment.objects.filter(content_type=content_type,
-                                       object_pk=int(object_pk_arg),
-                                       is_public=True)
-        return qs
+        pair = (content_type.pk, self.kwargs.get('object_pk', None))
+        return Response({'count': get_comment_counts([pair])[pair]})
+
+
+class CommentCounts(generics.GenericAPIView):
+    """
+    Get number of comments posted to each of the objects of a given
+    ContentType whose IDs are given, comma separated, in the 'pks' argument.
+    """
+    serializer_class = serializers.ReadCommentSerializer
 
     def get(self, request, *args, **kwargs):
-        return Response({'count': self.get_queryset().count()})
+        content_type_arg = self.kwargs.get('content_type', None)
+        app_label, model = content_type_arg.split("-")
+        pks = [pk for pk in request.query_params.get('pks', '').split(',')
+               if pk]
+        try:
+            content_type = ContentType.objects.get_by_natural_key(app_label,
+                                                                  model)
+        except ContentType.DoesNotExist:
+            return Response(dict.fromkeys(pks, 0))
+        counts = get_comment_counts([(content_type.pk, pk) for pk in pks])
+        return Response(dict((pk, counts[(content_type.pk, pk)])
+                             for pk in pks))
 
 
 class ToggleFeedbackFlag(generics.CreateAPIView, mixins.DestroyModelMixin):
@@ -93,78 +299,3 @@ class CreateReportFlag(generics.CreateAPIView):
 
     def perform_create(self, serializer):
         perform_flag(self.request, serializer.validated_data['comment'])
-
-class ApiCommentsView(APIView):
-
-    def get(self, request, *args, **kwargs):
-        context = {}
-        content_type_arg = self.kwargs.get('content_type', None)
-        object_pk_arg = self.kwargs.get('object_pk', None)
-        qs = XtdComment.objects.filter(content_type__pk=13,
-                                           object_pk=int(object_pk_arg),
-                                           is_public=True)
-        comments = tree_from_queryset(request, qs, True, True, self.request.user)
-        context['comments'] = comments
-
-        return Response(context)
-
-def tree_from_queryset(request, qs, with_flagging=False,
-                       with_feedback=False, user=None):
-
-    """Converts a XtdComment queryset into a list of nested dictionaries.
-    The queryset has to be ordered by thread_id, order.
-    Each dictionary contains two attributes::
-        {
-            'comment': the comment object itself,
-            'children': [list of child comment dictionaries]
-        }
-    """
-    def get_user_feedback(comment, user):
-        d = {'likedit_users': comment.users_flagging("I liked it"),
-             'dislikedit_users': comment.users_flagging("I disliked it")}
-        if user is not None:
-            if user in d['likedit_users']:
-                d['likedit'] = True
-            if user in d['dislikedit_users']:
-                d['dislikedit'] = True
-        return d
-
-    def add_children(children, obj, user):
-        for item in children:
-            if item['comment']['id'] == obj.parent_id:
-                obj_api = serializers.ReadCommentSerializer(obj, context={'request': request}).data
-                child_dict = {'comment': obj_api, 'children': []}
-                item['children'].append(child_dict)
-                return True
-            elif item['children']:
-                if add_children(item['children'], obj, user):
-                    return True
-        return False
-
-    def get_new_dict(obj):
-        obj_api = serializers.ReadCommentSerializer(obj, context={'request': request}).data
-        new_dict = {'comment': obj_api, 'children': []}
-        if with_flagging:
-            users_flagging = obj.users_flagging("removal suggestion")
-            if user.has_perm('django_comments.can_moderate'):
-                new_dict.update({'flagged_count': len(users_flagging)})
-            new_dict.update({'flagged': user in users_flagging})
-        return new_dict
-
-    dic_list = []
-    cur_dict = None
-    for obj in qs:
-        if cur_dict and obj.level == cur_dict['comment']['level']:
-            dic_list.append(cur_dict)
-            cur_dict = None
-        if not cur_dict:
-            cur_dict = get_new_dict(obj)
-            continue
-        if obj.parent_id == cur_dict['comment']['id']:
-            child_dict = get_new_dict(obj)
-            cur_dict['children'].append(child_dict)
-        else:
-            add_children(cur_dict['children'], obj, user)
-    if cur_dict:
-        dic_list.append(cur_dict)
-    return dic_list
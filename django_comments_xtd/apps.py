@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class CommentsXtdConfig(AppConfig):
     name = 'django_comments_xtd'
     verbose_name = 'Comments Xtd'
+
+    def ready(self):
+        from django_comments_xtd import get_model
+        from django_comments_xtd.models import (XtdComment,
+                                                connect_comment_model_signals)
+        # Comments are created as XtdComment by the views too.
+        for model in set([XtdComment, get_model()]):
+            connect_comment_model_signals(model)
@@ -0,0 +1,98 @@
+"""
+Cache helpers.
+
+Each object that receives comments has a version in the cache, that
+changes whenever a comment posted to the object, or a flag given to one of
+those comments, changes. Data derived from the comments of an object is
+cached under keys that include its version, so that it all becomes stale
+at once, no matter how many variants of it have been cached.
+"""
+import hashlib
+import time
+
+from django.core.cache import caches
+from django.utils.encoding import force_bytes
+
+from django_comments_xtd.conf import settings
+
+
+def get_cache():
+    return caches[settings.COMMENTS_XTD_CACHE_ALIAS]
+
+
+def make_key(prefix, *parts):
+    digest = hashlib.md5(force_bytes(":".join(
+        "%s" % part for part in parts))).hexdigest()
+    return "django_comments_xtd:%s:%s" % (prefix, digest)
+
+
+def version_key(ctype_id, object_pk):
+    return make_key("version", ctype_id, object_pk)
+
+
+def new_version():
+    return "%.6f" % time.time()
+
+
+def get_versions(pairs):
+    """
+    Return a dictionary with the version of each (ctype_id, object_pk) pair.
+    Objects without a version in the cache get a new one.
+    """
+    cache = get_cache()
+    keys = dict((version_key(*pair), pair) for pair in pairs)
+    versions = cache.get_many(keys.keys())
+    missing = {}
+    for key in keys:
+        if key not in versions:
+            missing[key] = versions[key] = new_version()
+    if missing:
+        cache.set_many(missing, None)
+    return dict((keys[key], version) for key, version in versions.items())
+
+
+def get_version(ctype_id, object_pk):
+    return get_versions([(ctype_id, object_pk)])[(ctype_id, object_pk)]
+
+
+def bump_version(ctype_id, object_pk):
+    """
+    Invalidate everything cached about the comments to the object.
+    Returns the new version.
+    """
+    version = new_version()
+    get_cache().set(version_key(ctype_id, object_pk), version, None)
+    return version
+
+
+def blacklist_version_key():
+    return make_key("version", "blacklist")
+
+
+def get_blacklist_version():
+    """Return the version of the BlackListedDomain table."""
+    cache = get_cache()
+    version = cache.get(blacklist_version_key())
+    if version is None:
+        version = new_version()
+        cache.add(blacklist_version_key(), version, None)
+        version = cache.get(blacklist_version_key(), version)
+    return version
+
+
+def bump_blacklist_version():
+    """Tell the processes that the BlackListedDomain table has changed."""
+    get_cache().set(blacklist_version_key(), new_version(), None)
+
+
+def tree_key(ctype_id, object_pk, version, *variant):
+    return make_key("tree", ctype_id, object_pk, version, *variant)
+
+
+def count_key(ctype_id, object_pk, version, site_id):
+    return make_key("count", ctype_id, object_pk, version, site_id)
+
+
+def make_etag(*parts):
+    return hashlib.md5(force_bytes(":".join(
+        "%s" % part for part in parts))).hexdigest()
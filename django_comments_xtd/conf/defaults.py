@@ -7,6 +7,10 @@ COMMENT_MAX_LENGTH = 3000
 # Extra key to salt the XtdCommentForm.
 COMMENTS_XTD_SALT = b""
 
+# Accept confirmation and mute keys made by previous versions, that carry
+# a pickled comment. Set it to False once those sent have expired.
+COMMENTS_XTD_ACCEPT_PICKLED_KEYS = True
+
 # Whether comment posts should be confirmed by email.
 COMMENTS_XTD_CONFIRM_EMAIL = True
 
@@ -25,6 +29,51 @@ COMMENTS_XTD_MAX_THREAD_LEVEL_BY_APP_MODEL = {}
 # Default order to list comments in.
 COMMENTS_XTD_LIST_ORDER = ('thread_id', 'order')
 
+# How to keep comments in thread order when a reply is posted:
+#  * 'order': renumber the 'order' field of the comments below the reply.
+#  * 'path': only the reply is written, comments sort by 'thread_path'.
+#    Use it along with COMMENTS_XTD_LIST_ORDER = ('thread_id', 'thread_path').
+COMMENTS_XTD_THREAD_ORDERING = 'order'
+
+# Alias of the cache, in the CACHES setting, used by django-comments-xtd.
+COMMENTS_XTD_CACHE_ALIAS = 'default'
+
+# Seconds to cache the output of the render_xtdcomment_tree tag for.
+# The cache is invalidated whenever the comments to the object change.
+# Set it to 0 to disable the cache.
+COMMENTS_XTD_TREE_CACHE_TIMEOUT = 0
+
+# Levels of replies, and replies to each comment, the render_xtdcomment_tree
+# tag renders at first. The rest are rendered on demand, by the view named
+# comments-xtd-replies. Set them to 0 to render the whole tree.
+COMMENTS_XTD_TREE_DEPTH = 0
+COMMENTS_XTD_TREE_MAX_REPLIES = 0
+
+# Seconds to cache the number of comments posted to an object for.
+# Set it to 0 to disable the cache.
+COMMENTS_XTD_COUNT_CACHE_TIMEOUT = 0
+
+# Whether the CommentBox component receives new comments through a
+# stream of Server-Sent Events, instead of polling for them.
+COMMENTS_XTD_LIVE_UPDATES = False
+
+# Class of the broker delivering events to the live updates streams.
+COMMENTS_XTD_EVENT_BROKER = "django_comments_xtd.events.InProcessEventBroker"
+
+# Seconds a live updates stream stays open before the browser reconnects.
+COMMENTS_XTD_EVENT_STREAM_TIMEOUT = 30
+
+# Number of threads listed by each page of the comment list API view,
+# along with up to COMMENTS_XTD_API_REPLIES_PER_PAGE replies each. The rest
+# of the replies of a thread are listed, as many at a time, by requesting
+# the cursor given for it. Set it to 0 to list all the comments at once.
+COMMENTS_XTD_API_THREADS_PER_PAGE = 0
+COMMENTS_XTD_API_REPLIES_PER_PAGE = 20
+
+# Whether the comment list API view encodes the comments in JSON as they
+# are read from the database, instead of once all of them have been read.
+COMMENTS_XTD_API_STREAMING = False
+
 # Form class to use.
 COMMENTS_XTD_FORM_CLASS = "django_comments_xtd.forms.XtdCommentForm"
 
@@ -39,6 +88,28 @@ COMMENTS_XTD_SEND_HTML_EMAIL = True
 # your own celery app.
 COMMENTS_XTD_THREADED_EMAILS = True
 
+# Number of threads sending emails when COMMENTS_XTD_THREADED_EMAILS is True.
+COMMENTS_XTD_MAIL_WORKERS = 2
+
+# Maximum number of emails waiting for a thread to send them. When the
+# queue is full emails wait up to COMMENTS_XTD_MAIL_QUEUE_TIMEOUT seconds
+# to get in, and are sent by the thread handling the request afterwards.
+COMMENTS_XTD_MAIL_QUEUE_SIZE = 1000
+COMMENTS_XTD_MAIL_QUEUE_TIMEOUT = 5
+
+# Maximum number of groups of emails sent through the same connection.
+COMMENTS_XTD_MAIL_BATCH_SIZE = 50
+
+# Number of emails sent at once when notifying many followers, and times
+# to retry sending them when it fails.
+COMMENTS_XTD_MAIL_CHUNK_SIZE = 100
+COMMENTS_XTD_MAIL_CHUNK_RETRIES = 2
+
+# Write follow-up notifications down in the database, instead of sending
+# them while handling the request that publishes the comment. Run the
+# management command send_followup_notifications to send them.
+COMMENTS_XTD_NOTIFICATION_OUTBOX = False
+
 # Define what commenting features a pair app_label.model can have.
 # TODO: Put django-comments-xtd settings under a dictionary, and merge
 #       COMMENTS_XTD_MAX_THREAD_LEVEL_BY_APP_MODEL with this one.
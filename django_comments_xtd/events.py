@@ -0,0 +1,130 @@
+"""
+Live updates of the comments posted to an object.
+
+Every change to the comments of an object publishes an event in the
+object's channel. Event brokers deliver them to the streams opened by the
+browsers displaying the object. The default broker,
+InProcessEventBroker, works within a single process. Deployments running
+several processes need a broker with a shared backend, implementing
+BaseEventBroker.
+"""
+import collections
+import json
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+from django_comments_xtd.conf import settings
+
+
+# Seconds between keep-alive messages sent to idle event streams.
+KEEPALIVE_INTERVAL = 15
+
+# Seconds browsers wait to reconnect once a stream is closed.
+RETRY_INTERVAL = 3
+
+
+class BaseEventBroker(object):
+    """Interface of the classes that deliver comment events."""
+
+    def publish(self, channel, name, data):
+        """Publish an event with the given name and JSON data."""
+        raise NotImplementedError
+
+    def last_event_id(self, channel):
+        """Return the ID of the last event published to the channel."""
+        raise NotImplementedError
+
+    def wait(self, channel, last_event_id, timeout):
+        """
+        Return a list of (id, name, data) tuples with the events published
+        to the channel after the one with ID last_event_id, waiting up to
+        timeout seconds for one to arrive.
+        """
+        raise NotImplementedError
+
+
+class InProcessEventBroker(BaseEventBroker):
+    """
+    Keep the last events published in memory, shared by all the threads
+    of the process.
+    """
+
+    def __init__(self, max_events=1000):
+        self._condition = threading.Condition()
+        self._events = collections.deque(maxlen=max_events)
+        # Start counting from the current time, so that IDs received
+        # from browsers before a restart are not ahead of the new ones.
+        self._last_id = int(time.time() * 1000)
+
+    def publish(self, channel, name, data):
+        with self._condition:
+            self._last_id += 1
+            self._events.append((self._last_id, channel, name, data))
+            self._condition.notify_all()
+
+    def last_event_id(self, channel):
+        with self._condition:
+            return self._last_id
+
+    def _events_after(self, channel, last_event_id):
+        return [(event_id, name, data)
+                for event_id, event_channel, name, data in self._events
+                if event_id > last_event_id and event_channel == channel]
+
+    def wait(self, channel, last_event_id, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                events = self._events_after(channel, last_event_id)
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                self._condition.wait(remaining)
+
+
+_brokers = {}
+
+
+def get_event_broker():
+    """Return the broker in use, or None when live updates are disabled."""
+    if not settings.COMMENTS_XTD_LIVE_UPDATES:
+        return None
+    path = settings.COMMENTS_XTD_EVENT_BROKER
+    if path not in _brokers:
+        _brokers[path] = import_string(path)()
+    return _brokers[path]
+
+
+def event_channel(ctype_id, object_pk):
+    return "%s:%s" % (ctype_id, object_pk)
+
+
+def publish_update(ctype_id, object_pk, version):
+    """Tell the streams of the object that its comments have changed."""
+    broker = get_event_broker()
+    if broker is not None:
+        broker.publish(event_channel(ctype_id, object_pk), "update",
+                       {"version": version})
+
+
+def stream_events(broker, channel, last_event_id, timeout):
+    """
+    Generate the Server-Sent Events published to the channel after
+    last_event_id, during timeout seconds. Browsers reconnect afterwards.
+    """
+    yield "retry: %d\n\n" % (RETRY_INTERVAL * 1000)
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        events = broker.wait(channel, last_event_id,
+                             min(remaining, KEEPALIVE_INTERVAL))
+        if not events:
+            yield ":\n\n"
+        for event_id, name, data in events:
+            last_event_id = event_id
+            yield "id: %s\nevent: %s\ndata: %s\n\n" % (
+                event_id, name, json.dumps(data))
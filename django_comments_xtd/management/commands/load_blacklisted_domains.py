@@ -0,0 +1,140 @@
+import io
+import re
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from django_comments_xtd.cache import bump_blacklist_version
+from django_comments_xtd.models import BlackListedDomain
+
+
+__all__ = ['Command']
+
+
+# Rows inserted, or deleted, by each query.
+BATCH_SIZE = 500
+
+DOMAIN_MAX_LENGTH = BlackListedDomain._meta.get_field('domain').max_length
+
+DOMAIN_RE = re.compile(r'^[a-z0-9_-]+(\.[a-z0-9_-]+)*$')
+
+
+def normalize_domain(line):
+    """
+    Return the domain in the line of a blacklist, lower cased and IDNA
+    encoded, or None if the line is blank, a comment, or not a domain.
+    Email addresses count as their domain.
+    """
+    line = line.split('#', 1)[0].strip()
+    domain = line.rsplit('@', 1)[-1].strip('.').lower()
+    if not domain:
+        return None
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        return None
+    if len(domain) > DOMAIN_MAX_LENGTH or not DOMAIN_RE.match(domain):
+        return None
+    return domain
+
+
+def read_domains(lines, stats):
+    """Return the set of domains in lines, counting them in stats."""
+    domains = set()
+    for line in lines:
+        stats['lines'] += 1
+        domain = normalize_domain(line)
+        if domain is None:
+            if line.strip() and not line.lstrip().startswith('#'):
+                stats['invalid'] += 1
+            continue
+        domains.add(domain)
+    return domains
+
+
+def chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+class Command(BaseCommand):
+    help = ("Add to the blacklisted domains those listed in the given "
+            "files, one per line, like the blacklist of joewein.net. Domains "
+            "not listed are deleted only with --delete. Use '-' to read "
+            "from the standard input.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', type=str)
+        parser.add_argument('--delete', action='store_true',
+                            help="Delete the domains that are not listed, "
+                                 "including those added in the admin.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report the changes without applying them.")
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        started = time.time()
+        stats = {'lines': 0, 'invalid': 0}
+        listed = set()
+        for path in options['files']:
+            if path == '-':
+                lines = sys.stdin
+            else:
+                lines = io.open(path, encoding='utf-8', errors='replace')
+            try:
+                listed |= read_domains(lines, stats)
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+        if options['delete'] and not listed:
+            raise CommandError("No domains listed, refusing to delete all "
+                               "the blacklisted domains.")
+
+        # Rows to delete: duplicates, and those not listed with --delete.
+        existing = set()
+        stale_pks = []
+        rows = BlackListedDomain.objects.using(using)\
+                                        .order_by()\
+                                        .values_list('pk', 'domain')
+        for pk, domain in rows.iterator():
+            if domain in existing or (domain not in listed and
+                                      options['delete']):
+                stale_pks.append(pk)
+            existing.add(domain)
+        added = listed - existing
+
+        if not options['dry_run']:
+            with transaction.atomic(using=using):
+                BlackListedDomain.objects.using(using).bulk_create(
+                    [BlackListedDomain(domain=domain)
+                     for domain in sorted(added)],
+                    batch_size=BATCH_SIZE)
+                self.delete_rows(using, stale_pks)
+            # Neither bulk_create nor delete_rows send signals.
+            bump_blacklist_version()
+
+        elapsed = max(time.time() - started, 1e-6)
+        print("Read %d line(s), %d domain(s), %d invalid line(s)." % (
+            stats['lines'], len(listed), stats['invalid']))
+        print("%d domain(s) added, %d row(s) deleted, %d domain(s) "
+              "unchanged%s." % (len(added), len(stale_pks),
+                                len(existing & listed),
+                                " (dry run)" if options['dry_run'] else ""))
+        print("Took %.2f seconds, %d line(s) per second." % (
+            elapsed, stats['lines'] / elapsed))
+
+    def delete_rows(self, using, pks):
+        # Deleted with plain SQL, as QuerySet.delete() would fetch every
+        # row to send the post_delete signal for it.
+        connection = connections[using]
+        opts = BlackListedDomain._meta
+        table = connection.ops.quote_name(opts.db_table)
+        column = connection.ops.quote_name(opts.pk.column)
+        with connection.cursor() as cursor:
+            for chunk in chunks(pks, BATCH_SIZE):
+                cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                    table, column, ", ".join(["%s"] * len(chunk))), chunk)
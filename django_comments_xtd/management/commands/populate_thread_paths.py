@@ -0,0 +1,26 @@
+from django.db.utils import ConnectionDoesNotExist
+from django.core.management.base import BaseCommand
+
+from django_comments_xtd.models import rebuild_thread_paths
+
+
+__all__ = ['Command']
+
+
+class Command(BaseCommand):
+    help = ("Calculate the thread_path of existing XtdComments, required "
+            "to use COMMENTS_XTD_THREAD_ORDERING = 'path'.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('using', nargs='*', type=str)
+
+    def handle(self, *args, **options):
+        using = options['using'] or ['default']
+        for db_conn in using:
+            try:
+                total = rebuild_thread_paths(using=db_conn)
+            except ConnectionDoesNotExist:
+                print("DB connection '%s' does not exist." % db_conn)
+                continue
+            print("Updated thread_path of %d XtdComment object(s) in '%s'."
+                  % (total, db_conn))
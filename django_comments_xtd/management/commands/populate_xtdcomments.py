@@ -6,7 +6,8 @@ from django.core.management.base import BaseCommand
 
 from django_comments.models import Comment
 
-from django_comments_xtd.models import XtdComment
+from django_comments_xtd.models import (XtdComment, rebuild_flag_counters,
+                                        thread_path_segment)
 
 
 __all__ = ['Command']
@@ -22,10 +23,15 @@ class Command(BaseCommand):
         for comment in Comment.objects.all():
             sql = ("INSERT INTO %(table)s "
                    "       ('comment_ptr_id', 'thread_id', 'parent_id',"
-                   "        'level', 'order', 'followup') "
-                   "VALUES (%(id)d, %(id)d, %(id)d, 0, 1, 0)")
+                   "        'level', 'order', 'followup', 'likedit_count',"
+                   "        'dislikedit_count', 'flagged_count',"
+                   "        'thread_path', 'modified') "
+                   "VALUES (%(id)d, %(id)d, %(id)d, 0, 1, 0, 0, 0, 0,"
+                   "        '%(path)s', %%s)")
             cursor.execute(sql % {'table': XtdComment._meta.db_table,
-                                  'id': comment.id})
+                                  'id': comment.id,
+                                  'path': thread_path_segment(comment.id)},
+                           [comment.submit_date])
 
     def handle(self, *args, **options):
         total = 0
@@ -33,6 +39,7 @@ class Command(BaseCommand):
         for db_conn in using:
             try:
                 self.populate_db(connections[db_conn].cursor())
+                rebuild_flag_counters(using=db_conn)
                 total += XtdComment.objects.using(db_conn).count()
             except ConnectionDoesNotExist:
                 print("DB connection '%s' does not exist." % db_conn)
@@ -0,0 +1,26 @@
+from django.db.utils import ConnectionDoesNotExist
+from django.core.management.base import BaseCommand
+
+from django_comments_xtd.models import rebuild_flag_counters
+
+
+__all__ = ['Command']
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the like, dislike and removal suggestion counters "
+            "of XtdComments from the comment flags.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('using', nargs='*', type=str)
+
+    def handle(self, *args, **options):
+        using = options['using'] or ['default']
+        for db_conn in using:
+            try:
+                total = rebuild_flag_counters(using=db_conn)
+            except ConnectionDoesNotExist:
+                print("DB connection '%s' does not exist." % db_conn)
+                continue
+            print("Rebuilt counters of %d flagged XtdComment object(s) "
+                  "in '%s'." % (total, db_conn))
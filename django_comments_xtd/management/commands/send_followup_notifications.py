@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_comments_xtd.views import send_followup_notifications
+
+
+__all__ = ['Command']
+
+
+class Command(BaseCommand):
+    help = ("Send the follow-up notifications written down in the outbox "
+            "when COMMENTS_XTD_NOTIFICATION_OUTBOX is True.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Notifications claimed at once.")
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help="Times a notification is tried before "
+                                 "leaving it in the outbox.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep sending notifications as they arrive.")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds to wait for new notifications "
+                                 "when the outbox is empty, with --loop.")
+
+    def handle(self, *args, **options):
+        total_sent, total_failed = 0, 0
+        while True:
+            sent, failed = send_followup_notifications(
+                batch_size=options['batch_size'],
+                max_attempts=options['max_attempts'])
+            total_sent += sent
+            total_failed += failed
+            if sent + failed < options['batch_size']:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        print("Sent %d notification(s), %d failed." % (total_sent,
+                                                       total_failed))
@@ -0,0 +1,201 @@
+import re
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+from django.utils import timezone
+
+from django_comments.models import Comment
+
+from django_comments_xtd.models import XtdComment, FollowupSubscription
+
+
+__all__ = ['Command']
+
+
+# Indexes created by the migrations of django_comments_xtd, as the table
+# and the columns they index. The names of the indexes in index_together
+# are generated by Django, they are looked up by their columns.
+OBJECT_INDEX = (Comment._meta.db_table,
+                ('content_type_id', 'object_pk', 'site_id', 'is_public'))
+THREAD_ORDER_INDEX = (XtdComment._meta.db_table, ('thread_id', 'order'))
+THREAD_LEVEL_INDEX = (XtdComment._meta.db_table,
+                      ('thread_id', 'level', 'order'))
+
+
+def find_index(constraints, columns):
+    """Return the name of the index on exactly the given columns."""
+    for name, constraint in constraints.items():
+        if constraint['index'] and tuple(constraint['columns']) == columns:
+            return name
+    return None
+
+
+def get_query_shapes(ctype, object_pk, site_id):
+    """
+    Return a list of (name, queryset, indexes) with the queries
+    django-comments-xtd runs most often, or on the largest number of rows,
+    and the indexes, as (table, columns), they are expected to use.
+    """
+    comments = XtdComment.objects.filter(content_type=ctype,
+                                         object_pk=object_pk,
+                                         site__pk=site_id)
+    return [
+        ("comment list",
+         comments.filter(is_public=True).order_by('thread_id', 'order'),
+         [OBJECT_INDEX]),
+        ("comment list delta",
+         comments.filter(is_public=True, modified__gte=timezone.now()),
+         [OBJECT_INDEX]),
+        ("comment counts",
+         comments.filter(is_public=True).values_list('object_pk')
+                 .annotate(count=Count('pk')).order_by(),
+         [OBJECT_INDEX]),
+        ("thread renumbering",
+         XtdComment.objects.filter(thread_id=1, level__lte=0, order__gt=1)
+                           .order_by(),
+         [THREAD_LEVEL_INDEX, THREAD_ORDER_INDEX]),
+        ("thread reordering",
+         XtdComment.objects.filter(thread_id=1, order__gte=1).order_by(),
+         [THREAD_ORDER_INDEX]),
+        ("followers",
+         FollowupSubscription.objects.filter(content_type=ctype,
+                                             object_pk=object_pk),
+         []),
+        ("follower comments",
+         XtdComment.objects.filter(content_type=ctype, object_pk=object_pk,
+                                   user_email="bob@example.com",
+                                   is_public=True, followup=True)
+                           .order_by('-pk'),
+         [OBJECT_INDEX]),
+        ("confirmed comment",
+         XtdComment.objects.filter(confirmation_digest="0" * 64),
+         []),
+    ]
+
+
+SQLITE_SEARCH = re.compile(r'^SEARCH (?:TABLE )?(\w+)(?: AS \w+)? USING '
+                           r'(?:(?:COVERING )?INDEX (\w+)|'
+                           r'(INTEGER PRIMARY KEY))')
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+PG_SEQ_SCAN = re.compile(r'Seq Scan on (\w+)')
+PG_INDEX_SCAN = re.compile(r'Index (?:Only )?Scan(?: Backward)? using (\w+) '
+                           r'on (\w+)')
+PG_BITMAP_HEAP_SCAN = re.compile(r'Bitmap Heap Scan on (\w+)')
+PG_BITMAP_INDEX_SCAN = re.compile(r'Bitmap Index Scan on (\w+)')
+
+
+def explain_sqlite(cursor, sql, params):
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    accesses = []
+    for row in cursor.fetchall():
+        detail = row[-1]
+        match = SQLITE_SEARCH.match(detail)
+        if match:
+            accesses.append((match.group(1),
+                             match.group(2) or "primary key"))
+            continue
+        match = SQLITE_SCAN.match(detail)
+        if match:
+            accesses.append((match.group(1), None))
+    return accesses
+
+
+def explain_postgresql(cursor, sql, params):
+    cursor.execute("EXPLAIN " + sql, params)
+    accesses = []
+    bitmap_table = None
+    for row in cursor.fetchall():
+        line = row[0]
+        match = PG_SEQ_SCAN.search(line)
+        if match:
+            accesses.append((match.group(1), None))
+            continue
+        match = PG_INDEX_SCAN.search(line)
+        if match:
+            accesses.append((match.group(2), match.group(1)))
+            continue
+        match = PG_BITMAP_HEAP_SCAN.search(line)
+        if match:
+            bitmap_table = match.group(1)
+            continue
+        match = PG_BITMAP_INDEX_SCAN.search(line)
+        if match:
+            accesses.append((bitmap_table, match.group(1)))
+    return accesses
+
+
+EXPLAIN = {
+    'sqlite': explain_sqlite,
+    'postgresql': explain_postgresql,
+}
+
+
+class Command(BaseCommand):
+    help = ("Run EXPLAIN on the queries django-comments-xtd runs most "
+            "often, and report the indexes they use and the tables they "
+            "scan fully. Supports SQLite and PostgreSQL.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default',
+                            help="DB connection to report on.")
+        parser.add_argument('--no-seqscan', action='store_true',
+                            help="Discourage sequential scans in "
+                                 "PostgreSQL, to tell whether an index can "
+                                 "be used on tables too small for the "
+                                 "planner to prefer it.")
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        try:
+            explain = EXPLAIN[connection.vendor]
+        except KeyError:
+            raise CommandError("Database vendor '%s' is not supported."
+                               % connection.vendor)
+        ctype = ContentType.objects.db_manager(options['database'])\
+                                   .get_for_model(XtdComment)
+        tables = set([Comment._meta.db_table, XtdComment._meta.db_table,
+                      FollowupSubscription._meta.db_table])
+        warnings = 0
+        with connection.cursor() as cursor:
+            indexes = {}
+            for table in tables:
+                indexes[table] = connection.introspection.get_constraints(
+                    cursor, table)
+            names = {}
+            for table, columns in (OBJECT_INDEX, THREAD_ORDER_INDEX,
+                                   THREAD_LEVEL_INDEX):
+                names[(table, columns)] = find_index(indexes[table], columns)
+                if names[(table, columns)] is None:
+                    warnings += 1
+                    self.stdout.write("WARNING, index on %s (%s) is missing."
+                                      % (table, ", ".join(columns)))
+            if options['no_seqscan'] and connection.vendor == 'postgresql':
+                cursor.execute("SET enable_seqscan = off")
+            for name, queryset, expected in get_query_shapes(ctype, "1", 1):
+                sql, params = queryset.using(options['database'])\
+                                      .query.sql_with_params()
+                self.stdout.write(name)
+                for table, index in explain(cursor, sql, params):
+                    if table not in tables:
+                        continue
+                    if not index:
+                        warnings += 1
+                        self.stdout.write("    %s: WARNING, full scan"
+                                          % table)
+                    elif expected and table == expected[0][0] and \
+                            index not in [names[e] for e in expected]:
+                        warnings += 1
+                        self.stdout.write(
+                            "    %s: %s, WARNING, index on (%s) expected"
+                            % (table, index, ", ".join(expected[0][1])))
+                    else:
+                        self.stdout.write("    %s: %s" % (table, index))
+            if options['no_seqscan'] and connection.vendor == 'postgresql':
+                cursor.execute("SET enable_seqscan = on")
+        if warnings:
+            self.stdout.write("%d warning(s). Check that all the migrations "
+                              "of django_comments_xtd are applied." % warnings)
+        else:
+            self.stdout.write("All the queries use the expected indexes.")
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+FLAG_COUNTERS = {
+    "I liked it": 'likedit_count',
+    "I disliked it": 'dislikedit_count',
+    "removal suggestion": 'flagged_count',
+}
+
+
+def populate_flag_counters(apps, schema_editor):
+    XtdComment = apps.get_model('django_comments_xtd', 'XtdComment')
+    CommentFlag = apps.get_model('django_comments', 'CommentFlag')
+    db_alias = schema_editor.connection.alias
+    rows = CommentFlag.objects.using(db_alias)\
+                              .filter(flag__in=FLAG_COUNTERS)\
+                              .values('comment_id', 'flag')\
+                              .annotate(count=Count('pk'))\
+                              .order_by()
+    for row in rows:
+        XtdComment.objects.using(db_alias)\
+                          .filter(pk=row['comment_id'])\
+                          .update(**{FLAG_COUNTERS[row['flag']]: row['count']})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_xtd', '0004_auto_20170221_1510'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xtdcomment',
+            name='dislikedit_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='xtdcomment',
+            name='flagged_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='xtdcomment',
+            name='likedit_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_flag_counters,
+                             migrations.RunPython.noop),
+    ]
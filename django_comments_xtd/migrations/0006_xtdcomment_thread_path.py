@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def thread_path_segment(comment_id):
+    # Same as django_comments_xtd.models.thread_path_segment.
+    return "%010d" % comment_id
+
+
+def populate_thread_paths(apps, schema_editor):
+    # Same as django_comments_xtd.models.rebuild_thread_paths, for the
+    # comments posted before the field existed.
+    XtdComment = apps.get_model('django_comments_xtd', 'XtdComment')
+    db_alias = schema_editor.connection.alias
+    comments = XtdComment.objects.using(db_alias)
+    paths = {}
+    # Replies always have a greater id than their parent.
+    rows = comments.order_by('thread_id', 'pk')\
+                   .values_list('pk', 'parent_id', 'thread_id')
+    for pk, parent_id, thread_id in rows.iterator():
+        if pk == parent_id:
+            path = thread_path_segment(pk)
+        else:
+            parent_path = paths.get(parent_id,
+                                    paths.get(thread_id,
+                                              thread_path_segment(thread_id)))
+            path = parent_path + thread_path_segment(pk)
+        paths[pk] = path
+        comments.filter(pk=pk).update(thread_path=path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_xtd', '0005_xtdcomment_flag_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xtdcomment',
+            name='thread_path',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(populate_thread_paths,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_xtd', '0006_xtdcomment_thread_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xtdcomment',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_xtd', '0007_xtdcomment_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FollowupNotification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('claimed_until', models.DateTimeField(blank=True, null=True)),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='followup_notifications', to='django_comments_xtd.XtdComment')),
+            ],
+            options={
+                'ordering': ('created',),
+            },
+        ),
+    ]
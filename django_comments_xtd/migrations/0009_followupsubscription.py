@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def populate_followup_subscriptions(apps, schema_editor):
+    XtdComment = apps.get_model('django_comments_xtd', 'XtdComment')
+    FollowupSubscription = apps.get_model('django_comments_xtd',
+                                          'FollowupSubscription')
+    db_alias = schema_editor.connection.alias
+    rows = XtdComment.objects.using(db_alias)\
+                             .filter(is_public=True, followup=True)\
+                             .exclude(user_email='')\
+                             .order_by('pk')\
+                             .values_list('pk', 'content_type_id',
+                                          'object_pk', 'user_email',
+                                          'user_name', 'submit_date')
+    subscriptions = {}
+    for pk, ctype_id, object_pk, email, name, submit_date in rows.iterator():
+        key = (ctype_id, object_pk, email)
+        if key in subscriptions:
+            # Keep the date of the first comment, and the last comment.
+            subscriptions[key].user_name = name
+            subscriptions[key].comment_id = pk
+        else:
+            subscriptions[key] = FollowupSubscription(
+                content_type_id=ctype_id, object_pk=object_pk,
+                user_email=email, user_name=name, comment_id=pk,
+                created=submit_date)
+    FollowupSubscription.objects.using(db_alias)\
+                                .bulk_create(subscriptions.values(),
+                                             batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('django_comments_xtd', '0008_followupnotification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FollowupSubscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_pk', models.CharField(max_length=255)),
+                ('user_email', models.EmailField(max_length=254)),
+                ('user_name', models.CharField(blank=True, max_length=50)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='django_comments_xtd.XtdComment')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='followupsubscription',
+            unique_together=set([('content_type', 'object_pk', 'user_email')]),
+        ),
+        migrations.RunPython(populate_followup_subscriptions,
+                             migrations.RunPython.noop),
+    ]
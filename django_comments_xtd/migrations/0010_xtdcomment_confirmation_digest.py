@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+
+def confirmation_digest(ctype_id, object_pk, user_name, user_email, followup,
+                        submit_date):
+    # Same as django_comments_xtd.models.confirmation_digest.
+    if timezone.is_aware(submit_date):
+        submit_date = timezone.make_naive(submit_date, timezone.utc)
+    fields = [ctype_id, object_pk, user_name, user_email, int(bool(followup)),
+              submit_date.isoformat()]
+    value = "\x00".join(force_text(field) for field in fields)
+    return hashlib.sha256(value.encode('utf8')).hexdigest()
+
+
+def populate_confirmation_digests(apps, schema_editor):
+    XtdComment = apps.get_model('django_comments_xtd', 'XtdComment')
+    db_alias = schema_editor.connection.alias
+    rows = XtdComment.objects.using(db_alias)\
+                             .order_by('pk')\
+                             .values_list('pk', 'content_type_id',
+                                          'object_pk', 'user_name',
+                                          'user_email', 'followup',
+                                          'submit_date')
+    digests = set()
+    for row in rows.iterator():
+        digest = confirmation_digest(*row[1:])
+        if digest in digests:  # Duplicated comment, keep the first one.
+            continue
+        digests.add(digest)
+        XtdComment.objects.using(db_alias)\
+                          .filter(pk=row[0])\
+                          .update(confirmation_digest=digest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_xtd', '0009_followupsubscription'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xtdcomment',
+            name='confirmation_digest',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(populate_confirmation_digests,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Composite index on the columns of django_comments that the comments of an
+# object are looked up by. It's not part of the models, as the table belongs
+# to django_comments.
+COMMENT_INDEX_NAME = 'django_comments_xtd_object_idx'
+COMMENT_INDEX_COLUMNS = ('content_type_id', 'object_pk', 'site_id',
+                         'is_public')
+
+
+def create_comment_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in ('sqlite', 'postgresql', 'mysql'):
+        return  # Oracle can't index object_pk, a NCLOB.
+    Comment = apps.get_model('django_comments', 'Comment')
+    qn = schema_editor.quote_name
+    columns = [qn(column) for column in COMMENT_INDEX_COLUMNS]
+    if vendor == 'mysql':
+        # object_pk is a longtext, only its prefix can be indexed.
+        columns[1] += '(64)'
+    schema_editor.execute("CREATE INDEX %s ON %s (%s)" % (
+        qn(COMMENT_INDEX_NAME), qn(Comment._meta.db_table),
+        ", ".join(columns)))
+
+
+def drop_comment_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in ('sqlite', 'postgresql', 'mysql'):
+        return
+    Comment = apps.get_model('django_comments', 'Comment')
+    qn = schema_editor.quote_name
+    if vendor == 'mysql':
+        schema_editor.execute("DROP INDEX %s ON %s" % (
+            qn(COMMENT_INDEX_NAME), qn(Comment._meta.db_table)))
+    else:
+        schema_editor.execute("DROP INDEX %s" % qn(COMMENT_INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_xtd', '0010_xtdcomment_confirmation_digest'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='xtdcomment',
+            index_together=set([('thread_id', 'order'), ('thread_id', 'level', 'order')]),
+        ),
+        migrations.RunPython(create_comment_index, drop_comment_index),
+    ]
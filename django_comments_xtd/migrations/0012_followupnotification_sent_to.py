@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_comments_xtd', '0011_comment_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='followupnotification',
+            name='sent_to',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+    ]
@@ -1,20 +1,68 @@
+import hashlib
+import re
+from collections import defaultdict
+
 from django.db import models
-from django.db.models import F, Max, Min, Q
+from django.db.models import Count, F, Max, Min, Q
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete, post_save
 from django.db.transaction import atomic
+try:
+    from django.db.transaction import on_commit
+except ImportError:  # Django < 1.9
+    def on_commit(func, using=None):
+        func()
 from django.contrib.contenttypes.models import ContentType
 from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 
 from django_comments.managers import CommentManager
 from django_comments.models import Comment, CommentFlag
-from django_comments.signals import comment_was_flagged
+from django_comments.signals import comment_was_flagged, comment_was_posted
 
+from django_comments_xtd.cache import (bump_blacklist_version, bump_version,
+                                       count_key, get_cache, get_versions)
 from django_comments_xtd.conf import settings
+from django_comments_xtd.events import publish_update
+from django_comments_xtd.signals import (comment_thread_muted,
+                                         confirmation_received)
 
 
 LIKEDIT_FLAG = "I liked it"
 DISLIKEDIT_FLAG = "I disliked it"
 
+# Max number of comment ids sent in a single query when prefetching flags.
+FLAGS_PREFETCH_CHUNK_SIZE = 500
+
+# Each level of XtdComment.thread_path takes as many characters.
+THREAD_PATH_SEGMENT_LENGTH = 10
+
+# Salt of the HMACs in the mute keys of follow-up notifications.
+MUTE_KEY_SALT = "django_comments_xtd.mute"
+
+
+def confirmation_digest(comment):
+    """
+    Return a SHA256 hex digest of the fields that identify a comment sent
+    for confirmation: the same for the TmpXtdComment and for the
+    XtdComment created from it.
+    """
+    ctype_id = getattr(comment, 'content_type_id', None)
+    if ctype_id is None:
+        ctype_id = comment.content_type.pk
+    submit_date = comment.submit_date
+    if timezone.is_aware(submit_date):
+        submit_date = timezone.make_naive(submit_date, timezone.utc)
+    fields = [ctype_id, comment.object_pk, comment.user_name,
+              comment.user_email, int(bool(comment.followup)),
+              submit_date.isoformat()]
+    value = "\x00".join(force_text(field) for field in fields)
+    return hashlib.sha256(value.encode('utf8')).hexdigest()
+
 
 def max_thread_level_for_content_type(content_type):
     app_model = "%s.%s" % (content_type.app_label, content_type.model)
@@ -24,6 +72,21 @@ def max_thread_level_for_content_type(content_type):
         return settings.COMMENTS_XTD_MAX_THREAD_LEVEL
 
 
+def thread_path_segment(comment_id):
+    """Zero padded comment id, to make paths sort in thread order."""
+    return "%0*d" % (THREAD_PATH_SEGMENT_LENGTH, comment_id)
+
+
+def thread_ordering():
+    """
+    Return the fields that sort comments in thread order, according to
+    COMMENTS_XTD_THREAD_ORDERING.
+    """
+    if settings.COMMENTS_XTD_THREAD_ORDERING == 'path':
+        return ('thread_id', 'thread_path')
+    return ('thread_id', 'order')
+
+
 class MaxThreadLevelExceededException(Exception):
     def __init__(self, comment):
         self.comment = comment
@@ -61,10 +124,33 @@ class XtdComment(Comment):
     parent_id = models.IntegerField(default=0)
     level = models.SmallIntegerField(default=0)
     order = models.IntegerField(default=1, db_index=True)
+    thread_path = models.CharField(max_length=255, blank=True, default='',
+                                   db_index=True, editable=False)
     followup = models.BooleanField(blank=True, default=False,
                                    help_text=_("Notify follow-up comments"))
+    likedit_count = models.PositiveIntegerField(default=0, editable=False)
+    dislikedit_count = models.PositiveIntegerField(default=0, editable=False)
+    flagged_count = models.PositiveIntegerField(default=0, editable=False)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+    # Set on comments posted through the confirmation flow, to tell
+    # whether a comment has been posted already, see confirmation_digest.
+    confirmation_digest = models.CharField(max_length=64, unique=True,
+                                           null=True, blank=True,
+                                           editable=False)
     objects = XtdCommentManager()
 
+    class Meta:
+        # Same options as django_comments.Comment, that would be inherited
+        # without this Meta.
+        ordering = ('submit_date',)
+        permissions = [("can_moderate", "Can moderate comments")]
+        verbose_name = _('comment')
+        verbose_name_plural = _('comments')
+        # The columns of the parent table, django_comments, are indexed by
+        # the migration 0011_comment_indexes.
+        index_together = [('thread_id', 'order'),
+                          ('thread_id', 'level', 'order')]
+
     def save(self, *args, **kwargs):
         is_new = self.pk is None
         super(Comment, self).save(*args, **kwargs)
@@ -72,6 +158,7 @@ class XtdComment(Comment):
             if not self.parent_id:
                 self.parent_id = self.id
                 self.thread_id = self.id
+                self.thread_path = thread_path_segment(self.id)
             else:
                 if max_thread_level_for_content_type(self.content_type):
                     with atomic():
@@ -82,14 +169,21 @@ class XtdComment(Comment):
             super(Comment, self).save(*args, **kwargs)
 
     def _calculate_thread_data(self):
-        # Implements the following approach:
+        # With COMMENTS_XTD_THREAD_ORDERING = 'order' implements the
+        # following approach:
         #  http://www.sqlteam.com/article/sql-for-threaded-discussion-forums
+        # The thread_path is the list of ids from the top of the thread
+        # down to the comment, and it's kept up to date in both cases.
         parent = XtdComment.objects.get(pk=self.parent_id)
         if parent.level == max_thread_level_for_content_type(self.content_type):
             raise MaxThreadLevelExceededException(self)
 
         self.thread_id = parent.thread_id
         self.level = parent.level + 1
+        self.thread_path = parent.thread_path + thread_path_segment(self.id)
+        if settings.COMMENTS_XTD_THREAD_ORDERING == 'path':
+            # Replies sort by thread_path, no other comment has to change.
+            return
         qc_eq_thread = XtdComment.objects.filter(thread_id=parent.thread_id)
         qc_ge_level = qc_eq_thread.filter(level__lte=parent.level,
                                           order__gt=parent.order)
@@ -108,14 +202,16 @@ class XtdComment(Comment):
         return ("comments-xtd-reply", None, {"cid": self.pk})
 
     def allow_thread(self):
-        if self.level < max_thread_level_for_content_type(self.content_type):
+        content_type = ContentType.objects.get_for_id(self.content_type_id)
+        if self.level < max_thread_level_for_content_type(content_type):
             return True
         else:
             return False
 
     @classmethod
     def tree_from_queryset(cls, queryset, with_flagging=False,
-                           with_feedback=False, user=None):
+                           with_feedback=False, user=None, parent=None,
+                           depth=None, max_replies=None):
         """Converts a XtdComment queryset into a list of nested dictionaries.
         The queryset has to be ordered by thread_id, order.
         Each dictionary contains two attributes::
@@ -123,6 +219,19 @@ class XtdComment(Comment):
                 'comment': the comment object itself,
                 'children': [list of child comment dictionaries]
             }
+
+        The tree is built in a single pass: every dictionary is indexed by
+        the comment's id, so that each reply is attached to its parent in
+        constant time. Replies whose parent is not in the queryset are
+        skipped, along with their own replies.
+
+        With ``parent``, the queryset holds the comments below it, and the
+        tree starts with the replies to it instead of the top level
+        comments. ``depth`` limits the levels in the tree,
+        and ``max_replies`` the replies to each comment, not counting
+        those at the top of the tree. With either of them each dictionary
+        has a ``children_count`` with the number of replies to the comment
+        in the queryset, including those left out of the tree.
         """
         def get_user_feedback(comment, user):
             d = {'likedit_users': comment.users_flagging(LIKEDIT_FLAG),
@@ -134,57 +243,419 @@ class XtdComment(Comment):
                     d['dislikedit'] = True
             return d
 
-        def add_children(children, obj, user):
-            for item in children:
-                if item['comment'].pk == obj.parent_id:
-                    child_dict = {'comment': obj, 'children': []}
-                    if with_feedback:
-                        child_dict.update(get_user_feedback(obj, user))
-                    item['children'].append(child_dict)
-                    return True
-                elif item['children']:
-                    if add_children(item['children'], obj, user):
-                        return True
-            return False
-
         def get_new_dict(obj):
             new_dict = {'comment': obj, 'children': []}
             if with_feedback:
                 new_dict.update(get_user_feedback(obj, user))
             if with_flagging:
-                users_flagging = obj.users_flagging(CommentFlag.SUGGEST_REMOVAL)
-                if user.has_perm('django_comments.can_moderate'):
-                    new_dict.update({'flagged_count': len(users_flagging)})
-                new_dict.update({'flagged': user in users_flagging})
+                if can_moderate:
+                    new_dict.update({'flagged_count': obj.flagged_count})
+                new_dict.update({
+                    'flagged': obj.is_flagged_by(user,
+                                                 CommentFlag.SUGGEST_REMOVAL)
+                })
             return new_dict
 
+        top_level = 0 if parent is None else parent.level + 1
+        children_counts = None
+        if depth is not None or max_replies is not None:
+            # Replies to the comments in the tree are counted with a grouped
+            # query, as those beyond depth are not read.
+            counted = queryset.filter(level__gt=top_level)
+            if depth is not None:
+                queryset = queryset.filter(level__lt=top_level + depth)
+                counted = counted.filter(level__lte=top_level + depth)
+            children_counts = dict(counted.order_by()
+                                          .values_list('parent_id')
+                                          .annotate(count=Count('pk')))
+
+        flags = []
+        if with_feedback:
+            flags.extend([LIKEDIT_FLAG, DISLIKEDIT_FLAG])
+        if with_flagging:
+            flags.append(CommentFlag.SUGGEST_REMOVAL)
+            can_moderate = user.has_perm('django_comments.can_moderate')
+        if flags:
+            queryset = cls.prefetch_users_flagging(queryset, flags)
+
         dic_list = []
-        cur_dict = None
+        dic_by_id = {}
         for obj in queryset:
-            if cur_dict and obj.level == cur_dict['comment'].level:
-                dic_list.append(cur_dict)
-                cur_dict = None
-            if not cur_dict:
-                cur_dict = get_new_dict(obj)
-                continue
-            if obj.parent_id == cur_dict['comment'].pk:
-                child_dict = get_new_dict(obj)
-                cur_dict['children'].append(child_dict)
+            if obj.level == top_level:
+                siblings = dic_list
             else:
-                add_children(cur_dict['children'], obj, user)
-        if cur_dict:
-            dic_list.append(cur_dict)
+                parent_dict = dic_by_id.get(obj.parent_id)
+                if parent_dict is None:
+                    continue
+                siblings = parent_dict['children']
+                if max_replies is not None and len(siblings) >= max_replies:
+                    continue
+            new_dict = get_new_dict(obj)
+            if children_counts is not None:
+                new_dict['children_count'] = children_counts.get(obj.pk, 0)
+            dic_by_id[obj.pk] = new_dict
+            siblings.append(new_dict)
         return dic_list
 
+    @classmethod
+    def prefetch_users_flagging(cls, comments, flags=None):
+        """
+        Load the flags given to a list of comments and group them in memory,
+        so that ``users_flagging`` and ``is_flagged_by`` don't hit the
+        database once per comment.
+
+        ``comments`` may be a queryset or any iterable of comments. Flags
+        are restricted to those in ``flags``, when given. Returns the list
+        of comments.
+        """
+        flag_qs = CommentFlag.objects.select_related('user')
+        if flags is not None:
+            flag_qs = flag_qs.filter(flag__in=flags)
+        if isinstance(comments, QuerySet) and comments.query.can_filter():
+            flag_lists = [flag_qs.filter(comment__in=comments.values('pk'))]
+            comments = list(comments)
+        else:
+            comments = list(comments)
+            pks = [comment.pk for comment in comments]
+            flag_lists = [
+                flag_qs.filter(comment__in=pks[i:i+FLAGS_PREFETCH_CHUNK_SIZE])
+                for i in range(0, len(pks), FLAGS_PREFETCH_CHUNK_SIZE)]
+        users = defaultdict(lambda: defaultdict(list))
+        for flag_list in flag_lists:
+            for flag in flag_list:
+                users[flag.comment_id][flag.flag].append(flag.user)
+        for comment in comments:
+            comment._users_flagging = (flags, users.get(comment.pk, {}))
+        return comments
+
     def users_flagging(self, flag):
-        return [obj.user for obj in self.flags.filter(flag=flag)]
+        prefetched = getattr(self, '_users_flagging', None)
+        if prefetched is not None:
+            flags, users = prefetched
+            if flags is None or flag in flags:
+                return users.get(flag, [])
+        return [obj.user for obj in
+                self.flags.filter(flag=flag).select_related('user')]
+
+    def is_flagged_by(self, user, flag):
+        """Whether the given user has flagged the comment with ``flag``."""
+        prefetched = getattr(self, '_users_flagging', None)
+        if prefetched is not None:
+            flags, users = prefetched
+            if flags is None or flag in flags:
+                return user in users.get(flag, [])
+        if user is None or not user.is_authenticated():
+            return False
+        return self.flags.filter(flag=flag, user=user).exists()
+
+
+# Flags whose number is kept in a counter field of XtdComment.
+FLAG_COUNTERS = {
+    LIKEDIT_FLAG: 'likedit_count',
+    DISLIKEDIT_FLAG: 'dislikedit_count',
+    CommentFlag.SUGGEST_REMOVAL: 'flagged_count',
+}
+
+
+def update_flag_counter(flag, delta):
+    field = FLAG_COUNTERS.get(flag.flag)
+    if field is not None:
+        qs = XtdComment.objects.filter(pk=flag.comment_id)
+        if delta < 0:
+            qs = qs.filter(**{'%s__gte' % field: -delta})
+        qs.update(**{field: F(field) + delta, 'modified': timezone.now()})
+
+
+def rebuild_flag_counters(using='default'):
+    """
+    Recalculate the flag counters of every XtdComment from the CommentFlag
+    table. Returns the number of comments that have at least one flag.
+    """
+    with atomic(using=using):
+        XtdComment.objects.using(using)\
+                          .update(**{field: 0
+                                     for field in FLAG_COUNTERS.values()})
+        counts = defaultdict(list)
+        flagged = set()
+        for row in CommentFlag.objects.using(using)\
+                                      .filter(flag__in=FLAG_COUNTERS)\
+                                      .values('comment_id', 'flag')\
+                                      .annotate(count=Count('pk'))\
+                                      .order_by():
+            counts[(FLAG_COUNTERS[row['flag']], row['count'])].append(
+                row['comment_id'])
+            flagged.add(row['comment_id'])
+        for (field, count), pks in counts.items():
+            for i in range(0, len(pks), FLAGS_PREFETCH_CHUNK_SIZE):
+                XtdComment.objects.using(using)\
+                    .filter(pk__in=pks[i:i+FLAGS_PREFETCH_CHUNK_SIZE])\
+                    .update(**{field: count})
+    return len(flagged)
+
+
+def rebuild_thread_paths(using='default'):
+    """
+    Recalculate the thread_path of every XtdComment from its parent_id.
+    Returns the number of comments whose thread_path has changed.
+    """
+    paths = {}
+    updates = []
+    # Replies always have a greater id than their parent.
+    rows = XtdComment.objects.using(using)\
+                             .order_by('thread_id', 'pk')\
+                             .values_list('pk', 'parent_id', 'thread_id',
+                                          'thread_path')
+    for pk, parent_id, thread_id, thread_path in rows.iterator():
+        if pk == parent_id:
+            path = thread_path_segment(pk)
+        else:
+            parent_path = paths.get(parent_id,
+                                    paths.get(thread_id,
+                                              thread_path_segment(thread_id)))
+            path = parent_path + thread_path_segment(pk)
+        paths[pk] = path
+        if path != thread_path:
+            updates.append((pk, path))
+    with atomic(using=using):
+        for pk, path in updates:
+            XtdComment.objects.using(using).filter(pk=pk)\
+                                           .update(thread_path=path)
+    return len(updates)
+
+
+def get_comment_counts(pairs):
+    """
+    Return a dictionary with the number of public comments posted in the
+    current site to each of the given (content_type_id, object_pk) pairs.
+
+    Counts are read from the cache when COMMENTS_XTD_COUNT_CACHE_TIMEOUT is
+    greater than 0. The rest are calculated with a grouped query per
+    content type.
+    """
+    pairs = set((ctype_id, force_text(object_pk))
+                for ctype_id, object_pk in pairs)
+    counts = dict.fromkeys(pairs, 0)
+    timeout = settings.COMMENTS_XTD_COUNT_CACHE_TIMEOUT
+    if timeout > 0:
+        versions = get_versions(pairs)
+        keys = dict((count_key(ctype_id, object_pk, version,
+                               settings.SITE_ID),
+                     (ctype_id, object_pk))
+                    for (ctype_id, object_pk), version in versions.items())
+        cached = get_cache().get_many(keys.keys())
+        for key, count in cached.items():
+            counts[keys[key]] = count
+        missing = set(pair for key, pair in keys.items() if key not in cached)
+    else:
+        missing = pairs
+    pks_by_ctype = defaultdict(list)
+    for ctype_id, object_pk in missing:
+        pks_by_ctype[ctype_id].append(object_pk)
+    for ctype_id, pks in pks_by_ctype.items():
+        for i in range(0, len(pks), FLAGS_PREFETCH_CHUNK_SIZE):
+            rows = XtdComment.objects\
+                .filter(content_type=ctype_id,
+                        object_pk__in=pks[i:i+FLAGS_PREFETCH_CHUNK_SIZE],
+                        site__pk=settings.SITE_ID, is_public=True)\
+                .values_list('object_pk')\
+                .annotate(count=Count('pk'))\
+                .order_by()
+            for object_pk, count in rows:
+                counts[(ctype_id, object_pk)] = count
+    if timeout > 0 and missing:
+        get_cache().set_many(dict((key, counts[pair])
+                                  for key, pair in keys.items()
+                                  if pair in missing), timeout)
+    return counts
+
+
+@receiver(post_save, sender=CommentFlag)
+def increase_flag_counter(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        update_flag_counter(instance, 1)
+
+
+@receiver(post_delete, sender=CommentFlag)
+def decrease_flag_counter(sender, instance, **kwargs):
+    update_flag_counter(instance, -1)
+
+
+def invalidate_comment_caches(comment):
+    """
+    Make stale everything cached about the comments posted to the object
+    the given comment, or TmpXtdComment, belongs to, and notify the live
+    updates streams of the object.
+
+    The version is bumped once the transaction commits, otherwise a request
+    reading the comments in the meantime would cache them as they were
+    before the change under the new version.
+    """
+    ctype_id = getattr(comment, 'content_type_id', None)
+    if ctype_id is None:
+        ctype_id = comment.content_type.pk
+    object_pk = comment.object_pk
+
+    def invalidate():
+        version = bump_version(ctype_id, object_pk)
+        publish_update(ctype_id, object_pk, version)
+
+    on_commit(invalidate)
+
+
+# Receivers of the model signals of the comment model, connected by
+# CommentsXtdConfig.ready, as the model can be a subclass of XtdComment.
+def invalidate_caches_on_comment_change(sender, instance, raw=False,
+                                        **kwargs):
+    if not raw:
+        invalidate_comment_caches(instance)
+
+
+@receiver(post_save, sender=CommentFlag)
+@receiver(post_delete, sender=CommentFlag)
+def invalidate_caches_on_flag_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_comment_caches(instance.comment)
+
+
+@receiver(comment_was_posted)
+@receiver(confirmation_received)
+@receiver(comment_was_flagged)
+@receiver(comment_thread_muted)
+def invalidate_caches_on_comment_event(sender, comment, **kwargs):
+    invalidate_comment_caches(comment)
 
 
 @receiver(comment_was_flagged)
 def unpublish_nested_comments_on_removal_flag(sender, comment, flag, **kwargs):
     if flag.flag == CommentFlag.MODERATOR_DELETION:
-        XtdComment.objects.filter(~(Q(pk=comment.id)), parent_id=comment.id)\
-                          .update(is_public=False)
+        nested = XtdComment.objects.filter(~(Q(pk=comment.id)),
+                                           parent_id=comment.id)
+        followers = set(nested.filter(followup=True).values_list(
+            'content_type_id', 'object_pk', 'user_email'))
+        nested.update(is_public=False, modified=timezone.now())
+        for ctype_id, object_pk, user_email in followers:
+            sync_followup_subscription(ctype_id, object_pk, user_email)
+
+
+# ----------------------------------------------------------------------
+class FollowupSubscription(models.Model):
+    """
+    Someone to notify of the comments posted to an object, for having
+    posted a public comment to it with followup=True. Subscriptions are
+    kept in sync with the comments by sync_followup_subscription.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_pk = models.CharField(max_length=255)
+    user_email = models.EmailField(max_length=254)
+    user_name = models.CharField(max_length=50, blank=True)
+    # The last comment of the follower, signed in the mute links.
+    comment = models.ForeignKey(XtdComment, on_delete=models.CASCADE,
+                                related_name='+')
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = (('content_type', 'object_pk', 'user_email'),)
+
+    def __str__(self):
+        return "%s following %s-%s" % (self.user_email, self.content_type_id,
+                                       self.object_pk)
+
+    def get_mute_key(self):
+        """
+        Return the key of the links to mute the notifications: the ID of
+        the subscription followed by an HMAC of it and the email address.
+        """
+        return "%s-%s" % (self.pk, self._get_mute_hmac())
+
+    def _get_mute_hmac(self):
+        key_salt = MUTE_KEY_SALT + force_text(settings.COMMENTS_XTD_SALT)
+        return salted_hmac(key_salt,
+                           "%s:%s" % (self.pk, self.user_email)).hexdigest()
+
+
+def get_subscription_by_mute_key(key):
+    """Return the subscription of the mute key, or None if it's not valid."""
+    match = re.match(r'^(\d+)-([0-9a-f]+)$', key)
+    if match is None:
+        return None
+    try:
+        subscription = FollowupSubscription.objects\
+                                           .select_related('comment')\
+                                           .get(pk=match.group(1))
+    except FollowupSubscription.DoesNotExist:
+        return None
+    if not constant_time_compare(match.group(2),
+                                 subscription._get_mute_hmac()):
+        return None
+    return subscription
+
+
+def sync_followup_subscription(ctype_id, object_pk, user_email):
+    """
+    Subscribe user_email to the comments posted to the object if there is
+    a public comment of theirs with followup=True, or unsubscribe it.
+    """
+    if not user_email:
+        return
+    lookup = {'content_type_id': ctype_id,
+              'object_pk': force_text(object_pk),
+              'user_email': user_email}
+    last_comment = XtdComment.objects.filter(is_public=True, followup=True,
+                                             **lookup)\
+                                     .order_by('-pk').first()
+    if last_comment is None:
+        FollowupSubscription.objects.filter(**lookup).delete()
+    else:
+        FollowupSubscription.objects.update_or_create(
+            defaults={'user_name': last_comment.user_name,
+                      'comment': last_comment}, **lookup)
+
+
+def sync_followup_subscription_on_comment_change(sender, instance, raw=False,
+                                                 **kwargs):
+    if raw:
+        return
+    sync_followup_subscription(instance.content_type_id, instance.object_pk,
+                               instance.user_email)
+
+
+def connect_comment_model_signals(model):
+    """
+    Connect the receivers of the model signals of XtdComment, or of the
+    subclass of it given in COMMENTS_XTD_MODEL.
+    """
+    for signal in (post_save, post_delete):
+        signal.connect(invalidate_caches_on_comment_change, sender=model)
+        signal.connect(sync_followup_subscription_on_comment_change,
+                       sender=model)
+
+
+# ----------------------------------------------------------------------
+class FollowupNotification(models.Model):
+    """
+    A comment whose followers have to be notified by email. Written when
+    the comment is published, if COMMENTS_XTD_NOTIFICATION_OUTBOX is True,
+    and deleted once the emails are sent by the management command
+    send_followup_notifications.
+
+    Workers claim a notification by setting claimed_until. When the
+    emails can't be sent the claim expires and the notification is tried
+    again, up to the number of attempts given to the command. The
+    followers already notified are kept in sent_to, one email address per
+    line, not to notify them again.
+    """
+    comment = models.ForeignKey(XtdComment, on_delete=models.CASCADE,
+                                related_name='followup_notifications')
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    sent_to = models.TextField(blank=True, default='', editable=False)
+
+    class Meta:
+        ordering = ('created',)
+
+    def __str__(self):
+        return "notification of comment %s" % self.comment_id
 
 
 class DummyDefaultManager:
@@ -208,6 +679,11 @@ class TmpXtdComment(dict):
         try:
             return self[key]
         except KeyError:
+            if key == 'content_object' and 'content_type' in self:
+                # Fetched only when needed, as keys don't include it.
+                self[key] = self.content_type.get_object_for_this_type(
+                    pk=self.object_pk)
+                return self[key]
             return None
 
     def __setattr__(self, key, value):
@@ -226,13 +702,35 @@ class TmpXtdComment(dict):
     def __setstate__(self, state):
         ct_key = state.pop('content_type_key')
         ctype = ContentType.objects.get_by_natural_key(*ct_key)
-        self.update(
-            state,
-            content_type=ctype,
-            content_object=ctype.get_object_for_this_type(
-                pk=state['object_pk']
-            )
-        )
+        self.update(state, content_type=ctype)
+
+    def to_dict(self):
+        """
+        Return the data of the comment as a dict that can be serialized to
+        JSON, to be restored with from_dict().
+        """
+        data = {}
+        for key, value in self.items():
+            if key in ('content_object', 'xtd_comment') or value is None:
+                continue
+            elif key == 'content_type':
+                data['content_type_key'] = value.natural_key()
+            elif key == 'user':
+                data['user_id'] = value.pk
+            elif key == 'submit_date':
+                data[key] = value.isoformat()
+            else:
+                data[key] = value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        tmp_comment = cls()
+        tmp_comment.__setstate__(data)
+        if 'submit_date' in data:
+            tmp_comment['submit_date'] = parse_datetime(data['submit_date'])
+        return tmp_comment
 
     def __reduce__(self):
         state = {k: v for k, v in self.items() if k != 'content_object'}
@@ -259,3 +757,9 @@ class BlackListedDomain(models.Model):
 
     class Meta:
         ordering = ('domain',)
+
+
+@receiver(post_save, sender=BlackListedDomain)
+@receiver(post_delete, sender=BlackListedDomain)
+def bump_blacklist_version_on_change(sender, **kwargs):
+    bump_blacklist_version()
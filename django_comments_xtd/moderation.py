@@ -1,9 +1,14 @@
+import threading
+import time
+
 from django import VERSION
 try:
     from django.contrib.sites.shortcuts import get_current_site
 except ImportError:
     from django.contrib.sites.models import get_current_site
 
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.template import Context, loader
 
 try:
@@ -20,6 +25,7 @@ except ImportError:
     from django.contrib.comments.moderation import Moderator, CommentModerator
 
 
+from django_comments_xtd.cache import get_blacklist_version
 from django_comments_xtd.conf import settings
 from django_comments_xtd.models import BlackListedDomain, TmpXtdComment
 from django_comments_xtd.signals import confirmation_received
@@ -74,9 +80,94 @@ class XtdCommentModerator(CommentModerator):
                   recipient_list, fail_silently=True)
 
 
+def idna_domain(domain):
+    """
+    Return the domain lower cased and IDNA encoded, as blacklisted domains
+    are stored. Labels that can't be encoded are left as they are.
+    """
+    domain = domain.lower().strip('.')
+    try:
+        return domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        labels = []
+        for label in domain.split('.'):
+            try:
+                labels.append(label.encode('idna').decode('ascii'))
+            except UnicodeError:
+                labels.append(label)
+        return '.'.join(labels)
+
+
+class BlackListedDomainSet(object):
+    """
+    In-memory copy of the BlackListedDomain table, to match email domains
+    without querying the database.
+
+    A domain matches when it, or any of its parent domains, is blacklisted:
+    with "example.com" blacklisted "mail.example.com" matches too. Domains
+    are compared lower cased and IDNA encoded. The copy
+    is loaded again when the version of the table in the cache changes,
+    which is checked at most every check_interval seconds.
+    """
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self._domains = frozenset()
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        version = get_blacklist_version()
+        domains = frozenset(
+            idna_domain(domain) for domain in
+            BlackListedDomain.objects.values_list('domain', flat=True)
+                                     .order_by().iterator())
+        with self._lock:
+            self._domains = domains
+            self._version = version
+            self._checked_at = time.time()
+
+    def expire(self):
+        """Check the version of the table on the next lookup."""
+        self._checked_at = 0
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if get_blacklist_version() != self._version:
+            self.load()
+
+    def __contains__(self, domain):
+        self._check_version()
+        domains = self._domains
+        domain = idna_domain(domain)
+        while domain:
+            if domain in domains:
+                return True
+            domain = domain.partition('.')[2]
+        return False
+
+    def __len__(self):
+        self._check_version()
+        return len(self._domains)
+
+
+blacklisted_domains = BlackListedDomainSet()
+
+
+@receiver(post_save, sender=BlackListedDomain)
+@receiver(post_delete, sender=BlackListedDomain)
+def expire_blacklisted_domains(sender, **kwargs):
+    blacklisted_domains.expire()
+
+
 class SpamModerator(XtdCommentModerator):
     """
-    Discard messages comming from blacklisted domains.
+    Discard messages comming from blacklisted domains, and their
+    subdomains.
 
     The current list of blacklisted domains had been fetched from
     http://www.joewein.net/spam/blacklist.htm
@@ -93,8 +184,9 @@ class SpamModerator(XtdCommentModerator):
     ``SpamModerator`` uses the additional ``django_comments_xtd`` model:
      * ``BlackListedDomain``
 
-    Remember to update the content regularly through an external Spam
-    filtering service.
+    The domains are kept in memory, see ``BlackListedDomainSet``. Remember
+    to update the content regularly through an external Spam filtering
+    service, with the ``load_blacklisted_domains`` management command.
     """
     def allow(self, comment, content_object, request):
         try:
@@ -102,7 +194,7 @@ class SpamModerator(XtdCommentModerator):
         except IndexError:
             return False
         else:
-            if(BlackListedDomain.objects.filter(domain=domain).count()):
+            if domain in blacklisted_domains:
                 return False
             return super(SpamModerator, self).allow(comment, content_object,
                                                     request)
@@ -9,6 +9,13 @@ import {Comment} from './comment.jsx';
 import {CommentForm} from './commentform.jsx';
 
 
+const MAX_POLL_INTERVAL_FACTOR = 16;
+
+// Pixels left to scroll down to the end of the comments when the next
+// page of comments is requested.
+const NEXT_PAGE_SCROLL_MARGIN = 400;
+
+
 export class CommentBox extends React.Component {
   constructor(props) {
     super(props);
@@ -16,11 +23,23 @@ export class CommentBox extends React.Component {
     this.state = {
       previewing: false,
       preview: {name: '', email: '', url: '', comment: ''},
-      tree: [], cids: [], newcids: [], counter: this.props.comment_count
+      tree: [], cids: [], newcids: [], counter: this.props.comment_count,
+      listed: this.props.comment_count, replies: {}
     };
+    // Comments received so far, and the value of 'since' to request the
+    // changes made to them afterwards.
+    this.comments = [];
+    this.since = '';
+    // When the list is paginated, the URL of the next page of threads,
+    // or null after the last one.
+    this.paginated = false;
+    this.next = null;
+    this.loading_page = false;
+    this.tree_element = null;
     this.handle_comment_created = this.handle_comment_created.bind(this);
     this.handle_preview = this.handle_preview.bind(this);
     this.handle_update = this.handle_update.bind(this);
+    this.handle_scroll = this.handle_scroll.bind(this);
   }
 
   handle_comment_created() {
@@ -39,6 +58,19 @@ export class CommentBox extends React.Component {
     this.load_comments();
   }
 
+  handle_scroll() {
+    if (!this.next || this.loading_page || !this.tree_element)
+      return;
+    var bottom = this.tree_element.getBoundingClientRect().bottom;
+    if (bottom - window.innerHeight < NEXT_PAGE_SCROLL_MARGIN)
+      this.load_page();
+  }
+
+  handle_more_replies(thread_id, event) {
+    event.preventDefault();
+    this.load_replies(thread_id);
+  }
+
   reset_preview() {
     this.setState({
       preview: {name: '', email: '', url: '', comment: ''},
@@ -49,8 +81,8 @@ export class CommentBox extends React.Component {
   render_comment_counter() {
     if (this.state.counter > 0) {
       var fmts = django.ngettext("One comment.", "%s comments.",
-                                 this.state.cids.length);
-      var text = django.interpolate(fmts, [this.state.cids.length]);
+                                 this.state.listed);
+      var text = django.interpolate(fmts, [this.state.listed]);
       return (
         <div>
           <h5 className="text-center">{text}</h5>
@@ -78,7 +110,7 @@ export class CommentBox extends React.Component {
   }
 
   render_update_alert() {
-    var diff = this.state.counter - this.state.cids.length;
+    var diff = this.state.counter - this.state.listed;
     if (diff > 0) {
       var fmts = django.ngettext("There is a new comment.",
                                  "There are %s new comments.", diff);
@@ -96,7 +128,22 @@ export class CommentBox extends React.Component {
       return "";
   }
 
-  create_tree(data) {
+  render_more_replies(thread_id) {
+    if (!this.state.replies[thread_id])
+      return "";
+    return (
+      <div className="text-center">
+        <button type="button" className="btn btn-default btn-xs"
+                onClick={this.handle_more_replies.bind(this, thread_id)}>
+          {django.gettext("Load more replies")}
+        </button>
+      </div>
+    );
+  }
+
+  create_tree(data, removed) {
+    // removed is the number of comments no longer public, or null when
+    // data holds a page of comments, that doesn't change the count.
     var tree = new Array();
     var order = new Array();
     var comments = {};
@@ -119,7 +166,7 @@ export class CommentBox extends React.Component {
         order.push(item.id);
       }
       children[item.id] = [];
-      if (item.parent_id!==item.id) {
+      if (item.parent_id!==item.id && children[item.parent_id]) {
         children[item.parent_id].push(item.id);
       }
     }
@@ -142,22 +189,64 @@ export class CommentBox extends React.Component {
       }
     }
 
+    // A paginated list holds only the comments loaded so far.
+    var listed = curcids.length;
+    if (this.paginated) {
+      listed = this.state.listed;
+      if (removed !== null)
+        listed = Math.max(listed + newcids.length - removed, curcids.length);
+    }
     this.setState({tree:tree,
                    cids: curcids,
                    newcids: newcids,
-                   counter: curcids.length});
+                   listed: listed,
+                   counter: removed === null ? this.state.counter : listed});
+  }
+
+  merge_comments(comments, removed) {
+    // Replace the comments that have changed, append the new ones
+    // and drop those that are no longer public.
+    var positions = {};
+    var merged = this.comments.filter(function(item) {
+      return removed.indexOf(item.id) == -1;
+    });
+    merged.forEach(function(item, index) {
+      positions[item.id] = index;
+    });
+    for (let item of comments) {
+      if (positions[item.id] === undefined) {
+        positions[item.id] = merged.length;
+        merged.push(item);
+      } else {
+        merged[positions[item.id]] = item;
+      }
+    }
+    this.comments = merged;
+    return merged;
   }
 
   load_comments() {
     $.ajax({
       url: this.props.list_url,
+      data: {since: this.since},
       dataType: 'json',
-      cache: false,
-      success: function(data) {
+      ifModified: true,
+      success: function(data, status) {
+        if (status == 'notmodified')
+          return;
         // Set here a cookie with the last time comments have been retrieved.
         // I'll use it to add a label 'new' to every new comment received
         // after the timestamp stored in the cookie.
-        this.create_tree(data);
+        this.since = data.since;
+        if (data.next !== undefined) {
+          // First page of a paginated list.
+          this.paginated = true;
+          this.next = data.next;
+          this.setState({replies: data.replies});
+        }
+        this.create_tree(this.merge_comments(data.comments, data.removed),
+                         data.removed.length);
+        this.handle_scroll();
       }.bind(this),
       error: function(xhr, status, err) {
         console.error(this.props.list_url, status, err.toString());
@@ -165,26 +254,104 @@ export class CommentBox extends React.Component {
     });
   }
 
-  load_count() {
+  load_page() {
+    this.loading_page = true;
     $.ajax({
-      url: this.props.count_url,
+      url: this.next,
       dataType: 'json',
-      cache: false,
       success: function(data) {
+        this.next = data.next;
+        this.loading_page = false;
+        this.setState({replies: $.extend({}, this.state.replies,
+                                         data.replies)});
+        this.create_tree(this.merge_comments(data.comments, []), null);
+        this.handle_scroll();
+      }.bind(this),
+      error: function(xhr, status, err) {
+        this.loading_page = false;
+        console.error(this.next, status, err.toString());
+      }.bind(this)
+    });
+  }
+
+  load_replies(thread_id) {
+    var url = this.state.replies[thread_id];
+    $.ajax({
+      url: url,
+      dataType: 'json',
+      success: function(data) {
+        var replies = $.extend({}, this.state.replies);
+        if (data.next)
+          replies[thread_id] = data.next;
+        else
+          delete replies[thread_id];
+        this.setState({replies: replies});
+        this.create_tree(this.merge_comments(data.comments, []), null);
+      }.bind(this),
+      error: function(xhr, status, err) {
+        console.error(url, status, err.toString());
+      }.bind(this)
+    });
+  }
+
+  load_count(on_loaded) {
+    // on_loaded receives whether the count has changed.
+    on_loaded = on_loaded || function() {};
+    $.ajax({
+      url: this.props.count_url,
+      dataType: 'json',
+      ifModified: true,
+      success: function(data, status) {
+        if (status == 'notmodified' || data.count == this.state.counter)
+          return on_loaded(false);
         this.setState({counter: data.count});
+        on_loaded(true);
       }.bind(this),
       error: function(xhr, status, err) {
         console.error(this.props.count_url, status, err.toString());
+        on_loaded(false);
       }.bind(this)
     });
   }
-  
+
+  poll_count(interval) {
+    // Poll less often while nothing changes, up to
+    // MAX_POLL_INTERVAL_FACTOR times the poll_interval.
+    setTimeout(function() {
+      this.load_count(function(changed) {
+        var max_interval = this.props.poll_interval * MAX_POLL_INTERVAL_FACTOR;
+        this.poll_count(changed ? this.props.poll_interval
+                        : Math.min(interval * 2, max_interval));
+      }.bind(this));
+    }.bind(this), interval);
+  }
+
+  listen_events() {
+    // The browser reconnects whenever the server closes the stream.
+    // Poll instead if the stream can't be opened.
+    var source = new EventSource(this.props.events_url);
+    source.addEventListener('update', function() {
+      this.load_count();
+    }.bind(this));
+    source.onerror = function() {
+      if (source.readyState == EventSource.CLOSED && this.props.poll_interval)
+        this.poll_count(this.props.poll_interval);
+    }.bind(this);
+  }
+
   componentDidMount() {
     this.load_comments();
-    if(this.props.polling_interval)
-      setInterval(this.load_count.bind(this), this.props.polling_interval);
+    window.addEventListener('scroll', this.handle_scroll);
+    if(this.props.events_url && window.EventSource)
+      this.listen_events();
+    else if(this.props.poll_interval)
+      this.poll_count(this.props.poll_interval);
   }
   
+  componentWillUnmount() {
+    window.removeEventListener('scroll', this.handle_scroll);
+  }
+
   render() {
     var settings = this.props;
     var comment_counter = this.render_comment_counter();
@@ -193,11 +360,13 @@ export class CommentBox extends React.Component {
 
     var nodes = this.state.tree.map(function(item) {
       return (
-        <Comment key={item.id}
-                 data={item}
-                 settings={settings}
-                 newcids={this.state.newcids}
-                 on_comment_created={this.handle_comment_created} />
+        <div key={item.id}>
+          <Comment data={item}
+                   settings={settings}
+                   newcids={this.state.newcids}
+                   on_comment_created={this.handle_comment_created} />
+          {this.render_more_replies(item.id)}
+        </div>
       );
     }.bind(this));
     
@@ -207,7 +376,8 @@ export class CommentBox extends React.Component {
         {comment_form}
         <hr/>
         {update_alert}
-        <div className="comment-tree">
+        <div className="comment-tree"
+             ref={function(element) { this.tree_element = element; }.bind(this)}>
           <div className="media-list">
             {nodes}
           </div>
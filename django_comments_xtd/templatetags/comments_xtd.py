@@ -7,9 +7,14 @@ try:
 except ImportError:
     from urllib import urlencode
 
+from django.contrib.auth.context_processors import PermWrapper
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.contenttypes.models import ContentType
 from django.template import (Library, Node, TemplateSyntaxError,
                              Variable, loader)
+from django.utils import translation
+from django.utils.crypto import get_random_string
+from django.utils.encoding import force_text
 from django.utils.safestring import mark_safe
 
 try:
@@ -18,8 +23,12 @@ except ImportError:
     from django.core.urlresolvers import reverse
 
 from django_comments.forms import CommentSecurityForm
+from django_comments.models import CommentFlag
 from django_comments_xtd import get_model as get_comment_model
+from django_comments_xtd import cache
 from django_comments_xtd.conf import settings
+from django_comments_xtd.models import (get_comment_counts, LIKEDIT_FLAG,
+                                        DISLIKEDIT_FLAG)
 
 
 XtdComment = get_comment_model()
@@ -28,6 +37,14 @@ XtdComment = get_comment_model()
 register = Library()
 
 
+# Context variable that tells ``render_xtdcomment_user_state`` to leave a
+# placeholder, and the placeholder it leaves, with the random token of
+# the rendered tree, the template, the comment and its removal suggestions.
+USER_STATE_TOKEN = 'xtd_user_state_token'
+USER_STATE_PLACEHOLDER = '<!--xtd-user-state %s %s %s %s-->'
+USER_STATE_PATTERN = r'<!--xtd-user-state %s (\S+) (\S+) (\d+)-->'
+
+
 # ----------------------------------------------------------------------
 class XtdCommentCountNode(Node):
     """Store the number of XtdComments for the given list of app.models"""
@@ -74,6 +91,57 @@ def get_xtdcomment_count(parser, token):
     return XtdCommentCountNode(as_varname, content_types)
 
 
+# ----------------------------------------------------------------------
+class GetXtdCommentCountsNode(Node):
+    """Store a list of (object, number of XtdComments) pairs."""
+
+    def __init__(self, object_list, as_varname):
+        self.object_list = Variable(object_list)
+        self.as_varname = as_varname
+
+    def render(self, context):
+        objects = list(self.object_list.resolve(context))
+        pairs = [(ContentType.objects.get_for_model(obj).pk,
+                  force_text(obj.pk)) for obj in objects]
+        counts = get_comment_counts(pairs)
+        context[self.as_varname] = [(obj, counts[pair])
+                                    for obj, pair in zip(objects, pairs)]
+        return ''
+
+
+@register.tag
+def get_xtdcomment_counts(parser, token):
+    """
+    Gets the comment count of each object in the given list, with a single
+    query, and populates the template context with a list of pairs
+    (object, count), whose name is defined by the 'as' clause.
+
+    Syntax::
+
+        {% get_xtdcomment_counts for object_list as var %}
+
+    Example usage::
+
+        {% get_xtdcomment_counts for object_list as stories %}
+        {% for story, comment_count in stories %}...{% endfor %}
+
+    """
+    tokens = token.contents.split()
+
+    if len(tokens) != 5:
+        raise TemplateSyntaxError("%r tag requires 4 arguments" % tokens[0])
+
+    if tokens[1] != 'for':
+        raise TemplateSyntaxError("2nd. argument in %r tag must be 'for'" %
+                                  tokens[0])
+
+    if tokens[3] != 'as':
+        raise TemplateSyntaxError("4th. argument in %r tag must be 'as'" %
+                                  tokens[0])
+
+    return GetXtdCommentCountsNode(tokens[2], tokens[4])
+
+
 # ----------------------------------------------------------------------
 class BaseLastXtdCommentsNode(Node):
     """Base class to deal with the last N XtdComments for a list of app.model"""
@@ -243,6 +311,142 @@ class RenderXtdCommentTreeNode(Node):
             cvars.append((vname, Variable(vobj)))
         return cvars
 
+    def get_cache_key(self, context_dict, ctype, obj, part):
+        """
+        Return the key to cache the given part of the rendered tree under,
+        or None when the output must not be cached. The key doesn't depend
+        on the user, whose state is filled in after reading the cache.
+        """
+        if settings.COMMENTS_XTD_TREE_CACHE_TIMEOUT <= 0 or self.cvars:
+            return None
+        if isinstance(self.template_path, (list, tuple)):
+            template_variant = ",".join(self.template_path)
+        else:
+            template_variant = self.template_path or ""
+        version = cache.get_version(ctype.pk, obj.pk)
+        return cache.tree_key(ctype.pk, obj.pk, version, settings.SITE_ID,
+                              template_variant,
+                              context_dict['allow_feedback'],
+                              context_dict['show_feedback'],
+                              context_dict['allow_flagging'],
+                              translation.get_language(), part)
+
+    def get_template_names(self, ctype):
+        if self.template_path:
+            return self.template_path
+        return [
+            "django_comments_xtd/%s/%s/comment_tree.html" % (
+                ctype.app_label, ctype.model),
+            "django_comments_xtd/%s/comment_tree.html" % (ctype.app_label,),
+            "django_comments_xtd/comment_tree.html"
+        ]
+
+    def get_comments(self, ctype, obj, user):
+        queryset = XtdComment.objects.filter(content_type=ctype,
+                                             object_pk=obj.pk,
+                                             site__pk=settings.SITE_ID,
+                                             is_public=True)
+        return XtdComment.tree_from_queryset(
+            queryset,
+            with_flagging=self.allow_flagging,
+            with_feedback=self.allow_feedback,
+            user=user,
+            depth=settings.COMMENTS_XTD_TREE_DEPTH or None,
+            max_replies=settings.COMMENTS_XTD_TREE_MAX_REPLIES or None
+        )
+
+    def get_user_state(self, context_dict, ctype, obj):
+        """
+        Return the flags the user has given to the comments posted to the
+        object, and whether the user can moderate them, or None when the
+        user sees the comments as anonymous users do.
+        """
+        user = context_dict.get('user', None)
+        if user is None or not user.is_authenticated():
+            return None
+        flags = []
+        if context_dict['allow_feedback']:
+            flags.extend([LIKEDIT_FLAG, DISLIKEDIT_FLAG])
+        if context_dict['allow_flagging']:
+            flags.append(CommentFlag.SUGGEST_REMOVAL)
+        user_flags = {}
+        if flags:
+            qs = CommentFlag.objects.filter(
+                user=user, flag__in=flags,
+                comment__content_type=ctype,
+                comment__object_pk=force_text(obj.pk),
+                comment__site__pk=settings.SITE_ID)
+            for comment_id, flag in qs.values_list('comment_id', 'flag'):
+                user_flags.setdefault(force_text(comment_id), set()).add(flag)
+        can_moderate = user.has_perm('django_comments.can_moderate')
+        if not user_flags and not can_moderate:
+            return None
+        return {'flags': user_flags, 'can_moderate': can_moderate}
+
+    def fill_user_state(self, html, token, context_dict, user_state):
+        """
+        Replace the placeholders left by ``render_xtdcomment_user_state``
+        with their templates, rendered with the state of the user.
+        """
+        templates = {}
+
+        def render_placeholder(match):
+            template_name, comment_pk, flagged_count = match.groups()
+            if template_name not in templates:
+                templates[template_name] = loader.get_template(template_name)
+            flags = user_state['flags'].get(comment_pk, ())
+            item = {'comment': {'pk': comment_pk},
+                    'likedit': LIKEDIT_FLAG in flags,
+                    'dislikedit': DISLIKEDIT_FLAG in flags,
+                    'flagged': CommentFlag.SUGGEST_REMOVAL in flags}
+            if user_state['can_moderate']:
+                item['flagged_count'] = int(flagged_count)
+            return templates[template_name].render(dict(context_dict,
+                                                        item=item))
+
+        pattern = re.compile(USER_STATE_PATTERN % re.escape(token))
+        return mark_safe(pattern.sub(render_placeholder, html))
+
+    def render_cached(self, context_dict, ctype, obj):
+        """
+        Render the tree once for all the users, leaving placeholders where
+        the output depends on the user, and fill them in for each user.
+        Users that haven't liked, disliked or flagged any of the comments,
+        and can't moderate them, share the output of anonymous users.
+        """
+        timeout = settings.COMMENTS_XTD_TREE_CACHE_TIMEOUT
+        output_key = self.get_cache_key(context_dict, ctype, obj, 'output')
+        user_state = self.get_user_state(context_dict, ctype, obj)
+        if user_state is None:
+            html = cache.get_cache().get(output_key)
+            if html is not None:
+                return html
+        fragment_key = self.get_cache_key(context_dict, ctype, obj,
+                                          'fragment')
+        fragment = cache.get_cache().get(fragment_key)
+        if fragment is None:
+            anonymous = AnonymousUser()
+            token = get_random_string(16)
+            html = loader.render_to_string(
+                self.get_template_names(ctype),
+                dict(context_dict, user=anonymous,
+                     perms=PermWrapper(anonymous),
+                     comments=self.get_comments(ctype, obj, anonymous),
+                     **{USER_STATE_TOKEN: token}))
+            fragment = (token, html)
+            cache.get_cache().set(fragment_key, fragment, timeout)
+        token, html = fragment
+        if user_state is not None:
+            return self.fill_user_state(html, token, context_dict,
+                                        user_state)
+        anonymous = AnonymousUser()
+        html = self.fill_user_state(
+            html, token,
+            dict(context_dict, user=anonymous, perms=PermWrapper(anonymous)),
+            {'flags': {}, 'can_moderate': False})
+        cache.get_cache().set(output_key, html, timeout)
+        return html
+
     def render(self, context):
         context_dict = context.flatten()
         for attr in ['allow_flagging', 'allow_feedback', 'show_feedback']:
@@ -251,17 +455,10 @@ class RenderXtdCommentTreeNode(Node):
         if self.obj:
             obj = self.obj.resolve(context)
             ctype = ContentType.objects.get_for_model(obj)
-            queryset = XtdComment.objects.filter(content_type=ctype,
-                                                 object_pk=obj.pk,
-                                                 site__pk=settings.SITE_ID,
-                                                 is_public=True)
-            comments = XtdComment.tree_from_queryset(
-                queryset,
-                with_flagging=self.allow_flagging,
-                with_feedback=self.allow_feedback,
-                user=context['user']
-            )
-            context_dict['comments'] = comments
+            if self.get_cache_key(context_dict, ctype, obj, 'output'):
+                return self.render_cached(context_dict, ctype, obj)
+            context_dict['comments'] = self.get_comments(ctype, obj,
+                                                         context['user'])
         if self.cvars:
             for vname, vobj in self.cvars:
                 context_dict[vname] = vobj.resolve(context)
@@ -274,18 +471,8 @@ class RenderXtdCommentTreeNode(Node):
                                           "have 'comments' in the context and "
                                           "neither have been provided with the "
                                           "clause 'with'.")
-        if self.template_path:
-            template_arg = self.template_path
-        else:
-            template_arg = [
-                "django_comments_xtd/%s/%s/comment_tree.html" % (
-                    ctype.app_label, ctype.model),
-                "django_comments_xtd/%s/comment_tree.html" % (
-                    ctype.app_label,),
-                "django_comments_xtd/comment_tree.html"
-            ]
-        html = loader.render_to_string(template_arg, context_dict)
-        return html
+        return loader.render_to_string(self.get_template_names(ctype),
+                                       context_dict)
 
 
 class GetXtdCommentTreeNode(Node):
@@ -386,6 +573,45 @@ def render_xtdcomment_tree(parser, token):
                                     template_path=template_path)
 
 
+class RenderXtdCommentUserStateNode(Node):
+    def __init__(self, template_path):
+        self.template_path = Variable(template_path)
+
+    def render(self, context):
+        template_path = self.template_path.resolve(context)
+        token = context.get(USER_STATE_TOKEN, None)
+        if token:
+            comment = context['item']['comment']
+            return mark_safe(USER_STATE_PLACEHOLDER % (
+                token, template_path, comment.pk, comment.flagged_count))
+        return loader.render_to_string(template_path, context.flatten())
+
+
+@register.tag
+def render_xtdcomment_user_state(parser, token):
+    """
+    Render the part of a comment in a tree that depends on the user, like
+    whether the user liked or flagged it. When the tree is being cached,
+    leave a placeholder that ``render_xtdcomment_tree`` fills in for each
+    user. The template receives ``item``, with only ``item.comment.pk``
+    of the comment, and the ``likedit``, ``dislikedit``, ``flagged`` and
+    ``flagged_count`` of the user.
+
+    Syntax::
+
+        {% render_xtdcomment_user_state <template> %}
+
+    Example usage::
+
+        {% render_xtdcomment_user_state "includes/comment_tools.html" %}
+    """
+    tokens = token.contents.split()
+    if len(tokens) != 2:
+        raise TemplateSyntaxError("%r tag requires the template as its only "
+                                  "argument." % tokens[0])
+    return RenderXtdCommentUserStateNode(tokens[1])
+
+
 @register.tag
 def get_xtdcomment_tree(parser, token):
     """
@@ -438,13 +664,10 @@ class GetCommentBoxPropsNode(Node):
         obj = self.obj.resolve(context)
         form = CommentSecurityForm(obj)
         ctype = ContentType.objects.get_for_model(obj)
-        queryset = XtdComment.objects.filter(content_type=ctype,
-                                             object_pk=obj.pk,
-                                             site__pk=settings.SITE_ID,
-                                             is_public=True)
+        pair = (ctype.pk, force_text(obj.pk))
         ctype_slug = "%s-%s" % (ctype.app_label, ctype.model)
         d = {
-            "comment_count": queryset.count(),
+            "comment_count": get_comment_counts([pair])[pair],
             "allow_comments": True,
             "current_user": "0:Anonymous",
             "is_authenticated": False,
@@ -471,6 +694,10 @@ class GetCommentBoxPropsNode(Node):
                 "security_hash": form['security_hash'].value()
             }
         }
+        if settings.COMMENTS_XTD_LIVE_UPDATES:
+            d['events_url'] = reverse('comments-xtd-api-events',
+                                      kwargs={'content_type': ctype_slug,
+                                              'object_pk': obj.id})
         user = context.get('user', None)
         if user and user.is_authenticated():
             d['current_user'] = "%d:%s" % (
@@ -508,6 +735,7 @@ def get_commentbox_props(parser, token):
             list_url: <api-url-to-list-comments>,
             count_url: <api-url-to-count-comments>,
             send_url: <api-irl-to-send-a-comment>,
+            events_url: <only_when_COMMENTS_XTD_LIVE_UPDATES_is_True>,
             form: {
                 content_type: <value>,
                 object_pk: <value>,
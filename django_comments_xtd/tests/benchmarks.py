@@ -0,0 +1,184 @@
+"""
+Benchmarks for django-comments-xtd.
+
+They are not collected by the test runner. Run them from the repository
+root with::
+
+    DJANGO_SETTINGS_MODULE=django_comments_xtd.tests.settings \\
+        python -m django_comments_xtd.tests.benchmarks
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+
+def setup_django():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE",
+                          "django_comments_xtd.tests.settings")
+    import django
+    django.setup()
+
+
+def build_thread(size, replies_per_comment=3, max_level=2):
+    """
+    Return a list of unsaved XtdComment objects posted to the same object,
+    in (thread_id, order) order, shaped as a few very busy threads.
+    """
+    from django_comments_xtd.models import XtdComment
+
+    comments = []
+    next_id = [1]
+
+    def add(parent, level):
+        if len(comments) >= size:
+            return
+        cid = next_id[0]
+        next_id[0] += 1
+        comment = XtdComment(id=cid, comment_ptr_id=cid, level=level,
+                             parent_id=parent.id if parent else cid,
+                             thread_id=parent.thread_id if parent else cid)
+        comments.append(comment)
+        if level < max_level:
+            for _ in range(replies_per_comment):
+                add(comment, level + 1)
+
+    while len(comments) < size:
+        add(None, 0)
+    for order, comment in enumerate(comments, 1):
+        comment.order = order
+    return comments
+
+
+def bench_tree_from_queryset(sizes=(1000, 5000, 10000, 50000), repeat=3):
+    """Time XtdComment.tree_from_queryset for growing comment counts."""
+    from django_comments_xtd.models import XtdComment
+
+    print("tree_from_queryset")
+    print("%10s %12s %16s" % ("comments", "seconds", "usec/comment"))
+    for size in sizes:
+        comments = build_thread(size, replies_per_comment=size // 10)
+        elapsed = min(timeit.repeat(
+            lambda: XtdComment.tree_from_queryset(comments),
+            number=1, repeat=repeat))
+        print("%10d %12.4f %16.2f" % (size, elapsed, elapsed * 1e6 / size))
+
+
+def setup_test_database():
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def bench_read_comment_serializer(sizes=(100, 1000, 5000), repeat=3):
+    """
+    Time ReadCommentSerializer serializing lists of comments, posted by
+    ten different users, and count the queries it runs.
+    """
+    from django.contrib.auth.models import AnonymousUser, User
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection
+    from django.test import RequestFactory
+    from django.test.utils import CaptureQueriesContext
+    from django.utils import timezone
+
+    from django_comments_xtd.api.serializers import ReadCommentSerializer
+    from django_comments_xtd.tests.models import Article
+
+    authors = [User.objects.create_user("user%d" % i,
+                                        "user%d@example.com" % i)
+               for i in range(10)]
+    ctype = ContentType.objects.get_for_model(Article)
+    request = RequestFactory().get("/")
+    request.user = AnonymousUser()
+
+    def serialize(comments):
+        return ReadCommentSerializer(comments, many=True,
+                                     context={'request': request}).data
+
+    print("ReadCommentSerializer")
+    print("%10s %12s %16s %10s" % ("comments", "seconds", "usec/comment",
+                                   "queries"))
+    for size in sizes:
+        comments = build_thread(size, replies_per_comment=size // 10)
+        for comment in comments:
+            comment.content_type_id = ctype.pk
+            comment.object_pk = "1"
+            comment.site_id = 1
+            comment.user_id = authors[comment.id % len(authors)].pk
+            comment.user_email = "user@example.com"
+            comment.comment = "Comment %d" % comment.id
+            comment.submit_date = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            elapsed = min(timeit.repeat(lambda: serialize(comments),
+                                        number=1, repeat=repeat))
+        print("%10d %12.4f %16.2f %10d" % (size, elapsed,
+                                           elapsed * 1e6 / size,
+                                           len(queries) // repeat))
+
+
+def bench_comment_tree_api(sizes=(100, 1000, 5000), repeat=3):
+    """
+    Time the comment tree API view against the flat comment list API view
+    for growing comment counts, and count the queries they run.
+    """
+    from django.core.urlresolvers import reverse
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection, transaction
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from django.utils import timezone
+
+    from django_comments_xtd.models import XtdComment
+    from django_comments_xtd.tests.models import Article
+
+    ctype = ContentType.objects.get_for_model(Article)
+    client = Client()
+    next_id = XtdComment.objects.count() + 1
+
+    print("CommentList and CommentTree API views")
+    print("%10s %12s %12s %12s %12s" % ("comments", "list secs", "tree secs",
+                                        "list queries", "tree queries"))
+    for size in sizes:
+        article = Article.objects.create(title="Article %d" % size,
+                                         slug="article-%d" % size,
+                                         body="Lorem ipsum")
+        comments = build_thread(size, replies_per_comment=size // 10)
+        with transaction.atomic():
+            for comment in comments:
+                comment.id = comment.comment_ptr_id = comment.id + next_id
+                comment.parent_id += next_id
+                comment.thread_id += next_id
+                comment.content_type_id = ctype.pk
+                comment.object_pk = str(article.pk)
+                comment.site_id = 1
+                comment.comment = "Comment %d" % comment.id
+                comment.submit_date = timezone.now()
+                comment.save(force_insert=True)
+        next_id += size
+        kwargs = {'content_type': 'tests-article', 'object_pk': article.pk}
+        timings = []
+        for name in ["comments-xtd-api-list", "comments-xtd-api-tree"]:
+            url = reverse(name, kwargs=kwargs)
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as queries:
+                elapsed = min(timeit.repeat(lambda: client.get(url),
+                                            number=1, repeat=repeat))
+            timings.append((elapsed, len(queries) // repeat))
+        print("%10d %12.4f %12.4f %12d %12d" % (
+            size, timings[0][0], timings[1][0], timings[0][1], timings[1][1]))
+
+
+def main(argv=None):
+    setup_django()
+    bench_tree_from_queryset()
+    setup_test_database()
+    bench_read_comment_serializer()
+    bench_comment_tree_api()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,30 @@
 from datetime import datetime
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
 
+from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.test import TestCase as DjangoTestCase
-
-from django_comments_xtd.models import (XtdComment,
-                                        MaxThreadLevelExceededException)
+from django.core.management import call_command
+from django.db import connection
+from django.test import (RequestFactory, TestCase as DjangoTestCase,
+                         TransactionTestCase)
+from django.test.utils import CaptureQueriesContext
+from django.utils import six
+
+from django_comments.models import CommentFlag
+from django_comments.views.moderation import perform_flag
+
+from django_comments_xtd import cache
+from django_comments_xtd.models import (XtdComment, FollowupSubscription,
+                                        MaxThreadLevelExceededException,
+                                        LIKEDIT_FLAG, DISLIKEDIT_FLAG,
+                                        rebuild_flag_counters,
+                                        rebuild_thread_paths,
+                                        thread_path_segment)
+from django_comments_xtd.views import perform_like, perform_dislike
 from django_comments_xtd.tests.models import Article, Diary
 
 
@@ -407,3 +426,338 @@ class DiaryBaseTestCase(DjangoTestCase):
                                       comment="cmt to cmt to day in diary",
                                       submit_date=datetime.now(),
                                       parent_id=1)  # already max thread level
+
+
+class TreeFromQuerySetTestCase(ArticleBaseTestCase):
+    def setUp(self):
+        super(TreeFromQuerySetTestCase, self).setUp()
+        thread_test_step_1(self.article_1)
+        thread_test_step_2(self.article_1)
+        thread_test_step_3(self.article_1)
+        thread_test_step_4(self.article_1)
+        thread_test_step_5(self.article_1)
+
+    def ids_tree(self, dic_list):
+        return [(item['comment'].id, self.ids_tree(item['children']))
+                for item in dic_list]
+
+    def test_tree_from_queryset(self):
+        # See ThreadStep5TestCase to get a quick view of the thread structure.
+        tree = XtdComment.tree_from_queryset(XtdComment.objects.all())
+        self.assertEqual(self.ids_tree(tree), [
+            (1, [(3, [(8, [])]), (4, [(7, [])])]),
+            (2, [(5, [(6, [])])]),
+            (9, [])
+        ])
+
+    def test_tree_from_queryset_skips_replies_to_missing_parents(self):
+        # Comment 4 is not in the queryset, so comment 7 can't be placed.
+        qs = XtdComment.objects.exclude(pk=4)
+        tree = XtdComment.tree_from_queryset(qs)
+        self.assertEqual(self.ids_tree(tree), [
+            (1, [(3, [(8, [])])]),
+            (2, [(5, [(6, [])])]),
+            (9, [])
+        ])
+
+    def test_tree_from_queryset_with_many_replies(self):
+        from django_comments_xtd.tests.benchmarks import build_thread
+
+        # Threads of 111 comments: 1 + 10 replies + 10 replies to each reply.
+        comments = build_thread(2000, replies_per_comment=10)
+        tree = XtdComment.tree_from_queryset(comments)
+
+        def count(dic_list):
+            return sum(1 + count(item['children']) for item in dic_list)
+
+        self.assertEqual(count(tree), 2000)
+        self.assertEqual(len(tree), 19)
+        self.assertEqual(len(tree[0]['children']), 10)
+        self.assertEqual(len(tree[0]['children'][9]['children']), 10)
+
+    def counts_tree(self, dic_list):
+        return [(item['comment'].id, item['children_count'],
+                 self.counts_tree(item['children']))
+                for item in dic_list]
+
+    def test_tree_from_queryset_with_depth(self):
+        qs = XtdComment.objects.all()
+        with self.assertNumQueries(2):
+            tree = XtdComment.tree_from_queryset(qs, depth=2)
+        self.assertEqual(self.counts_tree(tree), [
+            (1, 2, [(3, 1, []), (4, 1, [])]),
+            (2, 1, [(5, 1, [])]),
+            (9, 0, [])
+        ])
+
+    def test_tree_from_queryset_with_max_replies(self):
+        tree = XtdComment.tree_from_queryset(XtdComment.objects.all(),
+                                             max_replies=1)
+        self.assertEqual(self.counts_tree(tree), [
+            (1, 2, [(3, 1, [(8, 0, [])])]),
+            (2, 1, [(5, 1, [(6, 0, [])])]),
+            (9, 0, [])
+        ])
+
+    def test_tree_from_queryset_with_parent(self):
+        parent = XtdComment.objects.get(pk=1)
+        qs = XtdComment.objects.filter(thread_id=1, level__gt=0)
+        tree = XtdComment.tree_from_queryset(qs, parent=parent, depth=1)
+        self.assertEqual(self.counts_tree(tree), [(3, 1, []), (4, 1, [])])
+
+
+class TreeFromQuerySetWithFlagsTestCase(ArticleBaseTestCase):
+    def setUp(self):
+        super(TreeFromQuerySetWithFlagsTestCase, self).setUp()
+        thread_test_step_1(self.article_1)
+        thread_test_step_2(self.article_1)
+        thread_test_step_3(self.article_1)
+        thread_test_step_4(self.article_1)
+        thread_test_step_5(self.article_1)
+        self.alice = User.objects.create_user("alice", "alice@tester.com",
+                                              "pwd")
+        self.bob = User.objects.create_user("bob", "bob@tester.com", "pwd")
+        for comment_id, user, flag in [
+                (1, self.alice, LIKEDIT_FLAG),
+                (1, self.bob, LIKEDIT_FLAG),
+                (3, self.bob, DISLIKEDIT_FLAG),
+                (8, self.alice, CommentFlag.SUGGEST_REMOVAL)]:
+            CommentFlag.objects.create(comment_id=comment_id, user=user,
+                                       flag=flag)
+
+    def test_tree_from_queryset_queries_do_not_depend_on_size(self):
+        # One query for the comments, one for all of their flags.
+        with self.assertNumQueries(2):
+            tree = XtdComment.tree_from_queryset(
+                XtdComment.objects.all(), with_feedback=True,
+                with_flagging=True, user=AnonymousUser())
+        self.assertEqual(set(tree[0]['likedit_users']),
+                         set([self.alice, self.bob]))
+        c3 = tree[0]['children'][0]
+        self.assertEqual(c3['dislikedit_users'], [self.bob])
+        self.assertFalse(c3['children'][0]['flagged'])
+
+    def test_tree_from_queryset_marks_user_feedback(self):
+        tree = XtdComment.tree_from_queryset(
+            XtdComment.objects.all(), with_feedback=True,
+            with_flagging=True, user=self.alice)
+        c1 = tree[0]
+        c8 = c1['children'][0]['children'][0]
+        self.assertTrue(c1['likedit'])
+        self.assertFalse('dislikedit' in c1)
+        self.assertTrue(c8['flagged'])
+        self.assertFalse('flagged_count' in c8)
+
+    def test_prefetch_users_flagging(self):
+        comments = XtdComment.prefetch_users_flagging(
+            XtdComment.objects.filter(pk__in=[1, 3]), [LIKEDIT_FLAG])
+        with self.assertNumQueries(0):
+            self.assertEqual(len(comments[0].users_flagging(LIKEDIT_FLAG)), 2)
+            self.assertTrue(comments[0].is_flagged_by(self.bob, LIKEDIT_FLAG))
+            self.assertFalse(comments[1].is_flagged_by(self.bob,
+                                                       LIKEDIT_FLAG))
+        # Flags not prefetched are still read from the database.
+        with self.assertNumQueries(1):
+            self.assertEqual(comments[1].users_flagging(DISLIKEDIT_FLAG),
+                             [self.bob])
+
+
+class FlagCountersTestCase(ArticleBaseTestCase):
+    def setUp(self):
+        super(FlagCountersTestCase, self).setUp()
+        thread_test_step_1(self.article_1)
+        self.alice = User.objects.create_user("alice", "alice@tester.com",
+                                              "pwd")
+        self.bob = User.objects.create_user("bob", "bob@tester.com", "pwd")
+
+    def counters(self, pk=1):
+        comment = XtdComment.objects.get(pk=pk)
+        return (comment.likedit_count, comment.dislikedit_count,
+                comment.flagged_count)
+
+    def test_like_dislike_and_flag_update_counters(self):
+        comment = XtdComment.objects.get(pk=1)
+        alice_request = RequestFactory().post('/')
+        alice_request.user = self.alice
+        bob_request = RequestFactory().post('/')
+        bob_request.user = self.bob
+
+        perform_like(alice_request, comment)
+        perform_like(bob_request, comment)
+        self.assertEqual(self.counters(), (2, 0, 0))
+        perform_dislike(bob_request, comment)  # Removes bob's like.
+        self.assertEqual(self.counters(), (1, 1, 0))
+        perform_like(alice_request, comment)  # Toggles alice's like.
+        self.assertEqual(self.counters(), (0, 1, 0))
+        perform_flag(alice_request, comment)
+        perform_flag(alice_request, comment)  # Flags only once.
+        self.assertEqual(self.counters(), (0, 1, 1))
+        self.assertEqual(self.counters(pk=2), (0, 0, 0))
+
+    def test_rebuild_flag_counters(self):
+        for user, flag in [(self.alice, LIKEDIT_FLAG),
+                           (self.bob, LIKEDIT_FLAG),
+                           (self.bob, CommentFlag.SUGGEST_REMOVAL)]:
+            CommentFlag.objects.create(comment_id=1, user=user, flag=flag)
+        CommentFlag.objects.create(comment_id=2, user=self.bob,
+                                   flag=DISLIKEDIT_FLAG)
+        XtdComment.objects.update(likedit_count=7, flagged_count=0)
+        self.assertEqual(rebuild_flag_counters(), 2)
+        self.assertEqual(self.counters(pk=1), (2, 0, 1))
+        self.assertEqual(self.counters(pk=2), (0, 1, 0))
+
+    def test_counters_do_not_go_below_zero(self):
+        flag = CommentFlag.objects.create(comment_id=1, user=self.bob,
+                                          flag=LIKEDIT_FLAG)
+        XtdComment.objects.update(likedit_count=0)
+        flag.delete()
+        self.assertEqual(self.counters(), (0, 0, 0))
+
+
+def path(*ids):
+    return ''.join(thread_path_segment(cid) for cid in ids)
+
+
+class ThreadPathTestCase(ArticleBaseTestCase):
+    def post_comments(self):
+        thread_test_step_1(self.article_1)
+        thread_test_step_2(self.article_1)
+        thread_test_step_3(self.article_1)
+        thread_test_step_4(self.article_1)
+        thread_test_step_5(self.article_1)
+
+    def test_thread_path_is_kept_with_default_ordering(self):
+        self.post_comments()
+        paths = dict(XtdComment.objects.values_list('pk', 'thread_path'))
+        self.assertEqual(paths[1], path(1))
+        self.assertEqual(paths[8], path(1, 3, 8))
+        self.assertEqual(paths[6], path(2, 5, 6))
+        self.assertEqual(paths[9], path(9))
+
+    @patch.multiple('django_comments_xtd.conf.settings',
+                    COMMENTS_XTD_THREAD_ORDERING='path',
+                    COMMENTS_XTD_LIST_ORDER=('thread_id', 'thread_path'))
+    def test_path_ordering(self):
+        thread_test_step_1(self.article_1)
+        thread_test_step_2(self.article_1)
+        thread_test_step_3(self.article_1)
+        thread_test_step_4(self.article_1)
+        # Comment 8 is a reply in the middle of thread 1. Saving comments
+        # 8 and 9 updates their two rows each, and no other comment.
+        with CaptureQueriesContext(connection) as ctx:
+            thread_test_step_5(self.article_1)
+        updates = [q['sql'] for q in ctx.captured_queries
+                   if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 4)
+        # Same order as in ThreadStep5TestCase.
+        self.assertEqual(
+            [comment.pk for comment in XtdComment.objects.all()],
+            [1, 3, 8, 4, 7, 2, 5, 6, 9])
+        self.assertEqual(
+            set(XtdComment.objects.values_list('order', flat=True)), set([1]))
+
+    def test_rebuild_thread_paths(self):
+        self.post_comments()
+        XtdComment.objects.filter(pk__in=[3, 6, 9]).update(thread_path='')
+        self.assertEqual(rebuild_thread_paths(), 3)
+        paths = dict(XtdComment.objects.values_list('pk', 'thread_path'))
+        self.assertEqual(paths[3], path(1, 3))
+        self.assertEqual(paths[8], path(1, 3, 8))
+        self.assertEqual(paths[6], path(2, 5, 6))
+        self.assertEqual(paths[9], path(9))
+        self.assertEqual(rebuild_thread_paths(), 0)
+
+
+class FollowupSubscriptionTestCase(ArticleBaseTestCase):
+    def post_comment(self, email, followup=True, is_public=True):
+        article_ct = ContentType.objects.get_for_model(Article)
+        return XtdComment.objects.create(content_type=article_ct,
+                                         object_pk=self.article_1.pk,
+                                         site=Site.objects.get_current(),
+                                         user_name=email.split("@")[0],
+                                         user_email=email, followup=followup,
+                                         is_public=is_public,
+                                         comment="comment by %s" % email,
+                                         submit_date=datetime.now())
+
+    def subscriptions(self):
+        return list(FollowupSubscription.objects.order_by('user_email')
+                    .values_list('user_email', 'comment_id'))
+
+    def test_comments_subscribe_their_authors(self):
+        bob_1 = self.post_comment("bob@example.com")
+        self.post_comment("alice@example.com", followup=False)
+        self.post_comment("carol@example.com", is_public=False)
+        self.assertEqual(self.subscriptions(), [("bob@example.com", bob_1.pk)])
+        # The subscription refers to the last comment of the follower.
+        bob_2 = self.post_comment("bob@example.com")
+        self.assertEqual(self.subscriptions(), [("bob@example.com", bob_2.pk)])
+
+    def test_unpublished_and_deleted_comments(self):
+        bob_1 = self.post_comment("bob@example.com")
+        bob_2 = self.post_comment("bob@example.com")
+        bob_2.is_public = False
+        bob_2.save()
+        self.assertEqual(self.subscriptions(), [("bob@example.com", bob_1.pk)])
+        bob_1.delete()
+        self.assertEqual(self.subscriptions(), [])
+
+
+def post_comment_to(article):
+    article_ct = ContentType.objects.get_for_model(Article)
+    return XtdComment.objects.create(content_type=article_ct,
+                                     object_pk=article.pk,
+                                     site=Site.objects.get_current(),
+                                     user_name="bob",
+                                     user_email="bob@example.com",
+                                     comment="Nice article",
+                                     submit_date=datetime.now())
+
+
+class CacheInvalidationTestCase(ArticleBaseTestCase):
+    @patch('django_comments_xtd.models.invalidate_comment_caches')
+    def test_only_comments_and_flags_invalidate_caches(self, mock_invalidate):
+        Article.objects.create(title="November", slug="november",
+                               body="Before the winter")
+        self.assertFalse(mock_invalidate.called)
+        comment = post_comment_to(self.article_1)
+        self.assertTrue(mock_invalidate.called)
+        mock_invalidate.reset_mock()
+        User.objects.create(username="alice")
+        self.assertFalse(mock_invalidate.called)
+        CommentFlag.objects.create(comment=comment,
+                                   user=User.objects.get(username="alice"),
+                                   flag=LIKEDIT_FLAG)
+        self.assertTrue(mock_invalidate.called)
+
+    def test_version_is_not_bumped_before_commit(self):
+        article_ct = ContentType.objects.get_for_model(Article)
+        version = cache.get_version(article_ct.pk, self.article_1.pk)
+        post_comment_to(self.article_1)  # Inside the test transaction.
+        self.assertEqual(cache.get_version(article_ct.pk, self.article_1.pk),
+                         version)
+
+
+class CacheInvalidationOnCommitTestCase(TransactionTestCase):
+    def test_version_is_bumped_on_commit(self):
+        article = Article.objects.create(title="September",
+                                         slug="september",
+                                         body="During September...")
+        article_ct = ContentType.objects.get_for_model(Article)
+        version = cache.get_version(article_ct.pk, article.pk)
+        post_comment_to(article)
+        self.assertNotEqual(cache.get_version(article_ct.pk, article.pk),
+                            version)
+
+
+class IndexReportTestCase(DjangoTestCase):
+    def test_queries_use_the_expected_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("Plans are checked on SQLite only.")
+        out = six.StringIO()
+        call_command('xtdcomment_index_report', stdout=out)
+        report = out.getvalue()
+        self.assertIn("django_comments: django_comments_xtd_object_idx",
+                      report)
+        self.assertIn("All the queries use the expected indexes.", report)
+        self.assertNotIn("WARNING", report)
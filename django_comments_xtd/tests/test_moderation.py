@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 import re
+import tempfile
 
 try:
     from unittest.mock import patch
@@ -10,6 +11,7 @@ from datetime import datetime, timedelta
 
 import django
 from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 
@@ -18,8 +20,12 @@ try:
 except ImportError:
     from django.contrib.comments.models import CommentFlag
 
-from django_comments_xtd import django_comments
-from django_comments_xtd.models import LIKEDIT_FLAG, DISLIKEDIT_FLAG
+from django_comments_xtd import cache, django_comments
+from django_comments_xtd.models import (LIKEDIT_FLAG, DISLIKEDIT_FLAG,
+                                        BlackListedDomain, TmpXtdComment)
+from django_comments_xtd.moderation import (BlackListedDomainSet,
+                                            SpamModerator,
+                                            blacklisted_domains)
 from django_comments_xtd.tests.models import Diary
 
 
@@ -337,3 +343,101 @@ class FlaggingLikedItAndDislikedIt(TestCase):
                                            user=user,
                                            flag=DISLIKEDIT_FLAG)
         self.assert_(flags.count() == 1)
+
+
+class BlackListedDomainSetTestCase(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        blacklisted_domains.expire()
+        BlackListedDomain.objects.create(domain="example.com")
+        self.domains = BlackListedDomainSet()
+
+    def test_subdomains_match(self):
+        self.assertIn("example.com", self.domains)
+        self.assertIn("Mail.Example.COM", self.domains)
+        self.assertNotIn("anexample.com", self.domains)
+        self.assertNotIn("com", self.domains)
+        self.assertNotIn("", self.domains)
+
+    def test_lookups_do_not_query(self):
+        self.domains.load()
+        with self.assertNumQueries(0):
+            for i in range(10):
+                self.assertNotIn("%d.example.org" % i, self.domains)
+
+    def test_reload_on_change(self):
+        self.assertNotIn("example.org", blacklisted_domains)
+        domain = BlackListedDomain.objects.create(domain="example.org")
+        self.assertIn("example.org", blacklisted_domains)
+        domain.delete()
+        self.assertNotIn("example.org", blacklisted_domains)
+
+    def test_reload_on_version_change(self):
+        # Changes made by other processes are noticed through the version
+        # in the cache, once check_interval seconds have passed.
+        self.domains.load()
+        BlackListedDomain.objects.bulk_create(
+            [BlackListedDomain(domain="example.org")])
+        cache.bump_blacklist_version()
+        self.assertNotIn("example.org", self.domains)
+        self.domains.check_interval = 0
+        self.assertIn("example.org", self.domains)
+
+    def test_spam_moderator(self):
+        spam_moderator = SpamModerator(Diary)
+        diary = Diary.objects.create(body="Lorem ipsum",
+                                     allow_comments=True)
+        for email, allowed in [("bob@mail.example.com", False),
+                               ("bob@example.org", True),
+                               ("bob", False)]:
+            comment = TmpXtdComment(user_email=email)
+            self.assertEqual(spam_moderator.allow(comment, diary, None),
+                             allowed)
+
+    def test_non_ascii_domains(self):
+        BlackListedDomain.objects.create(domain="xn--bcher-kva.example")
+        self.assertIn("bücher.example", self.domains)
+        self.assertIn("mail.Bücher.example", self.domains)
+        self.assertIn("xn--bcher-kva.example", self.domains)
+        self.assertNotIn("bucher.example", self.domains)
+        # Labels that can't be encoded don't spoil the rest of the domain.
+        self.assertIn("%s.bücher.example" % ("a" * 64), self.domains)
+        comment = TmpXtdComment(user_email="spam@bücher.example")
+        diary = Diary.objects.create(body="Lorem ipsum",
+                                     allow_comments=True)
+        self.assertFalse(SpamModerator(Diary).allow(comment, diary, None))
+
+    def load(self, content, *args):
+        with tempfile.NamedTemporaryFile('wb', suffix='.txt') as domains:
+            domains.write(content.encode('utf8'))
+            domains.flush()
+            with patch('sys.stdout'):
+                call_command('load_blacklisted_domains', domains.name, *args)
+        return sorted(BlackListedDomain.objects.values_list('domain',
+                                                            flat=True))
+
+    def test_load_command(self):
+        self.assertEqual(self.load("# Spammers\nexample.com\nExample.org.\n"
+                                   "\nspam@example.net # address\n"
+                                   "not a domain\nbücher.example\n"),
+                         ["example.com", "example.net", "example.org",
+                          "xn--bcher-kva.example"])
+        self.assertIn("www.example.org", blacklisted_domains)
+
+    def test_load_command_deletes(self):
+        BlackListedDomain.objects.create(domain="example.com")  # Duplicate.
+        BlackListedDomain.objects.create(domain="example.org")
+        # Duplicates are deleted, domains not listed are kept.
+        self.assertEqual(self.load("example.net\n"),
+                         ["example.com", "example.net", "example.org"])
+        self.assertEqual(self.load("example.org\nexample.net\n", "--delete",
+                                   "--dry-run"),
+                         ["example.com", "example.net", "example.org"])
+        self.assertEqual(self.load("example.org\nexample.net\n", "--delete"),
+                         ["example.net", "example.org"])
+        self.assertNotIn("example.com", blacklisted_domains)
+
+    def test_load_command_does_not_delete_all(self):
+        self.assertRaises(CommandError, self.load, "not a domain\n",
+                          "--delete")
+        self.assertEqual(self.load(""), ["example.com"])
@@ -4,10 +4,17 @@ except ImportError:
     from mock import patch
 import unittest
 
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.template import Context, Template, TemplateSyntaxError
 from django.test import TestCase as DjangoTestCase
+from django.test.utils import CaptureQueriesContext
 
+from django_comments.models import CommentFlag
+
+from django_comments_xtd import cache
+from django_comments_xtd.models import LIKEDIT_FLAG, XtdComment
 from django_comments_xtd.tests.models import Article, Diary
 from django_comments_xtd.tests.test_models import (
     thread_test_step_1, thread_test_step_2, thread_test_step_3,
@@ -39,6 +46,57 @@ class GetXtdCommentCountTestCase(DjangoTestCase):
         self.assertEqual(Template(t).render(Context()), '3')
         
 
+# Invalidate caches at once, instead of when the test transaction commits.
+@patch('django_comments_xtd.models.on_commit', lambda func, using=None: func())
+class GetXtdCommentCountsTestCase(DjangoTestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.article_1 = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.article_2 = Article.objects.create(
+            title="October", slug="october", body="What I did on October...")
+        self.day_in_diary = Diary.objects.create(body="About Today...")
+        thread_test_step_1(self.article_1)
+        add_comment_to_diary_entry(self.day_in_diary)
+        self.template = Template(
+            "{% load comments_xtd %}"
+            "{% get_xtdcomment_counts for object_list as pairs %}"
+            "{% for obj, count in pairs %}{{ obj.pk }}:{{ count }} {% endfor %}")
+        self.context = {'object_list': [self.article_1, self.article_2,
+                                        self.day_in_diary]}
+
+    def test_get_xtdcomment_counts(self):
+        self.assertEqual(self.template.render(Context(self.context)),
+                         '1:2 2:0 1:1 ')
+        # One query per content type.
+        with self.assertNumQueries(2):
+            self.template.render(Context(self.context))
+
+    @patch.multiple('django_comments_xtd.conf.settings',
+                    COMMENTS_XTD_COUNT_CACHE_TIMEOUT=300)
+    def test_get_xtdcomment_counts_from_cache(self):
+        self.template.render(Context(self.context))
+        with self.assertNumQueries(0):
+            output = self.template.render(Context(self.context))
+        self.assertEqual(output, '1:2 2:0 1:1 ')
+        thread_test_step_2(self.article_1)
+        self.assertEqual(self.template.render(Context(self.context)),
+                         '1:4 2:0 1:1 ')
+
+    @patch.multiple('django_comments_xtd.conf.settings',
+                    COMMENTS_XTD_COUNT_CACHE_TIMEOUT=300)
+    def test_counts_are_cached_per_site(self):
+        self.template.render(Context(self.context))
+        with patch.multiple('django_comments_xtd.conf.settings', SITE_ID=2):
+            self.assertEqual(self.template.render(Context(self.context)),
+                             '1:0 2:0 1:0 ')
+
+    def test_wrong_syntax(self):
+        self.assertRaises(TemplateSyntaxError, Template,
+                          "{% load comments_xtd %}"
+                          "{% get_xtdcomment_counts object_list as pairs %}")
+
+
 class LastXtdCommentsTestCase(DjangoTestCase):
     def setUp(self):
         self.article = Article.objects.create(
@@ -122,4 +180,107 @@ class XtdCommentsTestCase(DjangoTestCase):
         self.assertTrue(pos_c1 < pos_c3 < pos_c8 <
                         pos_c4 < pos_c7 < pos_c2 <
                         pos_c5 < pos_c6 < pos_c9)
+
+    @patch.multiple('django_comments_xtd.conf.settings',
+                    COMMENTS_XTD_TREE_DEPTH=2,
+                    COMMENTS_XTD_TREE_MAX_REPLIES=1)
+    def test_render_xtdcomment_tree_limited(self):
+        t = ("{% load comments_xtd %}"
+             "{% render_xtdcomment_tree for object %}")
+        output = Template(t).render(Context({'object': self.article,
+                                             'user': AnonymousUser()}))
+        # Comments 1, 3, 2, 5 and 9, with links to the replies left out.
+        self.assertEqual(output.count('<a name='), 5)
+        self.assertNotIn('<a name="c4"></a>', output)
+        for thread_id, parent_id in [(1, 1), (1, 3), (2, 5)]:
+            self.assertIn(reverse('comments-xtd-replies',
+                                  args=(thread_id, parent_id)), output)
         
+
+@patch.multiple('django_comments_xtd.conf.settings',
+                COMMENTS_XTD_TREE_CACHE_TIMEOUT=300)
+# Invalidate caches at once, instead of when the test transaction commits.
+@patch('django_comments_xtd.models.on_commit', lambda func, using=None: func())
+class RenderXtdCommentTreeCacheTestCase(DjangoTestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        thread_test_step_1(self.article)
+        self.template = Template("{% load comments_xtd %}"
+                                 "{% render_xtdcomment_tree for object %}")
+
+    def render(self, user=None):
+        return self.template.render(Context({
+            'object': self.article, 'user': user or AnonymousUser()}))
+
+    def test_output_is_cached(self):
+        output = self.render()
+        self.assertEqual(output.count('<a name='), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(), output)
+
+    def test_cache_disabled(self):
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_TREE_CACHE_TIMEOUT=0):
+            self.render()
+            with self.assertNumQueries(1):
+                self.render()
+
+    def test_new_comment_invalidates_cache(self):
+        self.render()
+        thread_test_step_2(self.article)
+        self.assertEqual(self.render().count('<a name='), 4)
+
+    def test_removal_invalidates_cache(self):
+        self.render()
+        comment = XtdComment.objects.get(pk=1)
+        comment.is_removed = True
+        comment.save()
+        self.assertEqual(
+            self.render().count('This comment has been removed.'), 1)
+
+    def test_feedback_invalidates_cache(self):
+        template = Template("{% load comments_xtd %}"
+                            "{% render_xtdcomment_tree for object "
+                            "   allow_feedback show_feedback %}")
+        context = {'object': self.article, 'user': AnonymousUser()}
+        output = template.render(Context(context))
+        user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        CommentFlag.objects.create(user=user, comment_id=1,
+                                   flag=LIKEDIT_FLAG)
+        self.assertNotEqual(template.render(Context(context)), output)
+
+    def test_users_share_the_output(self):
+        user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        output = self.render()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.render(user), output)
+        for query in queries.captured_queries:
+            self.assertNotIn('django_comments_xtd_xtdcomment', query['sql'])
+
+    def test_user_state_is_filled_in(self):
+        template = Template("{% load comments_xtd %}"
+                            "{% render_xtdcomment_tree for object "
+                            "   allow_feedback allow_flagging %}")
+        user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        CommentFlag.objects.create(user=user, comment_id=1,
+                                   flag=LIKEDIT_FLAG)
+        CommentFlag.objects.create(user=user, comment_id=2,
+                                   flag=CommentFlag.SUGGEST_REMOVAL)
+        liked = 'href="%s" class=""' % reverse('comments-xtd-like', args=[1])
+        anonymous_output = template.render(Context({
+            'object': self.article, 'user': AnonymousUser()}))
+        self.assertNotIn(liked, anonymous_output)
+        self.assertNotIn('comment flagged', anonymous_output)
+        with CaptureQueriesContext(connection) as queries:
+            output = template.render(Context({
+                'object': self.article, 'user': user}))
+        for query in queries.captured_queries:
+            self.assertNotIn('django_comments_xtd_xtdcomment', query['sql'])
+        self.assertIn(liked, output)
+        self.assertEqual(output.count('comment flagged'), 1)
+        self.assertNotIn('xtd-user-state', output)
+        self.assertEqual(template.render(Context({
+            'object': self.article, 'user': AnonymousUser()})),
+            anonymous_output)
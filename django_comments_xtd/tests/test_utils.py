@@ -0,0 +1,111 @@
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+import threading
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import TestCase
+
+from django_comments_xtd.utils import (MailDispatcher, _build_mail,
+                                       send_messages_in_chunks)
+
+
+def build_mails(count):
+    return [_build_mail("Subject %d" % i, "Body", "from@example.com",
+                        ["to%d@example.com" % i]) for i in range(count)]
+
+
+class MailDispatcherTestCase(TestCase):
+    def test_send(self):
+        dispatcher = MailDispatcher(workers=2, batch_size=3)
+        for message in build_mails(10):
+            dispatcher.send(message)
+        dispatcher.shutdown()
+        self.assertEqual(len(mail.outbox), 10)
+        stats = dispatcher.stats()
+        self.assertEqual(stats['sent'], 10)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_dead_workers_are_replaced(self):
+        dispatcher = MailDispatcher(workers=2)
+        dispatcher.send(build_mails(1)[0])
+        # Stop the workers behind the dispatcher's back, as a crash would.
+        for thread in dispatcher._threads:
+            dispatcher._queue.put(dispatcher._stop)
+        for thread in dispatcher._threads:
+            thread.join()
+        dispatcher.send(build_mails(1)[0])
+        dispatcher.shutdown()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_workers_are_started_after_fork(self):
+        dispatcher = MailDispatcher(workers=2)
+        dispatcher.send(build_mails(1)[0])
+        dispatcher.shutdown()
+        # The threads of the parent process look alive in the child, but
+        # they aren't running there.
+        parent_threads = dispatcher._threads = [threading.current_thread()]
+        with patch('django_comments_xtd.utils.os.getpid', return_value=-1):
+            dispatcher.send(build_mails(1)[0])
+            self.assertEqual(len(dispatcher._threads), 2)
+            self.assertNotIn(parent_threads[0], dispatcher._threads)
+            dispatcher.shutdown()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_full_queue(self):
+        # Without workers the second email doesn't fit in the queue,
+        # and it is sent by the calling thread.
+        dispatcher = MailDispatcher(workers=0, queue_size=1, queue_timeout=0)
+        for message in build_mails(2):
+            dispatcher.send(message)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, "Subject 1")
+        self.assertEqual(dispatcher.stats()['queue_depth'], 1)
+
+
+class FlakyEmailBackend(EmailBackend):
+    """Fail to send the second email it gets."""
+    def __init__(self, *args, **kwargs):
+        super(FlakyEmailBackend, self).__init__(*args, **kwargs)
+        self.calls = 0
+        self.closed = 0
+
+    def send_messages(self, messages):
+        self.calls += 1
+        if self.calls == 2:
+            raise IOError("Connection lost")
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+    def close(self):
+        self.closed += 1
+
+
+@patch.multiple('django_comments_xtd.conf.settings',
+                COMMENTS_XTD_MAIL_CHUNK_SIZE=3,
+                COMMENTS_XTD_MAIL_CHUNK_RETRIES=1)
+class SendMessagesInChunksTestCase(TestCase):
+    def test_chunks_are_retried(self):
+        connection = FlakyEmailBackend()
+        sent, failed = send_messages_in_chunks(build_mails(7), connection)
+        self.assertEqual((sent, failed), (7, 0))
+        # Only the email that failed is sent again, through a new
+        # connection, and every email is sent once.
+        self.assertEqual(connection.calls, 8)
+        self.assertEqual(connection.closed, 1)
+        self.assertEqual([m.subject for m in mail.outbox],
+                         ["Subject %d" % i for i in range(7)])
+
+    def test_failed_chunks(self):
+        connection = FlakyEmailBackend()
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_MAIL_CHUNK_RETRIES=0):
+            sent, failed = send_messages_in_chunks(build_mails(7),
+                                                   connection,
+                                                   fail_silently=True)
+        # The first chunk gives up on the two emails left to send.
+        self.assertEqual((sent, failed), (5, 2))
+        self.assertEqual([m.subject for m in mail.outbox],
+                         ["Subject %d" % i for i in (0, 3, 4, 5, 6)])
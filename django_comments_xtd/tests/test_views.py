@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import json
 import re
 import random
 import string
@@ -7,20 +8,37 @@ try:
     from unittest.mock import patch
 except ImportError:
     from mock import patch
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, Permission, User
+from django.core import mail
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import translation
 # from django.test.utils import override_settings
 
-from django_comments_xtd import django_comments, signals, signed
+from django_comments_xtd import cache, django_comments, signals, signed, views
+from django_comments_xtd.api.serializers import ReadCommentSerializer
 from django_comments_xtd.conf import settings
-from django_comments_xtd.models import XtdComment
+from django_comments_xtd.events import InProcessEventBroker, get_event_broker
+from django_comments.models import CommentFlag
+
+from django_comments_xtd.models import (LIKEDIT_FLAG, FollowupNotification,
+                                        FollowupSubscription, XtdComment,
+                                        confirmation_digest)
 from django_comments_xtd.tests.models import Article, Diary
+from django_comments_xtd.tests.test_models import (add_comment_to_diary_entry,
+                                                   thread_test_step_1,
+                                                   thread_test_step_2,
+                                                   thread_test_step_3,
+                                                   thread_test_step_4,
+                                                   thread_test_step_5)
 
 
 class OnCommentWasPostedTestCase(TestCase):
@@ -53,11 +71,46 @@ class OnCommentWasPostedTestCase(TestCase):
         self.assert_(self.mock_mailer.call_count == 1)
         self.assertTemplateUsed(self.response, "comments/posted.html")
 
+    def test_simultaneous_posts_as_authenticated_user(self):
+        # Both requests find that the comment doesn't exist yet, but only
+        # one of them can create it.
+        User.objects.create_user("bob", "bob@example.com", "pwd")
+        self.client.login(username="bob", password="pwd")
+        with patch('django_comments_xtd.views.confirmation_digest',
+                   return_value="0" * 64):
+            self.post_valid_data()
+            with patch('django_comments_xtd.views._comment_exists',
+                       return_value=False):
+                self.post_valid_data()
+        self.assertEqual(self.response.status_code, 200)
+        self.assertEqual(XtdComment.objects.count(), 1)
+
+    def test_simultaneous_posts_to_the_api(self):
+        User.objects.create_user("bob", "bob@example.com", "pwd")
+        self.client.login(username="bob", password="pwd")
+        data = {"name": "Bob", "email": "bob@example.com", "followup": True,
+                "reply_to": 0, "honeypot": "",
+                "comment": "Es war einmal eine kleine..."}
+        data.update(self.form.initial)
+        url = reverse("comments-xtd-api-create")
+        with patch('django_comments_xtd.views.confirmation_digest',
+                   return_value="0" * 64):
+            self.assertEqual(self.client.post(url, data=data).status_code,
+                             201)
+            with patch('django_comments_xtd.views._comment_exists',
+                       return_value=False):
+                response = self.client.post(url, data=data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(XtdComment.objects.count(), 1)
+
 
 class ConfirmCommentTestCase(TestCase):
     def setUp(self):
         patcher = patch('django_comments_xtd.views.send_mail')
         self.mock_mailer = patcher.start()
+        mass_patcher = patch('django_comments_xtd.views.send_mass_mail')
+        self.mock_mass_mailer = mass_patcher.start()
+        self.addCleanup(mass_patcher.stop)
         # Create random string so that it's harder for zlib to compress
         content = ''.join(random.choice(string.printable) for _ in range(6096))
         self.article = Article.objects.create(title="September",
@@ -100,6 +153,25 @@ class ConfirmCommentTestCase(TestCase):
         self.get_confirm_comment_url(self.key)
         self.assertContains(self.response, "404", status_code=404)
 
+    def test_confirmed_comment_has_confirmation_digest(self):
+        tmp_comment = views._load_key(self.key)
+        self.get_confirm_comment_url(self.key)
+        comment = XtdComment.objects.get()
+        self.assertEqual(comment.confirmation_digest,
+                         confirmation_digest(tmp_comment))
+        self.assertEqual(comment.confirmation_digest,
+                         confirmation_digest(comment))
+
+    def test_simultaneous_confirmations(self):
+        # Both requests find that the comment doesn't exist yet, but only
+        # one of them can create it.
+        self.get_confirm_comment_url(self.key)
+        with patch('django_comments_xtd.views._comment_exists',
+                   return_value=False):
+            self.get_confirm_comment_url(self.key)
+        self.assertContains(self.response, "404", status_code=404)
+        self.assertEqual(XtdComment.objects.count(), 1)
+
     def test_signal_receiver_may_discard_the_comment(self):
         # test that receivers of signal confirmation_received may return False
         # and thus rendering a template_discarded output
@@ -119,7 +191,7 @@ class ConfirmCommentTestCase(TestCase):
         # and redirects to the article detail page
         Site.objects.get_current().domain = "testserver"  # django bug #7743
         self.get_confirm_comment_url(self.key)
-        data = signed.loads(self.key, extra_key=settings.COMMENTS_XTD_SALT)
+        data = views._load_key(self.key)
         try:
             comment = XtdComment.objects.get(
                 content_type=data["content_type"],
@@ -132,6 +204,31 @@ class ConfirmCommentTestCase(TestCase):
         redirected_to = 'http://testserver%s' % self.article.get_absolute_url()
         self.assertRedirects(self.response, redirected_to)
 
+    def test_confirmation_key_is_not_pickled(self):
+        self.assertTrue(self.key.startswith("2."))
+        data = signed.loads_json(self.key,
+                                 extra_key=settings.COMMENTS_XTD_SALT)
+        self.assertEqual(data["user_email"], "bob@example.com")
+        self.assertNotIn("content_object", data)
+
+    def test_content_object_is_fetched_lazily(self):
+        with self.assertNumQueries(0):
+            tmp_comment = views._load_key(self.key)
+        with self.assertNumQueries(1):
+            self.assertEqual(tmp_comment.content_object, self.article)
+
+    def test_pickled_confirmation_key(self):
+        # Keys sent by previous versions are accepted while
+        # COMMENTS_XTD_ACCEPT_PICKLED_KEYS is True.
+        key = signed.dumps(views._load_key(self.key), compress=True,
+                           extra_key=settings.COMMENTS_XTD_SALT).decode()
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_ACCEPT_PICKLED_KEYS=False):
+            self.get_confirm_comment_url(key)
+            self.assertEqual(self.response.status_code, 404)
+        self.get_confirm_comment_url(key)
+        self.assertEqual(XtdComment.objects.count(), 1)
+
     def test_notify_comment_followers(self):
         # send a couple of comments to the article with followup=True and check
         # that when the second comment is confirmed a followup notification
@@ -152,9 +249,13 @@ class ConfirmCommentTestCase(TestCase):
         self.key = re.search(r'http://.+/confirm/(?P<key>[\S]+)/',
                              self.mock_mailer.call_args[0][1]).group("key")
         self.get_confirm_comment_url(self.key)
-        self.assertEqual(self.mock_mailer.call_count, 3)
-        self.assert_(self.mock_mailer.call_args[0][3] == ["bob@example.com"])
-        self.assert_(self.mock_mailer.call_args[0][1].find(
+        self.assertEqual(self.mock_mailer.call_count, 2)
+        # all the followers are notified at once
+        self.assertEqual(self.mock_mass_mailer.call_count, 1)
+        messages = self.mock_mass_mailer.call_args[0][0]
+        self.assertEqual(len(messages), 1)
+        self.assert_(messages[0][3] == ["bob@example.com"])
+        self.assert_(messages[0][1].find(
             "There is a new comment following up yours.") > -1)
 
     def test_notify_followers_dupes(self):
@@ -195,9 +296,12 @@ class ConfirmCommentTestCase(TestCase):
         self.key = re.search(r'http://.+/confirm/(?P<key>[\S]+)/',
                              self.mock_mailer.call_args[0][1]).group("key")
         self.get_confirm_comment_url(self.key)
-        self.assertEqual(self.mock_mailer.call_count, 4)
-        self.assert_(self.mock_mailer.call_args[0][3] == ["bob@example.com"])
-        self.assert_(self.mock_mailer.call_args[0][1].find(
+        self.assertEqual(self.mock_mailer.call_count, 3)
+        self.assertEqual(self.mock_mass_mailer.call_count, 1)
+        messages = self.mock_mass_mailer.call_args[0][0]
+        self.assertEqual(len(messages), 1)
+        self.assert_(messages[0][3] == ["bob@example.com"])
+        self.assert_(messages[0][1].find(
             "There is a new comment following up yours.") > -1)
 
     def test_no_notification_for_same_user_email(self):
@@ -220,6 +324,7 @@ class ConfirmCommentTestCase(TestCase):
                              self.mock_mailer.call_args[0][1]).group("key")
         self.get_confirm_comment_url(self.key)
         self.assertEqual(self.mock_mailer.call_count, 2)
+        self.assertEqual(self.mock_mass_mailer.call_count, 0)
 
 
 class ReplyNoCommentTestCase(TestCase):
@@ -269,6 +374,76 @@ class ReplyCommentTestCase(TestCase):
         self.assertEqual(response.status_code, 403)
 
 
+@patch.multiple('django_comments_xtd.conf.settings',
+                COMMENTS_XTD_TREE_DEPTH=1)
+class RepliesTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        thread_test_step_1(self.article)
+        thread_test_step_2(self.article)
+        thread_test_step_3(self.article)
+        thread_test_step_4(self.article)
+        thread_test_step_5(self.article)
+
+    def test_replies(self):
+        url = reverse("comments-xtd-replies", args=(1, 1))
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, "django_comments_xtd/replies.html")
+        # Replies 3 and 4, one level down, and links to theirs.
+        self.assertContains(response, '<a name="c', count=2)
+        self.assertContains(response, '<a name="c4"></a>')
+        self.assertContains(
+            response, reverse("comments-xtd-replies", args=(1, 4)))
+
+    def test_replies_ajax(self):
+        url = reverse("comments-xtd-replies", args=(1, 4))
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertTemplateNotUsed(response, "django_comments_xtd/replies.html")
+        self.assertContains(response, '<a name="c', count=1)
+        self.assertContains(response, '<a name="c7"></a>')
+
+    def test_replies_are_cut_in_thread_order(self):
+        # A second reply to comment 3, that comes after comment 8.
+        reply = XtdComment.objects.create(
+            content_type=ContentType.objects.get_for_model(Article),
+            object_pk=self.article.pk, site_id=1, parent_id=3,
+            comment="comment 10 to comment 3", submit_date=datetime.now())
+        url = reverse("comments-xtd-replies", args=(1, 1))
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_LIST_ORDER=('-submit_date',),
+                            COMMENTS_XTD_TREE_DEPTH=2,
+                            COMMENTS_XTD_TREE_MAX_REPLIES=1):
+            response = self.client.get(url)
+        self.assertContains(response, '<a name="c8"></a>')
+        self.assertNotContains(response, '<a name="c%d"></a>' % reply.pk)
+
+    def test_replies_in_path_order(self):
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_THREAD_ORDERING='path',
+                            COMMENTS_XTD_TREE_DEPTH=2):
+            # Replies in path mode keep the default order, 1.
+            reply = XtdComment.objects.create(
+                content_type=ContentType.objects.get_for_model(Article),
+                object_pk=self.article.pk, site_id=1, parent_id=3,
+                comment="comment 10 to comment 3", submit_date=datetime.now())
+            self.assertEqual(reply.order, 1)
+            url = reverse("comments-xtd-replies", args=(1, 1))
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+        self.assertTrue(any('ORDER BY' in q['sql'] and
+                            '"thread_path" ASC' in q['sql']
+                            for q in queries.captured_queries))
+        content = response.content.decode('utf-8')
+        positions = [content.index('<a name="c%d"></a>' % pk)
+                     for pk in (3, 8, reply.pk, 4, 7)]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_replies_to_other_thread_raise_404(self):
+        url = reverse("comments-xtd-replies", args=(2, 1))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
 class MuteFollowUpsTestCase(TestCase):
 
     def setUp(self):
@@ -277,6 +452,9 @@ class MuteFollowUpsTestCase(TestCase):
         # Second comment has to send one notification (to Bob).
         patcher = patch('django_comments_xtd.views.send_mail')
         self.mock_mailer = patcher.start()
+        mass_patcher = patch('django_comments_xtd.views.send_mass_mail')
+        self.mock_mass_mailer = mass_patcher.start()
+        self.addCleanup(mass_patcher.stop)
         self.article = Article.objects.create(
             title="September", slug="september", body="John's September")
         self.form = django_comments.get_form()(self.article)
@@ -304,10 +482,11 @@ class MuteFollowUpsTestCase(TestCase):
         self.get_confirm_comment_url(alicekey)  # confirm Alice's comment
 
         # Bob receives a follow-up notification
-        self.assert_(self.mock_mailer.call_count == 3)
+        self.assert_(self.mock_mass_mailer.call_count == 1)
+        messages = self.mock_mass_mailer.call_args[0][0]
+        self.assert_(messages[0][3] == ["bob@example.com"])
         self.bobs_mutekey = str(re.search(
-            r'http://.+/mute/(?P<key>[\S]+)/',
-            self.mock_mailer.call_args[0][1]).group("key"))
+            r'http://.+/mute/(?P<key>[\S]+)/', messages[0][1]).group("key"))
         self.addCleanup(patcher.stop)
 
     def get_confirm_comment_url(self, key):
@@ -331,13 +510,41 @@ class MuteFollowUpsTestCase(TestCase):
         data.update(self.form.initial)
         self.client.post(reverse("comments-post-comment"), data=data)
         # Alice confirms her comment...
-        self.assert_(self.mock_mailer.call_count == 4)
+        self.assert_(self.mock_mailer.call_count == 3)
         alicekey = str(re.search(r'http://.+/confirm/(?P<key>[\S]+)/',
                                  self.mock_mailer.call_args[0][1]).group("key"))
         self.get_confirm_comment_url(alicekey)  # confirm Alice's comment
         # Alice confirmed her comment, but this time Bob won't receive any
         # notification, neither do Alice being the sender
-        self.assert_(self.mock_mailer.call_count == 4)
+        self.assert_(self.mock_mailer.call_count == 3)
+        self.assert_(self.mock_mass_mailer.call_count == 1)
+
+    def test_mute_key_is_short_and_stable(self):
+        subscription = FollowupSubscription.objects.get(
+            user_email="bob@example.com")
+        self.assertEqual(self.bobs_mutekey, subscription.get_mute_key())
+        self.assertLess(len(self.bobs_mutekey), 64)
+
+    def test_mute_key_with_bad_hmac(self):
+        self.get_mute_followup_url(self.bobs_mutekey[:-1] + "0")
+        self.assertEqual(self.response.status_code, 404)
+        self.assertEqual(FollowupSubscription.objects.count(), 2)
+
+    def test_mute_twice(self):
+        self.get_mute_followup_url(self.bobs_mutekey)
+        self.assertEqual(self.response.status_code, 200)
+        self.get_mute_followup_url(self.bobs_mutekey)
+        self.assertEqual(self.response.status_code, 404)
+
+    def test_legacy_mute_key(self):
+        # Mute links sent in earlier versions keep working.
+        comment = XtdComment.objects.get(user_email="bob@example.com")
+        key = signed.dumps(comment, compress=True,
+                           extra_key=settings.COMMENTS_XTD_SALT)
+        self.get_mute_followup_url(key)
+        self.assertEqual(self.response.status_code, 200)
+        self.assertFalse(FollowupSubscription.objects.filter(
+            user_email="bob@example.com").exists())
 
 
 class HTMLDisabledMailTestCase(TestCase):
@@ -369,3 +576,497 @@ class HTMLDisabledMailTestCase(TestCase):
         self.client.post(reverse("comments-post-comment"), data=self.data)
         self.assert_(self.mock_mailer.call_count == 1)
         self.assert_(self.mock_mailer.call_args[1]['html'] is not None)
+
+
+class CommentCountsTestCase(TestCase):
+    def setUp(self):
+        self.article_1 = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.article_2 = Article.objects.create(
+            title="October", slug="october", body="What I did on October...")
+        thread_test_step_1(self.article_1)
+
+    def test_comment_counts(self):
+        url = reverse("comments-xtd-api-counts",
+                      kwargs={'content_type': 'tests-article'})
+        response = self.client.get(url, {'pks': '%d,%d' % (
+            self.article_1.pk, self.article_2.pk)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8')),
+                         {str(self.article_1.pk): 2,
+                          str(self.article_2.pk): 0})
+
+    def test_comment_count(self):
+        url = reverse("comments-xtd-api-count",
+                      kwargs={'content_type': 'tests-article',
+                              'object_pk': self.article_1.pk})
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content.decode('utf-8')),
+                         {'count': 2})
+
+    def test_other_sites_are_left_out(self):
+        site = Site.objects.create(domain="example.org", name="example.org")
+        XtdComment.objects.create(content_type=ContentType.objects.get(
+                                      app_label="tests", model="article"),
+                                  object_pk=self.article_1.pk,
+                                  site=site, comment="comment to other site",
+                                  submit_date=datetime.now())
+        kwargs = {'content_type': 'tests-article',
+                  'object_pk': self.article_1.pk}
+        response = self.client.get(reverse("comments-xtd-api-count",
+                                           kwargs=kwargs))
+        self.assertEqual(json.loads(response.content.decode('utf-8')),
+                         {'count': 2})
+        response = self.client.get(reverse("comments-xtd-api-list",
+                                           kwargs=kwargs))
+        self.assertEqual(len(json.loads(response.content.decode('utf-8'))),
+                         2)
+
+
+# Invalidate caches at once, instead of when the test transaction commits.
+@patch('django_comments_xtd.models.on_commit', lambda func, using=None: func())
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        thread_test_step_1(self.article)
+        kwargs = {'content_type': 'tests-article',
+                  'object_pk': self.article.pk}
+        self.list_url = reverse("comments-xtd-api-list", kwargs=kwargs)
+        self.count_url = reverse("comments-xtd-api-count", kwargs=kwargs)
+
+    def test_not_modified(self):
+        for url in [self.list_url, self.count_url]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.has_header('ETag'))
+            self.assertIn('no-cache', response['Cache-Control'])
+            with self.assertNumQueries(0):
+                response = self.client.get(
+                    url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_modified(self):
+        etags = [self.client.get(url)['ETag']
+                 for url in [self.list_url, self.count_url]]
+        thread_test_step_2(self.article)
+        for url, etag in zip([self.list_url, self.count_url], etags):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_varies_by_user(self):
+        etag = self.client.get(self.list_url)['ETag']
+        User.objects.create_user("bob", "bob@example.com", "pwd")
+        self.client.login(username="bob", password="pwd")
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+@patch('django_comments_xtd.api.views.DELTA_OVERLAP', timedelta(0))
+class CommentListDeltaTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        thread_test_step_1(self.article)
+        self.url = reverse("comments-xtd-api-list",
+                           kwargs={'content_type': 'tests-article',
+                                   'object_pk': self.article.pk})
+
+    def get_delta(self, since):
+        response = self.client.get(self.url, {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_full_list(self):
+        delta = self.get_delta('')
+        self.assertEqual([c['id'] for c in delta['comments']], [1, 2])
+        self.assertEqual(delta['removed'], [])
+        self.assertTrue(delta['since'])
+
+    def test_new_and_changed_comments(self):
+        since = self.get_delta('')['since']
+        self.assertEqual(self.get_delta(since)['comments'], [])
+        thread_test_step_2(self.article)
+        user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        CommentFlag.objects.create(user=user, comment_id=2,
+                                   flag=LIKEDIT_FLAG)
+        delta = self.get_delta(since)
+        self.assertEqual(sorted(c['id'] for c in delta['comments']),
+                         [2, 3, 4])
+        self.assertEqual(delta['removed'], [])
+
+    def test_removed_comments(self):
+        since = self.get_delta('')['since']
+        comment = XtdComment.objects.get(pk=2)
+        comment.is_public = False
+        comment.save()
+        delta = self.get_delta(since)
+        self.assertEqual(delta['comments'], [])
+        self.assertEqual(delta['removed'], [2])
+
+    def test_invalid_since(self):
+        response = self.client.get(self.url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+@patch.multiple('django_comments_xtd.conf.settings',
+                COMMENTS_XTD_API_THREADS_PER_PAGE=2,
+                COMMENTS_XTD_API_REPLIES_PER_PAGE=2)
+class ThreadCursorPaginationTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        thread_test_step_1(self.article)
+        thread_test_step_2(self.article)
+        thread_test_step_3(self.article)
+        thread_test_step_4(self.article)
+        thread_test_step_5(self.article)
+        self.url = reverse("comments-xtd-api-list",
+                           kwargs={'content_type': 'tests-article',
+                                   'object_pk': self.article.pk})
+
+    def get_page(self, url, data=None):
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_pages_of_threads(self):
+        page = self.get_page(self.url)
+        # Thread 1 is cut short after 2 replies, thread 2 is whole.
+        self.assertEqual([c['id'] for c in page['comments']],
+                         [1, 3, 8, 2, 5, 6])
+        self.assertEqual(list(page['replies']), ['1'])
+        page = self.get_page(page['next'])
+        self.assertEqual([c['id'] for c in page['comments']], [9])
+        self.assertEqual(page['replies'], {})
+        self.assertIsNone(page['next'])
+
+    def test_replies(self):
+        url = self.get_page(self.url)['replies']['1']
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_API_REPLIES_PER_PAGE=1):
+            page = self.get_page(url)
+            self.assertEqual([c['id'] for c in page['comments']], [4])
+            page = self.get_page(page['next'])
+        self.assertEqual([c['id'] for c in page['comments']], [7])
+        self.assertIsNone(page['next'])
+
+    @patch.multiple('django_comments_xtd.conf.settings',
+                    COMMENTS_XTD_LIST_ORDER=('-thread_id', 'order'))
+    def test_newest_threads_first(self):
+        page = self.get_page(self.url)
+        self.assertEqual([c['id'] for c in page['comments']], [9, 2, 5, 6])
+        page = self.get_page(page['next'])
+        self.assertEqual([c['id'] for c in page['comments']], [1, 3, 8])
+
+    def test_full_list_with_since(self):
+        page = self.get_page(self.url, {'since': ''})
+        self.assertEqual(len(page['comments']), 6)
+        self.assertTrue(page['since'])
+        self.assertNotIn('since=', page['next'])
+        # Changes are not paginated.
+        page = self.get_page(self.url, {'since': page['since']})
+        self.assertNotIn('next', page)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_disabled(self):
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_API_THREADS_PER_PAGE=0):
+            self.assertEqual(len(self.get_page(self.url)), 9)
+
+
+class CommentTreeTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        thread_test_step_1(self.article)
+        thread_test_step_2(self.article)
+        thread_test_step_3(self.article)
+        thread_test_step_4(self.article)
+        thread_test_step_5(self.article)
+
+    def get_tree(self, content_type, object_pk):
+        url = reverse("comments-xtd-api-tree",
+                      kwargs={'content_type': content_type,
+                              'object_pk': object_pk})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def ids_tree(self, items):
+        return [(item['comment']['id'], self.ids_tree(item['children']))
+                for item in items]
+
+    def test_tree(self):
+        # See test_models.py, ThreadStep5TestCase for the thread structure.
+        tree = self.get_tree('tests-article', self.article.pk)
+        self.assertEqual(self.ids_tree(tree), [
+            (1, [(3, [(8, [])]), (4, [(7, [])])]),
+            (2, [(5, [(6, [])])]),
+            (9, [])
+        ])
+        self.assertEqual(tree[0]['comment']['comment'],
+                         "comment 1 to article")
+
+    def test_tree_of_other_content_type(self):
+        diary = Diary.objects.create(body="About Today...")
+        add_comment_to_diary_entry(diary)
+        tree = self.get_tree('tests-diary', diary.pk)
+        self.assertEqual(self.ids_tree(tree), [(10, [])])
+        self.assertEqual(self.get_tree('tests-unknown', diary.pk), [])
+
+    def test_feedback(self):
+        # Comments to diary entries allow feedback, see tests/settings.py.
+        diary = Diary.objects.create(body="About Today...")
+        add_comment_to_diary_entry(diary)
+        user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        CommentFlag.objects.create(user=user, comment_id=10,
+                                   flag=LIKEDIT_FLAG)
+        self.client.login(username="bob", password="pwd")
+        flags = self.get_tree('tests-diary', diary.pk)[0]['comment']['flags']
+        self.assertTrue(flags['like']['active'])
+        self.assertEqual(flags['like']['users'], ["%d:bob" % user.pk])
+
+    def test_queries_do_not_depend_on_size(self):
+        url = reverse("comments-xtd-api-tree",
+                      kwargs={'content_type': 'tests-article',
+                              'object_pk': self.article.pk})
+        # Comments and flags. The first request caches the content type.
+        self.client.get(url)
+        with self.assertNumQueries(2):
+            self.client.get(url)
+
+
+@patch.multiple('django_comments_xtd.conf.settings',
+                COMMENTS_XTD_API_STREAMING=True)
+@patch('django_comments_xtd.api.views.STREAM_CHUNK_SIZE', 2)
+@patch('django_comments_xtd.api.views.DELTA_OVERLAP', timedelta(0))
+class StreamingCommentListTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        thread_test_step_1(self.article)
+        thread_test_step_2(self.article)
+        thread_test_step_3(self.article)
+        self.url = reverse("comments-xtd-api-list",
+                           kwargs={'content_type': 'tests-article',
+                                   'object_pk': self.article.pk})
+
+    def get_streamed(self, data=None):
+        response = self.client.get(self.url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        content = b''.join(response.streaming_content)
+        return json.loads(content.decode('utf-8'))
+
+    def test_list(self):
+        comments = self.get_streamed()
+        self.assertEqual([c['id'] for c in comments], [1, 3, 4, 2, 5])
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_API_STREAMING=False):
+            response = self.client.get(self.url)
+        self.assertEqual(json.loads(response.content.decode('utf-8')),
+                         comments)
+
+    def test_list_with_since(self):
+        delta = self.get_streamed({'since': ''})
+        self.assertEqual([c['id'] for c in delta['comments']],
+                         [1, 3, 4, 2, 5])
+        self.assertEqual(delta['removed'], [])
+        delta = self.get_streamed({'since': delta['since']})
+        self.assertEqual(delta['comments'], [])
+
+    def test_empty_list(self):
+        XtdComment.objects.all().delete()
+        self.assertEqual(self.get_streamed(), [])
+
+
+class InProcessEventBrokerTestCase(TestCase):
+    def test_wait_for_events(self):
+        broker = InProcessEventBroker()
+        last_event_id = broker.last_event_id("1:1")
+        broker.publish("1:1", "update", {"version": "1"})
+        broker.publish("1:2", "update", {"version": "2"})
+        events = broker.wait("1:1", last_event_id, 0)
+        self.assertEqual(events, [(last_event_id + 1, "update",
+                                   {"version": "1"})])
+        self.assertEqual(broker.wait("1:1", last_event_id + 1, 0.01), [])
+
+
+@patch.multiple('django_comments_xtd.conf.settings',
+                COMMENTS_XTD_LIVE_UPDATES=True,
+                COMMENTS_XTD_EVENT_STREAM_TIMEOUT=0.1)
+# Invalidate caches at once, instead of when the test transaction commits.
+@patch('django_comments_xtd.models.on_commit', lambda func, using=None: func())
+class CommentEventsTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.url = reverse("comments-xtd-api-events",
+                           kwargs={'content_type': 'tests-article',
+                                   'object_pk': self.article.pk})
+
+    def test_stream_events(self):
+        broker = get_event_broker()
+        last_event_id = broker.last_event_id(None)
+        thread_test_step_1(self.article)
+        response = self.client.get(self.url,
+                                   HTTP_LAST_EVENT_ID=str(last_event_id))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn("id: %d\nevent: update\n" % (last_event_id + 1),
+                      content)
+
+    def test_live_updates_disabled(self):
+        with patch.multiple('django_comments_xtd.conf.settings',
+                            COMMENTS_XTD_LIVE_UPDATES=False):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+class ReadCommentSerializerTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.moderator = User.objects.create_user("joe", "joe@example.com",
+                                                  "pwd")
+        self.moderator.user_permissions.add(
+            Permission.objects.get(content_type__app_label="django_comments",
+                                   codename="can_moderate"))
+        self.request = RequestFactory().get("/")
+        self.request.user = AnonymousUser()
+
+    def post_comments(self, count):
+        article_ct = ContentType.objects.get_for_model(Article)
+        for i in range(count):
+            XtdComment.objects.create(content_type=article_ct,
+                                      object_pk=self.article.pk,
+                                      site_id=1, user=self.moderator,
+                                      comment="comment %d" % i,
+                                      submit_date=datetime.now())
+
+    def serialize(self):
+        return ReadCommentSerializer(XtdComment.objects.all(), many=True,
+                                     context={'request': self.request}).data
+
+    def test_user_moderator(self):
+        self.post_comments(2)
+        self.assertEqual([c['user_moderator'] for c in self.serialize()],
+                         [True, True])
+
+    def test_submit_date(self):
+        self.post_comments(1)
+        comment = XtdComment.objects.get()
+        comment.submit_date = datetime(2017, 5, 18, 9, 19, 30)
+        comment.save()
+        data = self.serialize()[0]
+        self.assertEqual(data['submit_date'], "May 18, 2017, 9:19 a.m.")
+        self.assertEqual(data['submit_date_iso'], "2017-05-18T09:19:30")
+        with translation.override('es'):
+            self.assertEqual(self.serialize()[0]['submit_date'],
+                             "18 de Mayo de 2017 a las 09:19")
+
+    def test_queries_do_not_grow_with_comments(self):
+        # Comments, flags and the author's user and group permissions.
+        self.post_comments(2)
+        with self.assertNumQueries(4):
+            self.serialize()
+        self.post_comments(10)
+        with self.assertNumQueries(4):
+            self.serialize()
+
+
+@patch.multiple('django_comments_xtd.conf.settings',
+                COMMENTS_XTD_NOTIFICATION_OUTBOX=True,
+                COMMENTS_XTD_SEND_HTML_EMAIL=False)
+class FollowupNotificationOutboxTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(
+            title="September", slug="september", body="John's September")
+        self.bobs_comment = self.post_comment("Bob", "bob@example.com")
+
+    def post_comment(self, name, email):
+        article_ct = ContentType.objects.get_for_model(Article)
+        return XtdComment.objects.create(content_type=article_ct,
+                                         object_pk=self.article.pk,
+                                         site_id=1, user_name=name,
+                                         user_email=email, followup=True,
+                                         comment="Nice September",
+                                         submit_date=datetime.now())
+
+    @patch('django_comments_xtd.views.send_mass_mail')
+    def test_notifications_are_written_down(self, mock_mass_mailer):
+        comment = self.post_comment("Alice", "alice@example.com")
+        views.notify_comment_followers(comment)
+        self.assertEqual(mock_mass_mailer.call_count, 0)
+        self.assertEqual(
+            list(FollowupNotification.objects.values_list('comment_id',
+                                                          flat=True)),
+            [comment.pk])
+
+    def test_send_followup_notifications(self):
+        views.notify_comment_followers(
+            self.post_comment("Alice", "alice@example.com"))
+        views.notify_comment_followers(
+            self.post_comment("Charlie", "charlie@example.com"))
+        self.assertEqual(views.send_followup_notifications(), (2, 0))
+        self.assertEqual(FollowupNotification.objects.count(), 0)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ["alice@example.com", "bob@example.com",
+                          "bob@example.com"])
+
+    @patch('django_comments_xtd.views.send_messages_in_chunks',
+           return_value=(0, 1))
+    def test_failed_notifications_are_retried(self, mock_send):
+        views.notify_comment_followers(
+            self.post_comment("Alice", "alice@example.com"))
+        self.assertEqual(views.send_followup_notifications(), (0, 1))
+        notification = FollowupNotification.objects.get()
+        self.assertEqual(notification.attempts, 1)
+        # Claimed by the first attempt.
+        self.assertEqual(views.send_followup_notifications(), (0, 0))
+        notification.claimed_until = None
+        notification.save()
+        self.assertEqual(views.send_followup_notifications(), (0, 1))
+        self.assertEqual(
+            views.send_followup_notifications(max_attempts=2), (0, 0))
+        self.assertEqual(FollowupNotification.objects.get().attempts, 2)
+
+    def test_followers_notified_are_not_notified_again(self):
+        self.post_comment("Charlie", "charlie@example.com")
+        views.notify_comment_followers(
+            self.post_comment("Alice", "alice@example.com"))
+        send = views.send_messages_in_chunks
+        calls = []
+
+        def fail_second_email(messages, connection):
+            calls.append(messages)
+            if len(calls) == 2:
+                return 0, 1
+            return send(messages, connection)
+
+        with patch('django_comments_xtd.views.send_messages_in_chunks',
+                   side_effect=fail_second_email):
+            self.assertEqual(views.send_followup_notifications(), (0, 1))
+        notification = FollowupNotification.objects.get()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(notification.sent_to, mail.outbox[0].to[0])
+        notification.claimed_until = None
+        notification.save()
+        self.assertEqual(views.send_followup_notifications(), (1, 0))
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ["bob@example.com", "charlie@example.com"])
+
+    def test_command(self):
+        views.notify_comment_followers(
+            self.post_comment("Alice", "alice@example.com"))
+        with patch('sys.stdout'):
+            call_command('send_followup_notifications', batch_size=1)
+        self.assertEqual(FollowupNotification.objects.count(), 0)
+        self.assertEqual(len(mail.outbox), 1)
@@ -3,7 +3,6 @@ from django.conf.urls import include, url
 from rest_framework.urlpatterns import format_suffix_patterns
 
 from django_comments_xtd import api, views
-from django_comments_xtd.api.views import ApiCommentsView
 
 urlpatterns = [
     url(r'^sent/$', views.sent, name='comments-xtd-sent'),
@@ -11,6 +10,8 @@ urlpatterns = [
         name='comments-xtd-confirm'),
     url(r'^mute/(?P<key>[^/]+)/$', views.mute, name='comments-xtd-mute'),
     url(r'^reply/(?P<cid>[\d]+)/$', views.reply, name='comments-xtd-reply'),
+    url(r'^replies/(?P<thread_id>[\d]+)/(?P<parent_id>[\d]+)/$',
+        views.replies, name='comments-xtd-replies'),
 
     # Remap comments-flag to check allow-flagging is enabled.
     url(r'^flag/(\d+)/$', views.flag, name='comments-flag'),
@@ -25,14 +26,18 @@ urlpatterns = [
         name='comments-xtd-api-create'),
     url(r'^api/(?P<content_type>\w+[-]{1}\w+)/(?P<object_pk>[0-9]+)/$',
         api.CommentList.as_view(), name='comments-xtd-api-list'),
+    url(r'^api/(?P<content_type>\w+[-]{1}\w+)/(?P<object_pk>[0-9]+)/tree/$',
+        api.CommentTree.as_view(), name='comments-xtd-api-tree'),
     url(r'^api/(?P<content_type>\w+[-]{1}\w+)/(?P<object_pk>[0-9]+)/count/$',
         api.CommentCount.as_view(), name='comments-xtd-api-count'),
+    url(r'^api/(?P<content_type>\w+[-]{1}\w+)/(?P<object_pk>[0-9]+)/events/$',
+        views.comment_events, name='comments-xtd-api-events'),
+    url(r'^api/(?P<content_type>\w+[-]{1}\w+)/count/$',
+        api.CommentCounts.as_view(), name='comments-xtd-api-counts'),
     url(r'^api/feedback/$', api.ToggleFeedbackFlag.as_view(),
         name='comments-xtd-api-feedback'),
     url(r'^api/flag/$', api.CreateReportFlag.as_view(),
         name='comments-xtd-api-flag'),
-    url(r'^api/comment-list/(?P<content_type>\w+[-]{1}\w+)/(?P<object_pk>[0-9]+)/$',
-        view=ApiCommentsView.as_view(), name='comments-xtd-api-list-2'),
 
     url(r'', include("django_comments.urls")),
 ]
@@ -6,59 +6,259 @@ try:
 except ImportError:
     import queue as queue  # python3
 
+import atexit
+import logging
+import os
 import threading
+import time
 
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.contrib.contenttypes.models import ContentType
 
 from django_comments_xtd.conf import settings
 
 
+logger = logging.getLogger(__name__)
+
 mail_sent_queue = queue.Queue()
 
 
-class EmailThread(threading.Thread):
-    def __init__(self, subject, body, from_email, recipient_list,
-                 fail_silently, html):
-        self.subject = subject
-        self.body = body
-        self.recipient_list = recipient_list
-        self.from_email = from_email
-        self.fail_silently = fail_silently
-        self.html = html
-        threading.Thread.__init__(self)
+def send_messages_in_chunks(messages, connection=None, fail_silently=False):
+    """
+    Send the email messages through the same connection, in chunks of
+    COMMENTS_XTD_MAIL_CHUNK_SIZE messages. The messages are handed to the
+    connection one by one, so that when one fails the messages sent before
+    it are not sent again. The messages of a chunk left to send are sent
+    again, through a new connection, up to COMMENTS_XTD_MAIL_CHUNK_RETRIES
+    times. Returns the number of messages sent and the number of messages
+    that could not be sent.
+    """
+    chunk_size = settings.COMMENTS_XTD_MAIL_CHUNK_SIZE
+    retries = settings.COMMENTS_XTD_MAIL_CHUNK_RETRIES
+    close_connection = connection is None
+    if connection is None:
+        connection = get_connection()
+    sent, failed = 0, 0
+    try:
+        for i in range(0, len(messages), chunk_size):
+            pending = messages[i:i+chunk_size]
+            for attempt in range(retries + 1):
+                try:
+                    connection.open()
+                    while pending:
+                        sent += connection.send_messages(pending[:1]) or 0
+                        pending = pending[1:]
+                except Exception:
+                    connection.close()
+                    if attempt < retries:
+                        continue
+                    failed += len(pending)
+                    if not fail_silently:
+                        logger.exception("Cannot send %d email(s).",
+                                         len(pending))
+                break
+    finally:
+        if close_connection:
+            connection.close()
+    return sent, failed
 
-    def run(self):
-        _send_mail(self.subject, self.body, self.from_email,
-                   self.recipient_list, self.fail_silently, self.html)
-        mail_sent_queue.put(True)
 
+class MailDispatcher(object):
+    """
+    Send emails from a fixed pool of worker threads, fed by a bounded
+    queue. Each worker sends the emails waiting in the queue, up to
+    batch_size groups of them, through the same connection.
 
-def _send_mail(subject, body, from_email, recipient_list,
-               fail_silently=False, html=None):
+    When the queue is full, send() and send_many() wait up to
+    queue_timeout seconds for room, and then send the emails in the
+    calling thread.
+
+    Workers are started again when they are no longer running, like in a
+    process forked from the one that started them.
+    """
+    _stop = object()
+
+    def __init__(self, workers=2, queue_size=1000, queue_timeout=5,
+                 batch_size=50):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._sent = 0
+        self._failed = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+
+    def _after_fork(self):
+        # Threads don't survive a fork, and the lock might have been held
+        # by one of them. The emails in the queue are sent by the parent.
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._threads = []
+
+    def _is_running(self):
+        return (self._pid == os.getpid() and
+                len(self._threads) == self.workers and
+                all(thread.is_alive() for thread in self._threads))
+
+    def start(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+        with self._lock:
+            self._threads = [thread for thread in self._threads
+                             if thread.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(
+                    target=self._work, name="django-comments-xtd-mail-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def shutdown(self, timeout=None):
+        """Send the emails left in the queue and stop the workers."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(self._stop)
+        for thread in threads:
+            thread.join(timeout)
+
+    def send(self, message, fail_silently=False):
+        self.send_many([message], fail_silently)
+
+    def send_many(self, messages, fail_silently=False):
+        if not self._is_running():
+            self.start()
+        item = (messages, fail_silently, time.time())
+        try:
+            self._queue.put(item, timeout=self.queue_timeout)
+        except queue.Full:
+            self._send_batch([item])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'sent': self._sent,
+                'failed': self._failed,
+                'average_latency': (self._total_latency / self._sent
+                                    if self._sent else 0.0),
+                'max_latency': self._max_latency,
+            }
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is self._stop:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._stop:
+                    stop = True
+                    break
+                batch.append(item)
+            self._send_batch(batch)
+            if stop:
+                return
+
+    def _send_batch(self, batch):
+        connection = get_connection()
+        try:
+            for messages, fail_silently, queued_at in batch:
+                sent, failed = send_messages_in_chunks(messages, connection,
+                                                       fail_silently)
+                latency = time.time() - queued_at
+                with self._lock:
+                    self._sent += sent
+                    self._failed += failed
+                    self._total_latency += latency * sent
+                    self._max_latency = max(self._max_latency, latency)
+                for i in range(sent):
+                    mail_sent_queue.put(True)
+        finally:
+            connection.close()
+
+
+_mail_dispatcher = None
+_mail_dispatcher_lock = threading.Lock()
+
+
+def get_mail_dispatcher():
+    global _mail_dispatcher
+    with _mail_dispatcher_lock:
+        if _mail_dispatcher is None:
+            _mail_dispatcher = MailDispatcher(
+                workers=settings.COMMENTS_XTD_MAIL_WORKERS,
+                queue_size=settings.COMMENTS_XTD_MAIL_QUEUE_SIZE,
+                queue_timeout=settings.COMMENTS_XTD_MAIL_QUEUE_TIMEOUT,
+                batch_size=settings.COMMENTS_XTD_MAIL_BATCH_SIZE)
+            atexit.register(_mail_dispatcher.shutdown)
+        return _mail_dispatcher
+
+
+def _build_mail(subject, body, from_email, recipient_list, html=None):
     msg = EmailMultiAlternatives(subject, body, from_email, recipient_list)
     if html:
         msg.attach_alternative(html, "text/html")
+    return msg
+
+
+def _send_mail(subject, body, from_email, recipient_list,
+               fail_silently=False, html=None):
+    msg = _build_mail(subject, body, from_email, recipient_list, html)
     msg.send(fail_silently)
 
 
 def send_mail(subject, body, from_email, recipient_list,
               fail_silently=False, html=None):
     if settings.COMMENTS_XTD_THREADED_EMAILS:
-        EmailThread(subject, body, from_email, recipient_list,
-                    fail_silently, html).start()
+        get_mail_dispatcher().send(
+            _build_mail(subject, body, from_email, recipient_list, html),
+            fail_silently)
     else:
         _send_mail(subject, body, from_email, recipient_list,
                    fail_silently, html)
 
 
+def build_mass_mail(datatuple):
+    """
+    Return the email messages for the elements of datatuple, tuples
+    (subject, body, from_email, recipient_list, html), where html may be None.
+    """
+    return [_build_mail(subject, body, from_email, recipient_list, html)
+            for subject, body, from_email, recipient_list, html in datatuple]
+
+
+def send_mass_mail(datatuple, fail_silently=False):
+    """
+    Send many emails through the same connection. Each element of
+    datatuple is a tuple (subject, body, from_email, recipient_list, html),
+    where html may be None.
+    """
+    messages = build_mass_mail(datatuple)
+    if settings.COMMENTS_XTD_THREADED_EMAILS:
+        get_mail_dispatcher().send_many(messages, fail_silently)
+    else:
+        send_messages_in_chunks(messages, fail_silently=fail_silently)
+
+
 def has_app_model_option(comment):
     _default = {
         'allow_flagging': False,
         'allow_feedback': False,
         'show_feedback': False
     }
-    content_type = ContentType.objects.get_for_model(comment.content_object)
+    # Content types are cached, unlike the object the comment is posted to.
+    content_type = ContentType.objects.get_for_id(comment.content_type_id)
     key = "%s.%s" % (content_type.app_label, content_type.model)
     try:
         return settings.COMMENTS_XTD_APP_MODEL_OPTIONS[key]
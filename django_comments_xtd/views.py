@@ -1,14 +1,21 @@
 from __future__ import unicode_literals
+import logging
 import six
+from datetime import timedelta
 
 from django.apps import apps
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.mail import get_connection
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponseForbidden
+from django.db import IntegrityError
+from django.db.models import F, Q
+from django.db.transaction import atomic
+from django.http import Http404, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template import loader
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_protect
 from django.views.generic import ListView
@@ -21,14 +28,27 @@ from django_comments.views.utils import next_redirect, confirmation_view
 from django_comments_xtd import (get_form, comment_was_posted, signals, signed,
                                  get_model as get_comment_model)
 from django_comments_xtd.conf import settings
-from django_comments_xtd.models import (TmpXtdComment,
+from django_comments_xtd.events import (event_channel, get_event_broker,
+                                        stream_events)
+from django_comments_xtd.models import (TmpXtdComment, FollowupNotification,
+                                        FollowupSubscription,
+                                        confirmation_digest,
+                                        get_subscription_by_mute_key,
+                                        thread_ordering,
                                         MaxThreadLevelExceededException,
                                         LIKEDIT_FLAG, DISLIKEDIT_FLAG)
-from django_comments_xtd.utils import send_mail, has_app_model_option
+from django_comments_xtd.utils import (build_mass_mail, send_mail,
+                                       send_mass_mail, send_messages_in_chunks,
+                                       has_app_model_option)
 
 
 XtdComment = get_comment_model()
 
+logger = logging.getLogger(__name__)
+
+# Time a worker has to send the notifications it claims from the outbox.
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=5)
+
 
 def get_moderated_tmpl(cmt):
     return [
@@ -64,25 +84,47 @@ def send_email_confirmation_request(
               [comment.user_email, ], html=html_message)
 
 
+def get_confirmation_key(comment):
+    """Return the key of the confirmation URL of the TmpXtdComment."""
+    return signed.dumps_json(comment.to_dict(), compress=True,
+                             extra_key=settings.COMMENTS_XTD_SALT)
+
+
+def _load_key(key):
+    """
+    Return the TmpXtdComment in a confirmation key. Keys with a pickled
+    comment, made by previous versions, are accepted as long as
+    COMMENTS_XTD_ACCEPT_PICKLED_KEYS is True.
+    """
+    try:
+        return TmpXtdComment.from_dict(
+            signed.loads_json(key, extra_key=settings.COMMENTS_XTD_SALT))
+    except signed.BadSignature:
+        if not settings.COMMENTS_XTD_ACCEPT_PICKLED_KEYS:
+            raise
+    return signed.loads(str(key), extra_key=settings.COMMENTS_XTD_SALT)
+
+
 def _comment_exists(comment):
     """
-    True if exists a XtdComment with same user_name, user_email and submit_date.
+    True if the TmpXtdComment has been posted already, with the same
+    content type, object, user_name, user_email, followup and submit_date.
     """
-    return (XtdComment.objects.filter(
-        user_name=comment.user_name,
-        user_email=comment.user_email,
-        followup=comment.followup,
-        submit_date=comment.submit_date
-    ).count() > 0)
+    return XtdComment.objects.filter(
+        confirmation_digest=confirmation_digest(comment)
+    ).exists()
 
 
 def _create_comment(tmp_comment):
     """
-    Creates a XtdComment from a TmpXtdComment.
+    Creates a XtdComment from a TmpXtdComment. Raises IntegrityError if
+    it has been posted already.
     """
     comment = XtdComment(**tmp_comment)
+    comment.confirmation_digest = confirmation_digest(tmp_comment)
     # comment.is_public = True
-    comment.save()
+    with atomic():
+        comment.save()
     return comment
 
 
@@ -102,7 +144,10 @@ def on_comment_was_posted(sender, comment, request, **kwargs):
             (comment.user and comment.user.is_authenticated())
     ):
         if not _comment_exists(comment):
-            new_comment = _create_comment(comment)
+            try:
+                new_comment = _create_comment(comment)
+            except IntegrityError:  # Posted twice at once.
+                return
             comment.xtd_comment = new_comment
             signals.confirmation_received.send(sender=TmpXtdComment,
                                                comment=comment,
@@ -110,8 +155,7 @@ def on_comment_was_posted(sender, comment, request, **kwargs):
             if comment.is_public:
                 notify_comment_followers(new_comment)
     else:
-        key = signed.dumps(comment, compress=True,
-                           extra_key=settings.COMMENTS_XTD_SALT)
+        key = get_confirmation_key(comment)
         site = get_current_site(request)
         send_email_confirmation_request(comment, key, site)
 
@@ -160,9 +204,8 @@ def sent(request, using=None):
 def confirm(request, key,
             template_discarded="django_comments_xtd/discarded.html"):
     try:
-        tmp_comment = signed.loads(str(key),
-                                   extra_key=settings.COMMENTS_XTD_SALT)
-    except (ValueError, signed.BadSignature):
+        tmp_comment = _load_key(key)
+    except (ValueError, ContentType.DoesNotExist):
         raise Http404
     # the comment does exist if the URL was already confirmed, then: Http404
     if _comment_exists(tmp_comment):
@@ -176,7 +219,10 @@ def confirm(request, key,
         if response is False:
             return render(request, template_discarded, {'comment': tmp_comment})
 
-    comment = _create_comment(tmp_comment)
+    try:
+        comment = _create_comment(tmp_comment)
+    except IntegrityError:  # Confirmed twice at once.
+        raise Http404
     if comment.is_public is False:
         return render(request, get_moderated_tmpl(comment),
                       {'comment': comment})
@@ -186,21 +232,36 @@ def confirm(request, key,
 
 
 def notify_comment_followers(comment):
+    """
+    Send the follow-up notifications of the comment, or, when
+    COMMENTS_XTD_NOTIFICATION_OUTBOX is True, write them down to be sent
+    by the management command send_followup_notifications.
+    """
+    if settings.COMMENTS_XTD_NOTIFICATION_OUTBOX:
+        FollowupNotification.objects.create(comment=comment)
+        return
+    messages = get_followup_messages(comment)
+    if messages:
+        send_mass_mail(messages)
+
+
+def get_followup_messages(comment, until=None):
+    """
+    Return a list of (subject, body, from_email, recipient_list, html)
+    tuples with the emails to send to the followers of the comment, or to
+    those who were following it at the time given in until.
+    """
     followers = {}
 
-    kwargs = {'content_type': comment.content_type,
-              'object_pk': comment.object_pk,
-              'is_public': True,
-              'followup': True}
-    previous_comments = XtdComment.objects\
-                                  .filter(**kwargs)\
-                                  .exclude(user_email=comment.user_email)
+    subscriptions = FollowupSubscription.objects.filter(
+        content_type=comment.content_type, object_pk=comment.object_pk
+    ).exclude(user_email=comment.user_email)
+    if until is not None:
+        subscriptions = subscriptions.filter(created__lte=until)
 
-    for instance in previous_comments:
-        followers[instance.user_email] = (
-            instance.user_name,
-            signed.dumps(instance, compress=True,
-                         extra_key=settings.COMMENTS_XTD_SALT))
+    for subscription in subscriptions:
+        followers[subscription.user_email] = (subscription.user_name,
+                                              subscription.get_mute_key())
 
     # model = apps.get_model(comment.content_type.app_label,
     #                        comment.content_type.model)
@@ -212,20 +273,80 @@ def notify_comment_followers(comment):
         html_message_template = loader.get_template(
             "django_comments_xtd/email_followup_comment.html")
 
+    site = comment.site
+    messages = []
     for email, (name, key) in six.iteritems(followers):
         mute_url = reverse('comments-xtd-mute', args=[key])
         message_context = {'user_name': name,
                            'comment': comment,
                            # 'content_object': target,
                            'mute_url': mute_url,
-                           'site': comment.site}
+                           'site': site}
         text_message = text_message_template.render(message_context)
         if settings.COMMENTS_XTD_SEND_HTML_EMAIL:
             html_message = html_message_template.render(message_context)
         else:
             html_message = None
-        send_mail(subject, text_message, settings.COMMENTS_XTD_FROM_EMAIL,
-                  [email, ], html=html_message)
+        messages.append((subject, text_message,
+                         settings.COMMENTS_XTD_FROM_EMAIL, [email, ],
+                         html_message))
+    return messages
+
+
+def send_followup_notifications(batch_size=100, max_attempts=5):
+    """
+    Claim up to batch_size notifications from the outbox and send them,
+    through a single connection. Notifications sent are deleted, the
+    others are tried again once their claim expires, only to the followers
+    not notified yet. Returns the number of notifications sent and the
+    number of them that failed.
+    """
+    now = timezone.now()
+    available = Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+    candidates = list(FollowupNotification.objects
+                      .filter(available, attempts__lt=max_attempts)
+                      .values_list('pk', flat=True)[:batch_size])
+    claimed = []
+    for pk in candidates:
+        # Other workers may have claimed the notification in the meantime.
+        if FollowupNotification.objects.filter(available, pk=pk).update(
+                claimed_until=now + OUTBOX_CLAIM_TIMEOUT,
+                attempts=F('attempts') + 1):
+            claimed.append(pk)
+    sent, failed = 0, 0
+    connection = get_connection()
+    try:
+        notifications = FollowupNotification.objects\
+                                            .filter(pk__in=claimed)\
+                                            .select_related('comment')
+        for notification in notifications:
+            sent_to = set(notification.sent_to.split())
+            try:
+                messages = build_mass_mail(
+                    [message for message in get_followup_messages(
+                        notification.comment, until=notification.created)
+                     if message[3][0] not in sent_to])
+                n_failed = 0
+                for message in messages:
+                    n_sent, n_failed = send_messages_in_chunks([message],
+                                                               connection)
+                    if n_failed:
+                        break
+                    sent_to.update(message.to)
+                    notification.sent_to = "\n".join(sorted(sent_to))
+                    notification.save(update_fields=['sent_to'])
+            except Exception:
+                logger.exception("Cannot send the notifications of "
+                                 "comment %s.", notification.comment_id)
+                n_failed = 1
+            if n_failed:
+                failed += 1
+            else:
+                notification.delete()
+                sent += 1
+    finally:
+        connection.close()
+    return sent, failed
 
 
 def reply(request, cid):
@@ -253,15 +374,66 @@ def reply(request, cid):
                   {"comment": comment, "form": form, "cid": cid, "next": next})
 
 
+def replies(request, thread_id, parent_id):
+    """
+    Render the replies below a comment that render_xtdcomment_tree left out,
+    as many levels of them as COMMENTS_XTD_TREE_DEPTH. Renders only the
+    comment tree for AJAX requests, and a page with the comment otherwise.
+    """
+    parent = get_object_or_404(XtdComment, pk=parent_id, thread_id=thread_id,
+                               is_public=True,
+                               site__pk=get_current_site(request).pk)
+    options = has_app_model_option(parent)
+    queryset = XtdComment.objects.filter(
+        thread_id=parent.thread_id, level__gt=parent.level,
+        thread_path__startswith=parent.thread_path, is_public=True
+    ).order_by(*thread_ordering())
+    comments = XtdComment.tree_from_queryset(
+        queryset,
+        with_flagging=options['allow_flagging'],
+        with_feedback=options['allow_feedback'],
+        user=request.user,
+        parent=parent,
+        depth=settings.COMMENTS_XTD_TREE_DEPTH or None,
+        max_replies=settings.COMMENTS_XTD_TREE_MAX_REPLIES or None)
+    ctype = ContentType.objects.get_for_id(parent.content_type_id)
+    if request.is_ajax():
+        template_name = "comment_tree.html"
+    else:
+        template_name = "replies.html"
+    template_arg = [
+        "django_comments_xtd/%s/%s/%s" % (ctype.app_label, ctype.model,
+                                          template_name),
+        "django_comments_xtd/%s/%s" % (ctype.app_label, template_name),
+        "django_comments_xtd/%s" % template_name
+    ]
+    return render(request, template_arg,
+                  {"comment": parent, "comments": comments,
+                   "allow_flagging": options['allow_flagging'],
+                   "allow_feedback": options['allow_feedback'],
+                   "show_feedback": options['show_feedback']})
+
+
 def mute(request, key):
-    try:
-        comment = signed.loads(str(key),
-                               extra_key=settings.COMMENTS_XTD_SALT)
-    except (ValueError, signed.BadSignature):
-        raise Http404
-    # the comment does exist if the URL was already confirmed, then: Http404
-    if not comment.followup or not _comment_exists(comment):
-        raise Http404
+    subscription = get_subscription_by_mute_key(key)
+    if subscription is not None:
+        comment = subscription.comment
+    else:
+        # Mute links sent before subscriptions existed carry a signed comment.
+        if not settings.COMMENTS_XTD_ACCEPT_PICKLED_KEYS:
+            raise Http404
+        try:
+            comment = signed.loads(str(key),
+                                   extra_key=settings.COMMENTS_XTD_SALT)
+        except (ValueError, signed.BadSignature):
+            raise Http404
+        # the comment does exist if the URL was already confirmed: Http404
+        if (
+                not comment.followup or
+                not XtdComment.objects.filter(pk=comment.pk,
+                                              followup=True).exists()
+        ):
+            raise Http404
 
     # Send signal that the comment thread has been muted
     signals.comment_thread_muted.send(sender=XtdComment,
@@ -272,6 +444,10 @@ def mute(request, key):
         content_type=comment.content_type, object_pk=comment.object_pk,
         is_public=True, followup=True, user_email=comment.user_email
     ).update(followup=False)
+    FollowupSubscription.objects.filter(
+        content_type=comment.content_type, object_pk=comment.object_pk,
+        user_email=comment.user_email
+    ).delete()
 
     model = apps.get_model(comment.content_type.app_label,
                            comment.content_type.model)
@@ -288,6 +464,34 @@ def mute(request, key):
     return render(request, template_arg, {"content_object": target})
 
 
+def comment_events(request, content_type, object_pk):
+    """
+    Stream of Server-Sent Events telling when the comments posted to the
+    object change. It stays open COMMENTS_XTD_EVENT_STREAM_TIMEOUT seconds.
+    """
+    broker = get_event_broker()
+    if broker is None:
+        raise Http404
+    app_label, model = content_type.split("-")
+    try:
+        ctype = ContentType.objects.get_by_natural_key(app_label, model)
+    except ContentType.DoesNotExist:
+        raise Http404
+    channel = event_channel(ctype.pk, object_pk)
+    try:
+        last_event_id = int(request.META['HTTP_LAST_EVENT_ID'])
+    except (KeyError, ValueError):
+        last_event_id = broker.last_event_id(channel)
+    response = StreamingHttpResponse(
+        stream_events(broker, channel, last_event_id,
+                      settings.COMMENTS_XTD_EVENT_STREAM_TIMEOUT),
+        content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @csrf_protect
 @login_required
 def flag(request, comment_id, next=None):
@@ -348,7 +552,7 @@ def like(request, comment_id, next=None):
                              c=comment.pk)
     # Render a form on GET
     else:
-        liked_it = request.user in comment.users_flagging(LIKEDIT_FLAG)
+        liked_it = comment.is_flagged_by(request.user, LIKEDIT_FLAG)
         return render(request, 'django_comments_xtd/like.html',
                       {'comment': comment,
                        'already_liked_it': liked_it,
@@ -382,7 +586,7 @@ def dislike(request, comment_id, next=None):
                              c=comment.pk)
     # Render a form on GET
     else:
-        disliked_it = request.user in comment.users_flagging(DISLIKEDIT_FLAG)
+        disliked_it = comment.is_flagged_by(request.user, DISLIKEDIT_FLAG)
         return render(request, 'django_comments_xtd/dislike.html',
                       {'comment': comment,
                        'already_disliked_it': disliked_it,